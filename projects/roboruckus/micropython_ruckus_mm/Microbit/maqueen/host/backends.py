@@ -0,0 +1,82 @@
+# Benchmark of the motion backends: plays the same game with the firmware's own speed loop and with
+# the Maqueen Plus board's PID controller holding the wheel speeds, and compares the moves
+# Usage: python backends.py [--moves N] [--seed S] [--gains LF,LB,RF,RB] [--firmware path] [--set NAME=VALUE]
+
+import argparse
+import ast
+import sys
+
+from emulate import FIRMWARE, random_game, run_game
+
+BACKENDS = (("software", {"OnboardPID": False}), ("onboard PID", {"OnboardPID": True}))
+
+
+# Mean of a field over some moves, or None if there aren't any
+def mean(moves, field):
+    return sum(move[field] for move in moves) / len(moves) if moves else None
+
+
+def summary(result):
+    moves = result["moves"]
+    straight = [move for move in moves if "turn" not in move]
+    turns = [move for move in moves if "turn" in move]
+    for move in straight:
+        move["error"] = (abs(move["left"] - move["target"]) + abs(move["right"] - move["target"])) / 2
+    for move in turns:
+        move["error"] = abs(move["error_deg"])
+    return {
+        "straight_ms": mean(straight, "actual_ms"),
+        "straight_error": mean(straight, "error"),
+        "straight_i2c": mean(straight, "i2c"),
+        "turn_ms": mean(turns, "actual_ms"),
+        "turn_error": mean(turns, "error"),
+        "turn_i2c": mean(turns, "i2c"),
+        "moves": len(moves),
+        "i2c": result["device"].i2c.transactions,
+        "virtual_ms": result["virtual_ms"],
+    }
+
+
+def report(rows, out=sys.stdout):
+    out.write("%-12s %11s %12s %10s %11s %12s %10s %10s %10s\n" % (
+        "backend", "straight ms", "error ticks", "I2C/move", "turn ms", "error deg", "I2C/turn", "I2C total",
+        "game ms"))
+
+    def cell(value, width, form):
+        return ("%" + str(width) + form) % value if value is not None else " " * (width - 1) + "-"
+
+    for name, row in rows:
+        out.write("%-12s %s %s %s %s %s %s %10d %10.0f\n" % (
+            name, cell(row["straight_ms"], 11, ".1f"), cell(row["straight_error"], 12, ".2f"),
+            cell(row["straight_i2c"], 10, ".1f"), cell(row["turn_ms"], 11, ".1f"), cell(row["turn_error"], 12, ".2f"),
+            cell(row["turn_i2c"], 10, ".1f"), row["i2c"], row["virtual_ms"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the firmware's speed loop with the board's onboard PID")
+    parser.add_argument("--moves", type=int, default=40, help="number of moves in the game")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random move script")
+    parser.add_argument("--gains", metavar="LF,LB,RF,RB",
+                        help="speed the board reports per unit of PWM for each wheel and direction")
+    parser.add_argument("--firmware", default=FIRMWARE, help="firmware file to run")
+    parser.add_argument("--limit", type=int, default=3600000, help="virtual time limit in ms")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override one of the firmware's settings for both backends")
+    args = parser.parse_args(argv)
+    overrides = {}
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        overrides[name] = ast.literal_eval(value)
+    gains = [float(value) for value in args.gains.split(",")] if args.gains else None
+    rows = []
+    for name, backend in BACKENDS:
+        settings = dict(overrides)
+        settings.update(backend)
+        result = run_game(random_game(args.moves, args.seed), args.firmware, limit_ms=args.limit, overrides=settings,
+                          gains=gains)
+        rows.append((name, summary(result)))
+    report(rows)
+
+
+if __name__ == "__main__":
+    main()
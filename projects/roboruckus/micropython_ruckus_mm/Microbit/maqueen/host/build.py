@@ -0,0 +1,368 @@
+# Splits the μPython code into modules that can be precompiled with mpy-cross, so the micro:bit doesn't have to
+# compile the whole file from source every time it starts
+# Usage: python build.py [--firmware path] [--out dir] [--mpy-cross path] [--set NAME=VALUE] [--check]
+#
+# maqueen_ruckus_uPython.py stays the code to edit. This writes out/source with main.py and the modules below,
+# and out/mpy with main.py and the modules compiled to .mpy if mpy-cross is found:
+#   ruckus_config    the settings and constants at the top of the file, and the robot's game state
+#   ruckus_protocol  orders, the move queue and Done reports, the base class of WiFi
+#   ruckus_wifi      the ESP8266 transport: AT commands, +IPD frames and the link manager
+#   ruckus_settings  storing and loading the robot's settings, a base class of MaqueenPlus
+#   ruckus_moves     profiled and onboard PID moves, pivot turns, model calibration, odometry and the encoder
+#                    trace, a base class of MaqueenPlus
+#   ruckus_motion    the motor board, moves and the task scheduler
+# The modules are cut out of the file's text, so they keep its comments. Settings that the code changes while
+# running, the ones it declares global somewhere, are used as attributes of ruckus_config so every module sees
+# the same value. The other constants are imported by name.
+# Every module has to stay within MODULE_BUDGET bytes of code, and every method of a class split up by BASES has
+# to be listed in BASES or KEPT.
+# With --check the source build also has to play a few games in the emulator exactly like the single file, and
+# anything wrong makes this exit with an error.
+
+import argparse
+import ast
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+
+from emulate import FIRMWARE, random_game, run_game
+
+CONFIG = "ruckus_config"
+MAIN = "main"
+# Bytes of code, not counting comments and blank lines, of the original maqueen_ruckus_uPython.py, the biggest
+# source file known to compile and run on a robot. The micro:bit compiles a source file whole when it starts and
+# runs out of RAM on one too big, so no module may have more, and a single file with more has to be deployed as
+# a build. Raise it only after starting a robot from a bigger file with host/startup.py --listen, and looking at
+# the free heap it reports
+MODULE_BUDGET = 19208
+# Modules in the order they can import each other
+MODULES = (CONFIG, "ruckus_protocol", "ruckus_wifi", "ruckus_settings", "ruckus_moves", "ruckus_motion")
+# Module of each class with methods, classes with only constants go to ruckus_config
+CLASSES = {"ATMatcher": "ruckus_wifi", "UARTWriter": "ruckus_wifi", "LinkManager": "ruckus_wifi", "WiFi": "ruckus_wifi",
+           "Scheduler": "ruckus_motion", "MaqueenPlus": "ruckus_motion"}
+# Methods moved out of a class into base classes of it in other modules: class -> ((module, base class, methods), ...)
+BASES = {
+    "WiFi": (
+        ("ruckus_protocol", "Protocol", (
+            "MessageReceived", "InboxReceived", "BinaryReceived", "Assign", "Order", "ResetOrder", "ProgramQueued",
+            "QueueProgram", "RejectProgram", "ProgramReport", "QueueMove", "NextMove", "RunQueue", "ProcessMove",
+            "PushReport", "NewTimeline", "Stamp", "AckSent", "IntakeTask", "NetworkTask", "ReportDone", "ReportSteps",
+            "KeepPose", "KeepStats", "KeepHeap", "DoneSteps", "WriteDone", "ReportSent", "SetupMode",
+            "SetupInstruction", "SendTrace")),),
+    "MaqueenPlus": (
+        ("ruckus_settings", "Settings", (
+            "SaveSettings", "UseSettings", "WriteSettings", "ReadSettings", "CRC16", "LoadSettings")),
+        ("ruckus_moves", "Moves", (
+            "TraceSample", "TraceStart", "Odometry", "ResetPose", "Snap", "ProfiledSteps", "PIDSteps", "RecordMove",
+            "PivotSteps", "CalibrateSteps", "FitSpeedSteps", "MeasureSteps"))),
+}
+# Methods that stay in the classes split up by BASES, so a method added to one of them has to be given a module
+KEPT = {
+    "WiFi": (
+        "__init__", "WifiStartup", "Wait", "ParseIP", "SendCommand", "Response", "CommandSteps", "DropStale",
+        "FillSerial", "Pump", "ParseFrame", "FrameDone", "ReadMessage", "EmptySerialBuffer"),
+    "MaqueenPlus": (
+        "__init__", "forever", "MotionTask", "UITask", "HeapStart", "HeapSample", "SettleSteps", "Drive", "MoveSteps",
+        "SoundSteps", "getVersion", "I2CInit", "I2CSteps", "StartSteps", "RGB", "setMotors", "setLMotor", "setRMotor",
+        "stopAll", "getPID", "togglePID", "motorSpeed", "clearDistance", "getRotations", "getSensors", "ReadSensors",
+        "getDistance", "getLineBits", "getLine", "StopAt", "LinearMove", "LinearSteps", "Turn", "TurnSteps",
+        "CalibrateSpeed", "NavigationTest", "NavigationSteps"),
+}
+
+
+# Names a statement binds at the top level of a module
+def bound_names(node):
+    if isinstance(node, (ast.ClassDef, ast.FunctionDef)):
+        return {node.name}
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return {(alias.asname or alias.name).split(".")[0] for alias in node.names}
+    names = set()
+    for target in getattr(node, "targets", [getattr(node, "target", None)]):
+        if target is not None:
+            names.update(name.id for name in ast.walk(target) if isinstance(name, ast.Name))
+    return names
+
+
+# Names loaded anywhere in some statements
+def used_names(nodes):
+    return {name.id for node in nodes for name in ast.walk(node) if isinstance(name, ast.Name)}
+
+
+# Bytes of a file the micro:bit has to compile, blank lines and comments aren't counted since the compiler skips them
+def code_size(text):
+    return sum(len(line.encode()) + 1 for line in text.splitlines()
+               if line.strip() and not line.lstrip().startswith("#"))
+
+
+# The firmware's text, with the changes to make to it as it's copied into the modules
+class Source:
+    def __init__(self, text):
+        self.data = text.encode()
+        # ast columns are UTF-8 byte offsets, so the text is kept as bytes
+        self.starts = [0]
+        for line in self.data.splitlines(keepends=True):
+            self.starts.append(self.starts[-1] + len(line))
+        self.edits = []
+
+    # Replaces the text of a node
+    def replace(self, node, text):
+        self.edits.append((self.starts[node.lineno - 1] + node.col_offset,
+                           self.starts[node.end_lineno - 1] + node.end_col_offset, text))
+
+    # Takes out whole lines
+    def delete(self, first, last):
+        self.edits.append((self.starts[first - 1], self.starts[last], ""))
+
+    # Lines first to last, counting from 1, with the changes made
+    def lines(self, first, last):
+        start, end = self.starts[first - 1], self.starts[last]
+        parts = []
+        for edit_start, edit_end, text in sorted(edit for edit in self.edits if start <= edit[0] and edit[1] <= end):
+            parts.append(self.data[start:edit_start])
+            parts.append(text.encode())
+            start = edit_end
+        parts.append(self.data[start:end])
+        return b"".join(parts).decode()
+
+
+# Text of each statement with the blank lines and comments between it and the one before
+def segments(source, nodes, after):
+    texts = []
+    for node in nodes:
+        texts.append(source.lines(after + 1, node.end_lineno))
+        after = node.end_lineno
+    return texts
+
+
+# Reads the settings the code changes as attributes of ruckus_config, except in functions where they're local
+class SharedSettings(ast.NodeVisitor):
+    def __init__(self, shared, source):
+        self.shared = shared
+        self.source = source
+        self.local = set()
+        self.changed = False
+
+    def visit_FunctionDef(self, node):
+        outer = self.local
+        declared = {name for statement in ast.walk(node) if isinstance(statement, ast.Global)
+                    for name in statement.names}
+        arguments = {argument.arg for argument in ast.walk(node.args) if isinstance(argument, ast.arg)}
+        stored = {name.id for name in ast.walk(node) if isinstance(name, ast.Name) and isinstance(name.ctx, ast.Store)}
+        self.local = (arguments | stored) - declared
+        self.generic_visit(node)
+        self.local = outer
+
+    def visit_Global(self, node):
+        names = [name for name in node.names if name not in self.shared]
+        if names:
+            self.source.replace(node, "global " + ", ".join(names))
+        else:
+            self.source.delete(node.lineno, node.end_lineno)
+
+    def visit_Name(self, node):
+        if node.id in self.shared and node.id not in self.local:
+            self.source.replace(node, "config." + node.id)
+            self.changed = True
+
+
+def split(text, overrides=None):
+    source = Source(text)
+    tree = ast.parse(text)
+    imports = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    # The license and contributors at the top go in every module
+    notice = source.lines(1, tree.body[0].lineno - 1).strip()
+    # Settings changed at runtime are declared global somewhere
+    shared = {name for node in ast.walk(tree) if isinstance(node, ast.Global) for name in node.names}
+    # Statements of each module, for working out its imports, and their text
+    bodies = {name: [] for name in MODULES + (MAIN,)}
+    texts = {name: [] for name in MODULES + (MAIN,)}
+    uses_config = set()
+
+    # Rewrites the shared settings in some statements, True if any were used
+    def rewrite(nodes):
+        settings = SharedSettings(shared, source)
+        for node in nodes:
+            settings.visit(node)
+        return settings.changed
+
+    after = imports[-1].end_lineno
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            continue
+        start, after = after, node.end_lineno
+        if overrides and isinstance(node, ast.Assign):
+            for name in bound_names(node) & set(overrides):
+                source.replace(node.value, repr(overrides[name]))
+        if isinstance(node, ast.If):
+            # The __main__ block starts the robot
+            if rewrite(node.body):
+                uses_config.add(MAIN)
+            bodies[MAIN].extend(node.body)
+            texts[MAIN].append(textwrap.dedent(source.lines(node.lineno + 1, node.end_lineno)))
+        elif isinstance(node, ast.ClassDef) and any(isinstance(item, ast.FunctionDef) for item in node.body):
+            if node.name not in CLASSES:
+                raise ValueError("class " + node.name + " needs a module in CLASSES")
+            splits = []
+            if node.name in BASES:
+                methods = [item.name for item in node.body if isinstance(item, ast.FunctionDef)]
+                listed = list(KEPT[node.name]) + [name for _, _, names in BASES[node.name] for name in names]
+                unlisted = [name for name in methods if name not in listed]
+                if unlisted:
+                    raise ValueError(", ".join(node.name + "." + name for name in unlisted) +
+                                     " need a module in BASES or KEPT")
+                missing = sorted(set(listed) - set(methods))
+                if missing:
+                    raise ValueError(node.name + " has no " + ", ".join(missing))
+                for module, base, names in BASES[node.name]:
+                    moved = [item for item in node.body if isinstance(item, ast.FunctionDef) and item.name in names]
+                    if rewrite(moved):
+                        uses_config.add(module)
+                    bodies[module].append(ast.ClassDef(name=base, bases=[], keywords=[], body=moved,
+                                                       decorator_list=[]))
+                    node.bases.append(ast.Name(id=base, ctx=ast.Load()))
+                    splits.append((module, base, moved))
+            kept = [item for item in node.body if not any(item in moved for _, _, moved in splits)]
+            if rewrite(kept):
+                uses_config.add(CLASSES[node.name])
+            # Each method is cut out with the comments above it
+            items = dict(zip(node.body, segments(source, node.body, node.lineno)))
+            for module, base, moved in splits:
+                texts[module].append("\n# Methods of " + node.name + ", moved out of it by host/build.py\n" +
+                                     "class " + base + ":\n" + "".join(items[item] for item in moved).lstrip("\n"))
+            node.body = kept
+            header = "class " + node.name
+            if node.bases:
+                header += "(" + ", ".join(ast.unparse(base) for base in node.bases) + ")"
+            bodies[CLASSES[node.name]].append(node)
+            texts[CLASSES[node.name]].append(source.lines(start + 1, node.lineno - 1) + header + ":\n" +
+                                             "".join(items[item] for item in kept))
+        else:
+            bodies[CONFIG].append(node)
+            texts[CONFIG].append(source.lines(start + 1, node.end_lineno))
+    defined = {}
+    for module in MODULES:
+        for node in bodies[module]:
+            for name in bound_names(node):
+                defined[name] = module
+    if shared - {name for name, module in defined.items() if module == CONFIG}:
+        raise ValueError("globals changed at runtime must be set at the top of the file")
+    modules = {}
+    for module in MODULES + (MAIN,):
+        body = bodies[module]
+        used = used_names(body)
+        header = []
+        for node in imports:
+            names = [alias for alias in node.names if (alias.asname or alias.name).split(".")[0] in used]
+            if names:
+                if isinstance(node, ast.ImportFrom):
+                    header.append(ast.ImportFrom(module=node.module, names=names, level=0))
+                else:
+                    header.append(ast.Import(names=names))
+        if module in uses_config:
+            header.append(ast.Import(names=[ast.alias(name=CONFIG, asname="config")]))
+        own = {name for node in body for name in bound_names(node)}
+        for other in MODULES:
+            wanted = sorted(name for name in used - own if defined.get(name) == other and name not in shared)
+            if other == module or not wanted:
+                continue
+            if module != MAIN and MODULES.index(other) > MODULES.index(module):
+                raise ValueError(module + " can't import " + ", ".join(wanted) + " from " + other)
+            header.append(ast.ImportFrom(module=other, names=[ast.alias(name=name) for name in wanted], level=0))
+        code = ast.unparse(ast.Module(body=header, type_ignores=[]))
+        modules[module] = (notice + "\n# Generated by host/build.py from maqueen_ruckus_uPython.py, edit that instead" +
+                           "\n\n" + code + "\n\n" + "".join(texts[module]).lstrip("\n").rstrip("\n") + "\n")
+    return modules
+
+
+# Problems with the sizes of the modules of a build
+def over_budget(modules):
+    problems = []
+    for module, code in modules.items():
+        if code_size(code) > MODULE_BUDGET:
+            problems.append("%s has %d bytes of code, over MODULE_BUDGET %d" % (module, code_size(code), MODULE_BUDGET))
+    return problems
+
+
+# Games that have to go the same on the single file and the source build: the server has to get the same
+# requests at the same times through a dropped network, binary programs and setup mode
+def check(firmware, folder):
+    games = [("network drop", random_game(20, 3), {"drops": [(20000, 60000)]}),
+             ("binary programs", random_game(20, 5, program=6, report=1), {"binary": True}),
+             ("setup mode", [("assign", 1, 0), ("reset",), ("setup", "1:"), ("setup", "0:"),
+                             ("setup", "3:Test%20Bot,100,1300,0.72,0.32,1,50,51,52,53:")], {})]
+    problems = []
+    for name, script, options in games:
+        requests = []
+        for path in (firmware, folder):
+            # Costing nothing per line, so the longer lines of the build don't move anything
+            with contextlib.redirect_stdout(io.StringIO()):
+                requests.append(run_game(script, path, limit_ms=400000, line_us=0, **options)["server"].requests)
+        if requests[0] != requests[1]:
+            problems.append("the source build didn't play the " + name + " game like the single file")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split the Ruckus firmware into modules and precompile them")
+    parser.add_argument("--firmware", default=FIRMWARE, help="firmware file to split")
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(FIRMWARE), "build"),
+                        help="folder to write the builds to")
+    parser.add_argument("--mpy-cross", default="mpy-cross",
+                        help="mpy-cross to compile with, it has to match the micro:bit's MicroPython")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="change one of the settings at the top of the code in the build")
+    parser.add_argument("--check", action="store_true",
+                        help="also check that the source build plays like the single file in the emulator")
+    args = parser.parse_args(argv)
+    overrides = {}
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        overrides[name] = ast.literal_eval(value)
+    with open(args.firmware, encoding="utf-8") as source:
+        text = source.read()
+    modules = split(text, overrides)
+    folder = os.path.join(args.out, "source")
+    os.makedirs(folder, exist_ok=True)
+    for module, code in modules.items():
+        with open(os.path.join(folder, module + ".py"), "w") as module_file:
+            module_file.write(code)
+    sys.stdout.write("source build in " + folder + "\n")
+    sys.stdout.write("bytes of code: single file %d, " % code_size(text) +
+                     ", ".join("%s %d" % (module, code_size(code)) for module, code in modules.items()) + "\n")
+    if code_size(text) > MODULE_BUDGET:
+        sys.stdout.write("the single file is over the %d bytes of code a robot is known to compile, deploy a build\n"
+                         % MODULE_BUDGET)
+    problems = over_budget(modules)
+    compiler = shutil.which(args.mpy_cross)
+    if compiler is None:
+        sys.stdout.write(args.mpy_cross + " not found, the modules can still be copied as they are" +
+                         " (pip install mpy-cross)\n")
+    else:
+        compiled = os.path.join(args.out, "mpy")
+        os.makedirs(compiled, exist_ok=True)
+        # The micro:bit runs main.py, it only imports the rest
+        shutil.copy(os.path.join(folder, MAIN + ".py"), compiled)
+        for module in MODULES:
+            subprocess.run([compiler, "-o", os.path.join(compiled, module + ".mpy"),
+                            os.path.join(folder, module + ".py")], check=True)
+        sys.stdout.write("precompiled build in " + compiled + "\n")
+    if args.check:
+        # Settings changed with --set would make the games go differently
+        if overrides:
+            problems.append("--check compares the build with the single file, it can't be used with --set")
+        else:
+            problems.extend(check(args.firmware, folder))
+    for problem in problems:
+        sys.stdout.write(problem + "\n")
+    if problems:
+        sys.exit(1)
+    if args.check:
+        sys.stdout.write("the source build plays like the single file and everything is within budget\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# Fits movement settings for a fleet of robots from their encoder traces
+# Usage: python calibrate.py [--distance rotations] [--turn rotations] [--deadband PWM] [--send NAME=ADDRESS] TRACE...
+#
+# Each trace is the reply to setup mode instruction 4 saved to a file, see "Encoder Trace" in the README.
+# The robot's settings when the trace was taken go in a file of the same name ending in .settings, in the
+# SaveSettings format: name,speed,time,distance,turn,color,left forward,left backward,right forward,right
+# backward. Traces from robots with the same name are fitted together. For every robot this prints its
+# settings with the fitted travel and turn distances and wheel speeds, ending in ":" as the data of a setup
+# mode instruction, and the profile ramp and braking the motors can keep up with as comments.
+# Settings the traces can't tell anything about are kept as they were, with a warning on stderr.
+# With --send the fitted settings are sent straight to the robot at ADDRESS the way the game server sends
+# them: "1:" to enter setup mode, then "3:<settings>" to put them in use, save them and leave setup mode.
+# The robot has to be on and not assigned to a player.
+
+import argparse
+import os
+import socket
+import struct
+import sys
+
+import numpy as np
+
+# Encoder ticks per wheel rotation
+TICKS_PER_ROTATION = 90
+# Port the robot's Wi-Fi module listens on for messages from the game server
+ROBOT_PORT = 8080
+# Extra wheel rotations for each square after the first, see LinearSteps
+SQUARE_GAP = 0.18
+MARKER = 0xFFFF
+# Wheel and direction of each group of samples fitted by fit_gains, in the order of the settings
+GROUPS = ("left forward", "left backward", "right forward", "right backward")
+
+
+# A move from a trace: kind (0 straight, 1 turn, 2 calibration), magnitude, direction and its samples as columns of
+# ms since the start, left and right ticks, left and right PWM and left and right reported speed.
+# The last sample is where the wheels ended up.
+class Move:
+    def __init__(self, kind, magnitude, direction, samples):
+        self.kind = kind
+        self.magnitude = magnitude
+        self.direction = direction
+        self.t = samples[:, 0].astype(float)
+        self.ticks = samples[:, 1:3].astype(float)
+        self.pwm = (samples[:, 3:5] >> 8).astype(float)
+        self.speed = (samples[:, 3:5] & 0xFF).astype(float)
+
+
+def read_trace(path):
+    with open(path, "rb") as trace_file:
+        data = trace_file.read()
+    kind, version, count = struct.unpack_from("<BBH", data)
+    if kind != ord("T") or version != 2:
+        raise ValueError(path + " isn't a version 2 encoder trace")
+    samples = np.frombuffer(data, dtype="<u2", count=count * 5, offset=4).reshape(count, 5)
+    markers = np.flatnonzero(samples[:, 0] == MARKER)
+    if not len(markers) or markers[0] > 0:
+        sys.stderr.write(path + ": the trace filled up and its oldest samples were overwritten, a bigger TraceSize "
+                         "keeps more moves\n")
+    moves = []
+    # Samples before the first marker belong to a move whose start was overwritten
+    for index, start in enumerate(markers):
+        end = markers[index + 1] if index + 1 < len(markers) else count
+        if end - start > 2:
+            marker = samples[start]
+            moves.append(Move(int(marker[1]), int(marker[2]), int(marker[3]), samples[start + 1:end]))
+    return moves
+
+
+def read_settings(path, default):
+    if os.path.exists(path):
+        with open(path) as settings_file:
+            text = settings_file.readline().strip()
+    else:
+        text = default
+    fields = text.rstrip(":").split(",")
+    if len(fields) < 10:
+        raise ValueError("settings for " + path + " need all ten fields")
+    return [fields[0], int(fields[1]), int(fields[2]), float(fields[3]), float(fields[4]), int(fields[5])] + \
+        [int(value) for value in fields[6:10]]
+
+
+# Fits rotations per square so the ticks planned for each move plus the ticks coasted past them come
+# out at reference rotations per square, least squares over all moves. Planned ticks are distance *
+# magnitude * ticks per rotation plus a part that doesn't depend on the distance, which cancels out.
+def fit_distance(magnitudes, coasted, reference):
+    scale = magnitudes * TICKS_PER_ROTATION
+    wanted = scale * reference - coasted
+    solution, _, _, _ = np.linalg.lstsq(scale[:, None], wanted, rcond=None)
+    return float(solution[0])
+
+
+# Fits speed = gain * (PWM - deadband) for each group of samples, with one deadband shared by all of
+# them. The deadband is found by trying values on a grid, the gains for each have a closed form.
+# Returns the deadband and the gain of each group, or the given deadband if the samples can't tell.
+def fit_gains(pwm, speed, group, groups, deadband):
+    levels = [len(np.unique(pwm[group == index])) for index in range(groups)]
+    if max(levels, default=0) >= 2:
+        candidates = np.arange(0, min(pwm.min(), 30), 0.25)[:, None]
+    else:
+        candidates = np.array([[deadband]])
+    drive = pwm[None, :] - candidates
+    cross = np.stack([np.bincount(group, weights=row, minlength=groups) for row in drive * speed[None, :]])
+    power = np.stack([np.bincount(group, weights=row, minlength=groups) for row in drive * drive])
+    gains = np.where(power > 0, cross / np.where(power > 0, power, 1), 0)
+    residual = ((speed[None, :] - gains[:, group] * drive) ** 2).sum(axis=1)
+    best = int(np.argmin(residual))
+    return float(candidates[best, 0]), gains[best]
+
+
+# Samples where a wheel had been running at the same PWM for a while, per wheel and direction, from
+# straight moves and calibration runs. Groups are 0 left forward, 1 left backward, 2 right forward, 3 right backward
+def steady_samples(moves, settle_ms):
+    pwm, speed, group = [], [], []
+    for move in moves:
+        if move.kind == 1 or len(move.t) < 4:
+            continue
+        held = np.zeros(move.pwm.shape, dtype=bool)
+        held[2:] = (move.pwm[2:] == move.pwm[1:-1]) & (move.pwm[1:-1] == move.pwm[:-2])
+        keep = held & (move.pwm > 0) & (move.t[:, None] >= settle_ms)
+        for wheel in (0, 1):
+            rows = keep[:, wheel]
+            pwm.append(move.pwm[rows, wheel])
+            speed.append(move.speed[rows, wheel])
+            group.append(np.full(rows.sum(), wheel * 2 + (1 if move.direction == 1 else 0)))
+    if not pwm:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=int)
+    return np.concatenate(pwm), np.concatenate(speed), np.concatenate(group).astype(int)
+
+
+# How long the wheels take to get to 90% of their cruise speed, and how hard they slow down
+# when the motor is cut, in ticks/ms^2, as the medians over all straight moves
+def fit_ramp(moves):
+    rises, decels = [], []
+    for move in moves:
+        if move.kind != 0 or len(move.t) < 6:
+            continue
+        for wheel in (0, 1):
+            speed = move.speed[:-1, wheel]
+            cruise = np.median(speed[len(speed) // 3:2 * len(speed) // 3 + 1])
+            if cruise <= 0:
+                continue
+            rise = np.flatnonzero(speed >= 0.9 * cruise)
+            if len(rise):
+                rises.append(move.t[rise[0]])
+            cut = np.flatnonzero((move.pwm[1:-1, wheel] == 0) & (move.pwm[:-2, wheel] > 0)) + 1
+            if len(cut) and cut[0] >= 2:
+                index = cut[0]
+                rate = ((move.ticks[index, wheel] - move.ticks[index - 2, wheel])
+                        / max(1.0, move.t[index] - move.t[index - 2]))
+                coasted = move.ticks[-1, wheel] - move.ticks[index, wheel]
+                if coasted > 0 and rate > 0:
+                    decels.append(rate * rate / (2 * coasted))
+    return (float(np.median(rises)) if rises else None), (float(np.median(decels)) if decels else None)
+
+
+# Fits one robot's settings from its moves, returns the new settings, notes about the fit and
+# warnings about settings the moves couldn't tell anything about, which are kept as they were
+def calibrate(settings, moves, reference_distance, reference_turn, deadband, settle_ms):
+    name, target, _, distance, turn = settings[:5]
+    fitted = list(settings)
+    notes = ["%d moves" % len(moves)]
+    warnings = []
+    straight = [move for move in moves if move.kind == 0]
+    if straight:
+        magnitudes = np.array([move.magnitude for move in straight], dtype=float)
+        planned = (distance + (distance + SQUARE_GAP) * (magnitudes - 1)) * TICKS_PER_ROTATION
+        final = np.array([move.ticks[-1].mean() for move in straight])
+        # Moves that ran out of time never got to coast past the target
+        reached = final >= 0.9 * planned
+        if reached.any():
+            coasted = final[reached] - planned[reached]
+            fitted[3] = round(fit_distance(magnitudes[reached], coasted, reference_distance), 3)
+            notes.append("mean overshoot %.1f ticks" % coasted.mean())
+    if not straight or not reached.any():
+        warnings.append("no straight move reached its target, travel distance kept at %s" % distance)
+    turns = [move for move in moves if move.kind == 1]
+    if turns:
+        quarters = np.array([move.magnitude for move in turns], dtype=float)
+        planned = turn * quarters * TICKS_PER_ROTATION
+        final = np.array([move.ticks[-1].mean() for move in turns])
+        reached = final >= 0.9 * planned
+        if reached.any():
+            fitted[4] = round(fit_distance(quarters[reached], final[reached] - planned[reached], reference_turn), 3)
+    if not turns or not reached.any():
+        warnings.append("no turn reached its target, turn distance kept at %s" % turn)
+    pwm, speed, group = steady_samples(moves, settle_ms)
+    gains = np.zeros(len(GROUPS))
+    if len(pwm):
+        deadband, gains = fit_gains(pwm, speed, group, len(GROUPS), deadband)
+        notes.append("deadband %.2f, gains %s" % (deadband, " ".join("%.3f" % gain for gain in gains)))
+    for index, wheel in enumerate(GROUPS):
+        if gains[index] > 0:
+            fitted[6 + index] = int(round(deadband + target / gains[index]))
+        else:
+            warnings.append("no steady speeds for the %s wheel, PWM kept at %d" % (wheel, settings[6 + index]))
+    rise, decel = fit_ramp(moves)
+    return fitted, notes, warnings, rise, decel
+
+
+# Sends one message to a robot like the game server does, on a connection of its own that's closed
+# once the robot answers, returns the answer
+def send(address, message, timeout=30):
+    with socket.create_connection((address, ROBOT_PORT), timeout=timeout) as connection:
+        connection.sendall(message.encode())
+        return connection.recv(64).decode(errors="replace")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit movement settings from robots' encoder traces")
+    parser.add_argument("traces", nargs="+", help="trace files, each with a .settings file next to it")
+    parser.add_argument("--distance", type=float, default=0.72,
+                        help="wheel rotations one square should really take, including coasting")
+    parser.add_argument("--turn", type=float, default=0.32, help="wheel rotations a quarter turn should really take")
+    parser.add_argument("--deadband", type=float, default=5,
+                        help="PWM below which the motors don't turn, used if the traces only have one PWM per wheel")
+    parser.add_argument("--settle", type=float, default=200, help="ignore speeds from the first ms of each move")
+    parser.add_argument("--settings", default="Test%20Bot,100,1300,0.72,0.32,7,40,40,40,40",
+                        help="settings for traces that don't have a .settings file")
+    parser.add_argument("--send", action="append", default=[], metavar="NAME=ADDRESS",
+                        help="send the settings fitted for the robot called NAME to it at ADDRESS")
+    args = parser.parse_args(argv)
+    addresses = dict(robot.split("=", 1) for robot in args.send)
+    robots = {}
+    for path in args.traces:
+        settings = read_settings(os.path.splitext(path)[0] + ".settings", args.settings)
+        entry = robots.setdefault(settings[0], [settings, []])
+        entry[1].extend(read_trace(path))
+    for name, (settings, moves) in robots.items():
+        fitted, notes, warnings, rise, decel = calibrate(settings, moves, args.distance, args.turn, args.deadband,
+                                                         args.settle)
+        sys.stdout.write("# " + name + ": " + ", ".join(notes) + "\n")
+        for warning in warnings:
+            sys.stderr.write(name + ": " + warning + "\n")
+        line = ",".join(str(value) for value in fitted) + ":"
+        sys.stdout.write(line + "\n")
+        if rise is not None and decel is not None:
+            sys.stdout.write("# ProfileRamp = %d, ProfileBrake = %.5f\n" % (int(round(rise)), decel))
+        if name in addresses:
+            send(addresses[name], "1:")
+            answer = send(addresses[name], "3:" + line)
+            sys.stdout.write("# sent to " + addresses[name] + ", robot answered " + repr(answer) + "\n")
+    for name in addresses:
+        if name not in robots:
+            sys.stdout.write("# no traces from " + name + ", nothing sent\n")
+
+
+if __name__ == "__main__":
+    main()
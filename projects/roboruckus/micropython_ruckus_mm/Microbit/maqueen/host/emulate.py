@@ -0,0 +1,326 @@
+# Runs the Ruckus firmware on the host against an emulated micro:bit, Maqueen Plus and ESP8266
+# Usage: python emulate.py [--moves N] [--seed S] [--firmware path] [--rtt ms] [--drop AT_MS:FOR_MS] [--trace FILE]
+#                          [--set NAME=VALUE]
+
+import argparse
+import ast
+import builtins
+import collections
+import math
+import os
+import random
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from microbit import HEAP_FREE, LINE_US, MicroBit, VirtualClock, EmulationTimeout, run_lines, stop_lines
+from esp8266 import ESP8266, ScriptedServer, Timing
+
+FIRMWARE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "maqueen_ruckus_uPython.py")
+
+
+# Executes the firmware source with its imports bound to one emulated device
+# The firmware only starts its main loop when run as __main__, so this just defines everything.
+# A folder is a build split into modules by build.py, its modules are loaded on first import and the
+# overrides go into ruckus_config before anything imports it. Its main.py isn't run.
+def load_firmware(device, path=FIRMWARE, overrides=None):
+    modules = device.modules()
+    real_import = builtins.__import__
+    loaded = {}
+
+    def emulated_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if name in modules:
+            return modules[name]
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, name + ".py")):
+            if name not in loaded:
+                module = types.ModuleType(name)
+                loaded[name] = module
+                run(os.path.join(path, name + ".py"), vars(module))
+                if name == "ruckus_config":
+                    vars(module).update(overrides or {})
+            return loaded[name]
+        return real_import(name, globals, locals, fromlist, level)
+
+    emulated_builtins = dict(vars(builtins))
+    emulated_builtins["__import__"] = emulated_import
+    emulated_builtins["open"] = device.fs.open
+
+    def run(file, namespace):
+        # The clock tells run_lines which frames are firmware
+        namespace.update({"__file__": file, "__builtins__": emulated_builtins, "__clock__": device.clock})
+        with open(file) as source:
+            code = compile(source.read(), file, "exec")
+        exec(code, namespace)
+
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".py") and name != "main.py":
+                emulated_import(name[:-3])
+        # The settings first so they're seen as the code changes them
+        return collections.ChainMap(*sorted((vars(module) for module in loaded.values()),
+                                            key=lambda namespace: namespace["__name__"] != "ruckus_config"))
+    namespace = {"__name__": "ruckus_firmware"}
+    run(path, namespace)
+    namespace.update(overrides or {})
+    return namespace
+
+
+# A game: player assignment followed by a mix of the usual card moves
+# With a program size the moves are sent as program messages of that many moves
+def random_game(moves, seed=1, player=1, bot=0, program=0, report=0):
+    rng = random.Random(seed)
+    # (Movement, Magnitude), weighted roughly like a deck of program cards
+    cards = [(2, 1)] * 6 + [(2, 2)] * 4 + [(2, 3)] * 2 + [(3, 1)] * 2 + [(0, 1)] * 3 + [(1, 1)] * 3 + [(1, 2)] * 2
+    script = [("assign", player, bot)]
+    for _ in range(moves):
+        movement, magnitude = rng.choice(cards)
+        script.append(("move", movement, magnitude, 0))
+    if program:
+        orders = [step[1:] for step in script[1:]]
+        script = script[:1] + [("program", report, orders[i:i + program]) for i in range(0, len(orders), program)]
+    return script
+
+
+# Builds one emulated robot running the firmware against a scripted server
+# drops are (at ms, for ms) pairs when the access point goes missing, gains are the board's
+# speed per unit of PWM for the left forward, left backward, right forward and right backward wheels,
+# line_us what each line of firmware costs to run
+def make_robot(script, firmware=FIRMWARE, timing=None, limit_ms=None, overrides=None, binary=False,
+               esp_state="configured", drops=(), gains=None, line_us=LINE_US):
+    device = MicroBit(VirtualClock(limit_ms, line_us))
+    if gains:
+        device.board.gains = {("L", 1): gains[0], ("L", 2): gains[1], ("R", 1): gains[2], ("R", 2): gains[3]}
+    server = ScriptedServer(script, binary=binary)
+    esp = ESP8266(device.clock, server, timing=timing, state=esp_state)
+    for at_ms, duration_ms in drops:
+        esp.drop_ap(at_ms * 1000, duration_ms)
+    device.uart.attach(esp)
+    namespace = load_firmware(device, firmware, overrides)
+    server.address = namespace["ServerAddress"]
+    server.port = int(namespace["ServerPort"])
+    return device, esp, server, namespace
+
+
+def run_game(script, firmware=FIRMWARE, timing=None, limit_ms=None, overrides=None, binary=False,
+             esp_state="configured", drops=(), gains=None, line_us=LINE_US):
+    device, esp, server, namespace = make_robot(script, firmware, timing, limit_ms, overrides, binary, esp_state, drops,
+                                                gains, line_us)
+    wall_start = time.perf_counter()
+    bot = None
+    moves = []
+    run_lines()
+    try:
+        bot = namespace["MaqueenPlus"]()
+        server.on_finished = lambda: setattr(bot, "running", False)
+        finish = watch_moves(bot, device, moves)
+        if not server.finished:
+            bot.forever()
+        # Give the last move time to coast to a stop
+        device.clock.advance(300000)
+        finish()
+        if hasattr(bot, "Odometry"):
+            bot.Odometry()
+    except EmulationTimeout as error:
+        print("Stopped: " + str(error))
+    finally:
+        stop_lines()
+    wall = time.perf_counter() - wall_start
+    return {"device": device, "esp": esp, "server": server, "bot": bot, "namespace": namespace, "moves": moves,
+            "wall_ms": wall * 1000, "virtual_ms": device.clock.now_us / 1000}
+
+
+# Records the firmware's own stats for every straight move and turn, plus where the wheels really stopped
+# and how far from the middle of a square, and how many I2C transactions the move took
+# The motion runs as generator steps, so each record is finished when the next move starts or the game
+# ends, by which time the wheels have coasted to a stop without the emulator stepping the clock itself
+def watch_moves(bot, device, moves):
+    pending = []
+
+    def finish():
+        for record, start_heading in pending:
+            if "turn" in record:
+                turned = math.degrees(start_heading - device.board.heading)
+                if record.pop("direction") != 0:
+                    turned = -turned
+                record["error_deg"] = turned - 90 * record["turn"]
+            else:
+                ticks = device.board.ticks
+                record["left"] = ticks["L"]
+                record["right"] = ticks["R"]
+                record["grid_mm"] = device.board.grid_error()
+            moves.append(record)
+        del pending[:]
+
+    linear_steps = bot.LinearSteps
+
+    def watched(Magnitude, MoveDirection, Calibrate):
+        finish()
+        transactions = device.i2c.transactions
+        yield from linear_steps(Magnitude, MoveDirection, Calibrate)
+        if Calibrate or not hasattr(bot, "move_stats"):
+            return
+        stats = list(bot.move_stats)
+        pending.append(({"magnitude": Magnitude, "planned_ms": stats[0], "actual_ms": stats[1], "target": stats[2],
+                         "i2c": device.i2c.transactions - transactions}, 0))
+
+    bot.LinearSteps = watched
+    turn_steps = bot.TurnSteps
+
+    def watched_turn(magnitude, direction):
+        finish()
+        start = device.clock.now_us
+        heading = device.board.heading
+        transactions = device.i2c.transactions
+        yield from turn_steps(magnitude, direction)
+        elapsed = (device.clock.now_us - start) / 1000
+        pending.append(({"turn": magnitude, "direction": direction, "actual_ms": elapsed,
+                         "i2c": device.i2c.transactions - transactions}, heading))
+
+    bot.TurnSteps = watched_turn
+    return finish
+
+
+def report(result, out=sys.stdout):
+    server = result["server"]
+    out.write("%-22s %12s %10s %9s\n" % ("phase", "virtual ms", "wall ms", "speedup"))
+    for phase in server.phases:
+        virtual = (phase["end_us"] - phase["start_us"]) / 1000
+        wall = (phase["wall_end"] - phase["wall_start"]) * 1000
+        out.write("%-22s %12.1f %10.1f %8.0fx\n" % (phase["name"], virtual, wall, virtual / wall if wall else 0))
+    moves = [p for p in server.phases if p["name"].startswith("move") or p["name"].startswith("program")]
+    if moves:
+        count = sum(1 if p["name"].startswith("move") else (len(p["name"].split(" ", 1)[1]) - 2) // 3 for p in moves)
+        mean = sum((p["end_us"] - p["start_us"]) / 1000 for p in moves) / count
+        out.write("mean move round trip: %.1f ms over %d moves\n" % (mean, count))
+    out.write("total: %.1f ms virtual in %.1f ms wall (%.0fx)\n" % (
+        result["virtual_ms"], result["wall_ms"], result["virtual_ms"] / result["wall_ms"]))
+    straight = [m for m in result["moves"] if "turn" not in m]
+    if straight:
+        out.write("straight moves: mean time %.1f ms, mean planned %.1f ms, mean |distance error| %.2f ticks\n" % (
+            sum(m["actual_ms"] for m in straight) / len(straight),
+            sum(m["planned_ms"] for m in straight) / len(straight),
+            sum(abs(m["left"] - m["target"]) + abs(m["right"] - m["target"]) for m in straight) / (2 * len(straight))))
+        out.write("after straight moves: mean %.1f mm, worst %.1f mm from the middle of a square\n" % (
+            sum(m["grid_mm"] for m in straight) / len(straight), max(m["grid_mm"] for m in straight)))
+    for quarters in (1, 2, 3):
+        turns = [m for m in result["moves"] if m.get("turn") == quarters]
+        if turns:
+            out.write("%d-quarter turns: mean time %.1f ms, mean |heading error| %.1f degrees over %d turns\n" % (
+                quarters, sum(m["actual_ms"] for m in turns) / len(turns),
+                sum(abs(m["error_deg"]) for m in turns) / len(turns), len(turns)))
+    device = result["device"]
+    pose = getattr(result["bot"], "pose", None)
+    if pose is not None and result["moves"]:
+        board = device.board
+        out.write(("odometry: x %.0f mm, y %.0f mm, heading %.1f degrees, "
+                   "really x %.0f mm, y %.0f mm, heading %.1f degrees\n") % (
+            pose[0], pose[1], math.degrees(pose[2]), board.x, board.y, math.degrees(board.heading)))
+    times = getattr(getattr(result["bot"], "wifi", None), "boot_times", None)
+    if times:
+        out.write(("startup: module checked %d ms, configured %d ms, joined %d ms, board up at %d ms, "
+                   "registered at %d ms\n") % tuple(times))
+    out.write("AT commands: %s\n" % ", ".join("%s=%d" % item for item in sorted(result["esp"].commands.items())))
+    if result["esp"].busy_commands:
+        out.write("AT commands sent before the module had answered the last one: %d\n" % result["esp"].busy_commands)
+    paths = [path for at_us, path in result["server"].requests]
+    out.write("server requests: %d /Bot/Index, %d /Bot/Done\n" % (
+        sum(path.startswith("/Bot/Index") for path in paths), sum(path.startswith("/Bot/Done") for path in paths)))
+    wifi = getattr(result["bot"], "wifi", None)
+    if hasattr(wifi, "total_reuses"):
+        out.write("Done reports: %d reused connections, %d reconnects\n" % (wifi.total_reuses, wifi.total_reconnects))
+    esp = result["esp"]
+    if esp.drops:
+        out.write("access point dropped %d times, %d joins tried while it was gone\n" % (
+            len(esp.drops), esp.failed_joins))
+        links = getattr(wifi, "links", None)
+        if links is not None:
+            count = min(links.incidents, len(links.recovery_ms))
+            out.write("link incidents: %d%s%s\n" % (
+                links.incidents,
+                ", recovered in %s ms (tiers %s)" % (
+                    ", ".join(str(ms) for ms in links.recovery_ms[:count]),
+                    ", ".join(str(tier) for tier in links.recovery_tier[:count])) if count else "",
+                ", still recovering" if links.incident_start >= 0 else ""))
+    out.write("I2C transactions: %d, UART bytes out/in: %d/%d\n" % (
+        device.i2c.transactions, device.uart.bytes_written, device.uart.bytes_read))
+    clock = device.clock
+    if clock.line_us:
+        out.write("CPU: %d lines of firmware at %g us each, %.1f ms in all\n" % (
+            clock.lines, clock.line_us, clock.lines * clock.line_us / 1000))
+    else:
+        out.write("CPU: not modelled, running the firmware takes no time and task busy times are only time spent on"
+                  " I/O\n")
+    out.write("heap: not modelled, gc.mem_free() is always %d, so &heap and &free are placeholders\n" % HEAP_FREE)
+    scheduler = getattr(result["bot"], "scheduler", None)
+    if scheduler is not None:
+        for name, _, _, steps, total, longest in scheduler.tasks:
+            out.write("task %-8s %7d steps, %9.1f ms busy, mean %6.0f us, longest %6d us\n" % (
+                name, steps, total / 1000, total / steps if steps else 0, longest))
+
+
+# Saves the encoder trace the robot sent at the end of the game, and its settings in the
+# SaveSettings format next to it, for calibrate.py
+def save_trace(result, path):
+    traces = [reply for reply in result["server"].replies if reply[:1] == b"T"]
+    if not traces:
+        sys.stderr.write("no encoder trace came back\n")
+        return
+    with open(path, "wb") as trace_file:
+        trace_file.write(traces[-1])
+    namespace = result["namespace"]
+    settings = [namespace[name] for name in (
+        "RobotName", "LinearSpeedTarget", "LinearTime", "LinearDistance", "TurnDistance", "Color",
+        "Left_Forward_Speed", "Left_Backward_Speed", "Right_Forward_Speed", "Right_Backward_Speed")]
+    with open(os.path.splitext(path)[0] + ".settings", "w") as settings_file:
+        settings_file.write(",".join(str(value) for value in settings) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Ruckus firmware against an emulated robot")
+    parser.add_argument("--moves", type=int, default=20, help="number of moves in the game")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random move script")
+    parser.add_argument("--firmware", default=FIRMWARE, help="firmware file, or folder of a build.py build, to run")
+    parser.add_argument("--program", type=int, default=0, help="send moves as programs of this many moves")
+    parser.add_argument("--report", type=int, default=0, choices=(0, 1),
+                        help="programs report after each move (0) or once (1)")
+    parser.add_argument("--binary", action="store_true",
+                        help="send messages in the binary format if the firmware offers it")
+    parser.add_argument("--esp", default="configured", choices=("factory", "configured", "warm"),
+                        help="state of the Wi-Fi module at power up")
+    parser.add_argument("--drop", action="append", default=[], metavar="AT_MS:FOR_MS",
+                        help="take the access point away at a virtual time for a while, can be repeated")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record the encoder trace and save it and the robot's settings at the end")
+    parser.add_argument("--gains", metavar="LF,LB,RF,RB",
+                        help="speed the board reports per unit of PWM for each wheel and direction")
+    parser.add_argument("--rtt", type=float, default=Timing.rtt, help="round trip time to the server in ms")
+    parser.add_argument("--limit", type=int, default=3600000, help="virtual time limit in ms")
+    parser.add_argument("--line-us", type=float, default=LINE_US,
+                        help="what running each line of firmware costs in us, 0 for nothing")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override one of the firmware's settings, e.g. --set ProfiledMotion=True")
+    args = parser.parse_args(argv)
+    timing = Timing()
+    timing.rtt = args.rtt
+    overrides = {}
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        overrides[name] = ast.literal_eval(value)
+    drops = [tuple(int(value) for value in drop.split(":")) for drop in args.drop]
+    gains = [float(value) for value in args.gains.split(",")] if args.gains else None
+    script = random_game(args.moves, args.seed, program=args.program, report=args.report)
+    if args.trace:
+        # Ask for the trace in setup mode once the game is over
+        overrides.setdefault("TraceMotion", True)
+        script += [("reset",), ("setup", "1:"), ("setup", "4:")]
+    result = run_game(script, args.firmware, timing, args.limit, overrides, args.binary, args.esp, drops, gains,
+                      args.line_us)
+    report(result)
+    if args.trace:
+        save_trace(result, args.trace)
+
+
+if __name__ == "__main__":
+    main()
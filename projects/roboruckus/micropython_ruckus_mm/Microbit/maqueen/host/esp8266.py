@@ -0,0 +1,583 @@
+# Scripted ESP8266 AT command emulator and a stand-in RoboRuckus game server
+# The emulator sits on the far end of the emulated micro:bit UART (see microbit.py),
+# answers the AT commands the Ruckus firmware uses and injects +IPD frames from the server.
+
+import heapq
+import itertools
+import struct
+import time
+
+from microbit import UART_BYTE_US
+
+
+# Module response times in milliseconds
+class Timing:
+    command = 2
+    reset_ok = 5
+    reset_ready = 450
+    join = 2500
+    got_ip = 700
+    # Time a join takes to give up when the access point isn't there
+    join_fail = 5000
+    # Round trip time to the game server
+    rtt = 6
+    # Time the server takes to answer a request
+    think = 3
+
+
+class Link:
+    def __init__(self, remote, keep_alive=False):
+        self.remote = remote
+        self.keep_alive = keep_alive
+        self.request = b""
+        self.last_request = 0
+
+
+# The module's state at power up is one of:
+#   "factory"     station mode not set and no access point saved
+#   "configured"  station mode and the access point saved by an earlier AT+CWJAP_DEF, it joins on its own after booting
+#   "warm"        already joined and serving, as if only the micro:bit was reset
+class ESP8266:
+    def __init__(self, clock, server=None, ip="192.168.3.10", gateway="192.168.3.1", timing=None, state="configured"):
+        self.clock = clock
+        self.server = server
+        self.ip = ip
+        self.gateway = gateway
+        self.timing = timing or Timing()
+        self.events = []
+        self.sequence = itertools.count()
+        self.rx = []
+        self.rx_end = 0
+        self.line = b""
+        self.send_link = None
+        self.send_remaining = 0
+        self.send_data = b""
+        self.busy_until = 0
+        self.commands = {}
+        # Commands that came in while the module was still busy and got "busy p..." back
+        self.busy_commands = 0
+        # Commands are ignored until the module has booted
+        self.booting_until = 0
+        # Bumped whenever something would interrupt joining on its own
+        self.join_token = 0
+        # The access point is missing until this time, see drop_ap
+        self.ap_back_us = 0
+        # Settings stored in the module's flash survive a reset
+        self.mode = 2 if state == "factory" else 1
+        self.saved_ap = state != "factory"
+        self.links = {}
+        # When the access point dropped out, and join commands sent while it was missing
+        self.drops = []
+        self.failed_joins = 0
+        if state == "warm":
+            self.mux = 1
+            self.server_port = 8080
+            self.joined = True
+        else:
+            self.reset()
+            self.boot(0)
+        if server is not None:
+            server.attach(self)
+
+    def reset(self):
+        self.mux = 0
+        self.server_port = None
+        self.joined = False
+        self.links = {}
+        self.join_token += 1
+
+    # Boots the module, which joins the saved access point on its own if it has one
+    def boot(self, now_us):
+        ready = now_us + self.timing.reset_ready * 1000
+        self.booting_until = ready
+        if self.saved_ap and self.mode in (1, 3):
+            self.auto_join(max(ready, self.ap_back_us))
+
+    # Joins the saved access point on its own, starting at start_us
+    def auto_join(self, start_us):
+        token = self.join_token
+        join = start_us + self.timing.join * 1000
+
+        def joined(at_us):
+            if self.join_token == token:
+                self.joined = True
+
+        self.emit_at(join, "WIFI CONNECTED\r\n", token)
+        self.schedule(join + self.timing.got_ip * 1000, joined)
+        self.emit_at(join + self.timing.got_ip * 1000, "WIFI GOT IP\r\n", token)
+
+    # The access point goes away for duration_ms at at_us, taking every connection with it
+    # The module joins again on its own once it's back, unless a join command interrupts it
+    def drop_ap(self, at_us, duration_ms):
+        def drop(at):
+            self.ap_back_us = at + duration_ms * 1000
+            self.drops.append(at)
+            was_joined = self.joined
+            self.joined = False
+            self.join_token += 1
+            for link_id in sorted(self.links):
+                self.emit(at, str(link_id) + ",CLOSED\r\n")
+            self.links = {}
+            self.emit(at, "WIFI DISCONNECT\r\n")
+            if was_joined and self.saved_ap:
+                self.auto_join(self.ap_back_us)
+
+        self.schedule(at_us, drop)
+
+    # Unsolicited output, dropped if the join it belongs to was interrupted
+    def emit_at(self, at_us, text, token):
+        def emit(at):
+            if self.join_token == token:
+                self.emit(at, text)
+
+        self.schedule(at_us, emit)
+
+    # Event queue, processed lazily whenever the firmware touches the UART
+    def schedule(self, at_us, action):
+        heapq.heappush(self.events, (at_us, next(self.sequence), action))
+
+    def _run(self, now_us):
+        while self.events and self.events[0][0] <= now_us:
+            at_us, _, action = heapq.heappop(self.events)
+            action(at_us)
+
+    def emit(self, at_us, text):
+        data = text.encode() if isinstance(text, str) else bytes(text)
+        start = max(at_us, self.rx_end)
+        self.rx.append([start, data, 0])
+        self.rx_end = start + len(data) * UART_BYTE_US
+
+    def respond(self, now_us, delay_ms, text):
+        self.schedule(now_us + int(delay_ms * 1000), lambda at_us: self.emit(at_us, text))
+
+    # UART side
+    def available(self, now_us):
+        self._run(now_us)
+        count = 0
+        for start, data, consumed in self.rx:
+            if start > now_us:
+                break
+            count += min(len(data), (now_us - start) // UART_BYTE_US) - consumed
+        return count
+
+    def read(self, now_us, nbytes=None):
+        self._run(now_us)
+        out = bytearray()
+        while self.rx and (nbytes is None or len(out) < nbytes):
+            segment = self.rx[0]
+            start, data, consumed = segment
+            ready = min(len(data), (now_us - start) // UART_BYTE_US) if now_us >= start else 0
+            if ready <= consumed:
+                break
+            take = ready - consumed
+            if nbytes is not None:
+                take = min(take, nbytes - len(out))
+            out += data[consumed:consumed + take]
+            segment[2] = consumed + take
+            if segment[2] >= len(data):
+                self.rx.pop(0)
+            else:
+                break
+        return bytes(out)
+
+    def write(self, now_us, data):
+        self._run(now_us)
+        for index in range(len(data)):
+            if self.send_remaining:
+                self.send_data += data[index:index + 1]
+                self.send_remaining -= 1
+                if not self.send_remaining:
+                    self._sent(now_us)
+                continue
+            self.line += data[index:index + 1]
+            if self.line.endswith(b"\r\n"):
+                line = self.line[:-2].decode("utf-8", "replace").strip()
+                self.line = b""
+                if line:
+                    self._command(now_us, line)
+
+    # AT commands
+    def _command(self, now_us, line):
+        name = line.split("=")[0].split("?")[0]
+        if now_us < self.booting_until:
+            return
+        self.commands[name] = self.commands.get(name, 0) + 1
+        if now_us < self.busy_until:
+            self.busy_commands += 1
+            self.respond(now_us, 0, "busy p...\r\n")
+            return
+        # Busy until the response is out, commands that take longer say so themselves
+        self.busy_until = now_us + self.timing.command * 1000
+        handler = getattr(self, "_at_" + name[3:].lower(), None) if name.startswith("AT+") else None
+        if name == "AT":
+            self.respond(now_us, self.timing.command, "\r\nOK\r\n")
+        elif handler is None:
+            self.respond(now_us, self.timing.command, "\r\nERROR\r\n")
+        else:
+            args = line[len(name) + 1:] if "=" in line else None
+            handler(now_us, args, line.endswith("?"))
+
+    def _ok(self, now_us, text=""):
+        self.respond(now_us, self.timing.command, text + "\r\nOK\r\n")
+
+    def _error(self, now_us, text=""):
+        self.respond(now_us, self.timing.command, text + "\r\nERROR\r\n")
+
+    def _at_rst(self, now_us, args, query):
+        self.respond(now_us, self.timing.reset_ok, "\r\nOK\r\n")
+        self.busy_until = now_us + self.timing.reset_ready * 1000
+
+        def restart(at_us):
+            self.reset()
+            self.boot(now_us)
+
+        self.schedule(now_us + self.timing.reset_ok * 1000 + 1, restart)
+        self.respond(now_us, self.timing.reset_ready,
+                     "\r\n ets Jan  8 2013,rst cause:2, boot mode:(3,7)\r\n\r\nready\r\n")
+
+    def _at_cipmux(self, now_us, args, query):
+        if query:
+            self._ok(now_us, "+CIPMUX:" + str(self.mux) + "\r\n")
+        elif self.server_port is not None and args == "0":
+            self._error(now_us)
+        else:
+            self.mux = int(args)
+            self._ok(now_us)
+
+    def _at_cipserver(self, now_us, args, query):
+        parts = args.split(",")
+        if parts[0] == "1":
+            if not self.mux:
+                self._error(now_us)
+                return
+            self.server_port = int(parts[1]) if len(parts) > 1 else 333
+        else:
+            self.server_port = None
+        self._ok(now_us)
+
+    def _at_cwmode(self, now_us, args, query):
+        if query:
+            self._ok(now_us, "+CWMODE:" + str(self.mode) + "\r\n")
+        else:
+            self.mode = int(args)
+            self._ok(now_us)
+
+    _at_cwmode_cur = _at_cwmode
+    _at_cwmode_def = _at_cwmode
+
+    def _at_cwdhcp(self, now_us, args, query):
+        self._ok(now_us)
+
+    def _at_cwjap_cur(self, now_us, args, query):
+        if query:
+            self._ok(now_us, ("+CWJAP_CUR:\"RoboRuckus\",\"" + self.gateway + "\"\r\n") if self.joined else "No AP\r\n")
+            return
+        if self.mode not in (1, 3):
+            self._error(now_us)
+            return
+        self.join_token += 1
+        if now_us < self.ap_back_us:
+            # Nothing to join, the attempt times out
+            self.joined = False
+            self.failed_joins += 1
+            self.busy_until = now_us + self.timing.join_fail * 1000
+            self.respond(now_us, self.timing.join_fail, "+CWJAP:3\r\n\r\nFAIL\r\n")
+            return
+        join = self.timing.join
+        self.busy_until = now_us + (join + self.timing.got_ip) * 1000
+
+        def joined(at_us):
+            self.joined = True
+
+        self.joined = False
+        self.respond(now_us, join, "WIFI CONNECTED\r\n")
+        self.schedule(now_us + (join + self.timing.got_ip) * 1000, joined)
+        self.respond(now_us, join + self.timing.got_ip, "WIFI GOT IP\r\n\r\nOK\r\n")
+
+    # Also saves the access point to join after booting
+    def _at_cwjap_def(self, now_us, args, query):
+        if not query:
+            self.saved_ap = True
+        self._at_cwjap_cur(now_us, args, query)
+
+    _at_cwjap = _at_cwjap_def
+
+    def _at_cwqap(self, now_us, args, query):
+        self.joined = False
+        self.join_token += 1
+        self.links = {}
+        self._ok(now_us, "WIFI DISCONNECT\r\n")
+
+    def _at_cipsta(self, now_us, args, query):
+        ip, gateway, mask = (self.ip, self.gateway, "255.255.255.0") if self.joined else ("0.0.0.0",) * 3
+        self._ok(now_us, "+CIPSTA:ip:\"" + ip + "\"\r\n+CIPSTA:gateway:\"" + gateway + "\"\r\n"
+                 + "+CIPSTA:netmask:\"" + mask + "\"\r\n")
+
+    _at_cipsta_cur = _at_cipsta
+
+    def _at_cipstatus(self, now_us, args, query):
+        status = 2 if self.joined else 5
+        text = ""
+        for link_id in sorted(self.links):
+            status = 3
+            if self.links[link_id].remote == "server":
+                text += ("+CIPSTATUS:" + str(link_id) + ",\"TCP\",\"" + self.server.address + "\","
+                         + str(self.server.port) + ",0,0\r\n")
+            else:
+                text += ("+CIPSTATUS:" + str(link_id) + ",\"TCP\",\"" + self.server.address + "\",0,"
+                         + str(self.server_port) + ",1\r\n")
+        self._ok(now_us, "STATUS:" + str(status) + "\r\n" + text)
+
+    def _at_cipstart(self, now_us, args, query):
+        parts = args.split(",")
+        if not self.mux or len(parts) < 4:
+            self._error(now_us)
+            return
+        link_id = int(parts[0])
+        if link_id in self.links:
+            self._error(now_us, "ALREADY CONNECTED\r\n")
+            return
+        if not self.joined or self.server is None or not self.server.accepts(parts[2].strip("\""), int(parts[3])):
+            self.respond(now_us, self.timing.rtt * 3, "\r\nERROR\r\nCLOSED\r\n")
+            return
+        self.links[link_id] = Link("server")
+        delay = self.timing.rtt + self.timing.command
+        self.busy_until = now_us + delay * 1000
+        self.respond(now_us, delay, str(link_id) + ",CONNECT\r\n\r\nOK\r\n")
+
+    def _at_cipsend(self, now_us, args, query):
+        parts = args.split(",")
+        link_id = int(parts[0])
+        if link_id not in self.links:
+            self._error(now_us, "link is not valid\r\n")
+            return
+        self.send_link = link_id
+        self.send_remaining = int(parts[1])
+        self.send_data = b""
+        self._ok(now_us, "")
+        self.respond(now_us, self.timing.command, "> ")
+
+    def _at_cipclose(self, now_us, args, query):
+        link_id = int(args)
+        if link_id in self.links:
+            del self.links[link_id]
+            self._ok(now_us, str(link_id) + ",CLOSED\r\n")
+        else:
+            self._ok(now_us)
+
+    # Data written after AT+CIPSEND
+    def _sent(self, now_us):
+        link_id, data = self.send_link, self.send_data
+        self.send_link = None
+        self.send_data = b""
+        self.respond(now_us, 1, "\r\nRecv " + str(len(data)) + " bytes\r\n")
+        if link_id not in self.links:
+            self.respond(now_us, self.timing.rtt, "\r\nSEND FAIL\r\n")
+            return
+        self.respond(now_us, self.timing.rtt, "\r\nSEND OK\r\n")
+        if self.server is not None:
+            self.server.received(now_us + self.timing.rtt * 500, link_id, data)
+
+    # Network side, called by the server
+    def deliver(self, at_us, link_id, data):
+        def arrive(at):
+            if link_id in self.links:
+                self.emit(at, "\r\n+IPD," + str(link_id) + "," + str(len(data)) + ":")
+                self.emit(at, data)
+
+        self.schedule(at_us, arrive)
+
+    def remote_close(self, at_us, link_id):
+        def close(at):
+            if link_id in self.links:
+                del self.links[link_id]
+                self.emit(at, str(link_id) + ",CLOSED\r\n")
+                if self.server is not None:
+                    self.server.closed(at, link_id)
+
+        self.schedule(at_us, close)
+
+    # The server opens a connection to the robot's port and sends a message
+    def push(self, at_us, data):
+        def connect(at):
+            if not self.joined or self.server_port is None:
+                if self.server is not None:
+                    self.server.push_failed(at)
+                return
+            link_id = 0
+            while link_id in self.links:
+                link_id += 1
+            self.links[link_id] = Link("client")
+            self.emit(at, str(link_id) + ",CONNECT\r\n")
+            self.deliver(at + self.timing.rtt * 500, link_id, data)
+
+        self.schedule(at_us, connect)
+
+
+# Binary message format, see Message in the firmware
+BINARY_ORDER = 0xB1
+BINARY_PROGRAM = 0xB2
+BINARY_INSTRUCTION = 0xB3
+SETTINGS_FORMAT = ">BHffB"
+
+
+# Encodes a text message from the script in the binary format
+def encode_binary(kind, step, text):
+    if kind == "move" or kind == "reset":
+        return bytes([BINARY_ORDER, int(text[0]) * 4 + int(text[2]), int(text[1])])
+    if kind == "program":
+        return bytes([BINARY_PROGRAM, step[1]]) + bytes(value for movement, magnitude, lateral in step[2]
+                                                       for value in (movement * 4 + lateral, magnitude))
+    # Instructions, <instruction>:<player><bot>, 0:<settings ETag>
+    # or <instruction>:<name>,<speed>,<time>,<distance>,<turn>,<color>:
+    instruction, rest = text.split(":", 1)
+    message = bytes([BINARY_INSTRUCTION, int(instruction)])
+    if instruction == "0" and len(rest) == 4:
+        message += struct.pack(">H", int(rest, 16))
+    elif "," in rest:
+        fields = rest.rstrip(":").split(",")
+        message += struct.pack(SETTINGS_FORMAT, int(fields[1]), int(fields[2]), float(fields[3]), float(fields[4]),
+                               int(fields[5])) + fields[0].encode()
+    elif rest:
+        message += bytes(int(digit) for digit in rest)
+    return message
+
+
+# Stand-in RoboRuckus game server, walks through a script of orders
+# Steps are tuples: ("assign", player, bot), ("move", movement, magnitude, lateral),
+# ("program", report, [(movement, magnitude, lateral), ...]), ("reset",) and ("setup", message, settle_ms)
+# With binary set, messages are sent in the binary format to robots that offer it when registering
+class ScriptedServer:
+    def __init__(self, script, address="192.168.3.1", port=8082, gap_ms=250, join_ms=1000, keep_alive_ms=130000,
+                 binary=False):
+        self.script = list(script)
+        self.address = address
+        self.port = port
+        self.gap_ms = gap_ms
+        self.join_ms = join_ms
+        self.binary = binary
+        # Whether the robot registered with a protocol version this server speaks
+        self.use_binary = False
+        self.payload = b""
+        # Idle keep-alive connections are closed after this long, like Kestrel does
+        self.keep_alive_ms = keep_alive_ms
+        self.esp = None
+        self.step = -1
+        self.phase = None
+        # Done reports still expected for the current step
+        self.expect = 0
+        self.phases = []
+        self.requests = []
+        # Everything the robot sent back on the links the server opened
+        self.replies = []
+        self.finished = False
+        self.on_finished = None
+        self.wall_start = time.perf_counter()
+
+    def attach(self, esp):
+        self.esp = esp
+        self._begin("boot", 0)
+
+    def accepts(self, address, port):
+        return address == self.address and port == self.port
+
+    def _begin(self, name, at_us):
+        self.phase = {"name": name, "start_us": at_us, "wall_start": time.perf_counter()}
+
+    def _end(self, at_us):
+        phase = self.phase
+        phase["end_us"] = at_us
+        phase["wall_end"] = time.perf_counter()
+        self.phases.append(phase)
+        self.phase = None
+
+    def _next(self, at_us):
+        self.step += 1
+        if self.step >= len(self.script):
+            self.finished = True
+            if self.on_finished is not None:
+                self.on_finished()
+            return
+        step = self.script[self.step]
+        kind = step[0]
+        if kind == "assign":
+            payload = "0:" + str(step[1]) + str(step[2])
+        elif kind == "move":
+            payload = str(step[1]) + str(step[2]) + str(step[3])
+            self.expect = 1
+        elif kind == "program":
+            payload = "P" + str(step[1]) + "".join(str(a) + str(b) + str(c) for a, b, c in step[2])
+            # An empty program is rejected with a single report
+            self.expect = max(1, len(step[2])) if step[1] == 0 else 1
+        elif kind == "reset":
+            payload = "002"
+        else:
+            payload = step[1]
+        # Players take a moment to join before the first order
+        start = at_us + (self.join_ms if self.step == 0 else self.gap_ms) * 1000
+        self._begin(kind + " " + payload, start)
+        self.payload = encode_binary(kind, step, payload) if self.use_binary else payload.encode()
+        self.esp.push(start, self.payload)
+
+    def push_failed(self, at_us):
+        # Robot isn't listening yet, try again shortly
+        self.esp.push(at_us + 1000000, self.payload)
+
+    # A request from the robot on one of its client links
+    def received(self, at_us, link_id, data):
+        link = self.esp.links.get(link_id)
+        if link is None:
+            return
+        if link.remote == "client":
+            # Robot answering a pushed message, server hangs up once it has the whole reply
+            link.request += data
+            if (link.request[:1] == b"T" and len(link.request) >= 4
+                    and len(link.request) < 4 + struct.unpack_from("<H", link.request, 2)[0] * 10):
+                # Encoder trace still coming
+                return
+            self.replies.append(link.request)
+            link.request = b""
+            self.esp.remote_close(at_us + self.esp.timing.rtt * 500, link_id)
+            return
+        link.request += data
+        while b"\r\n\r\n" in link.request:
+            head, link.request = link.request.split(b"\r\n\r\n", 1)
+            link.request = link.request.lstrip(b"\r\n")
+            self._http(at_us, link_id, link, head.decode())
+
+    def _http(self, at_us, link_id, link, head):
+        lines = head.split("\r\n")
+        path = lines[0].split(" ")[1]
+        close = "Connection: close" in lines
+        self.requests.append((at_us, path))
+        reply_at = at_us + (self.esp.timing.think + self.esp.timing.rtt // 2) * 1000
+        response = ("HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n"
+                    + ("Connection: close\r\n" if close else "") + "\r\nAK")
+        self.esp.deliver(reply_at, link_id, response.encode())
+        if close:
+            self.esp.remote_close(reply_at + 1000, link_id)
+        else:
+            link.last_request = at_us
+            self.esp.schedule(at_us + self.keep_alive_ms * 1000, lambda at: self._idle(at, link_id, link, at_us))
+        if path.startswith("/Bot/Index") and self.step < 0:
+            self.use_binary = self.binary and "&proto=1" in path
+            self._end(at_us)
+            self._next(reply_at)
+        elif path.startswith("/Bot/Done") and self.expect > 0:
+            # A rejected program is reported once whatever it asked for
+            self.expect = 0 if "&rejected=" in path else self.expect - 1
+            if not self.expect:
+                self._end(at_us)
+                self._next(reply_at)
+
+    def _idle(self, at_us, link_id, link, requested_us):
+        if self.esp.links.get(link_id) is link and link.last_request == requested_us:
+            self.esp.remote_close(at_us, link_id)
+
+    def closed(self, at_us, link_id):
+        if link_id != 0 or self.phase is None or self.expect or self.phase["name"] == "boot":
+            return
+        step = self.script[self.step]
+        settle = step[2] if step[0] == "setup" and len(step) > 2 else 0
+        self._end(at_us)
+        self._next(at_us + settle * 1000)
@@ -0,0 +1,416 @@
+# Load test: a fleet of emulated robots against one stand-in game server on a shared Wi-Fi network
+# Usage: python fleet.py [--robots 4,8,12,16] [--moves N] [--latency ms] [--jitter ms] [--loss p] [--frame us]
+#                        [--seed S]
+#
+# The server is an asyncio program running on a virtual clock. Every robot runs the unmodified firmware
+# in its own thread against its own emulated micro:bit and ESP8266, and only one thread runs at a time:
+# a robot runs ahead of the server's clock by at most one network latency, then hands control back
+# until the server's clock catches up. Everything between the robots and the server goes over a
+# simulated access point that carries one frame at a time, with added latency, jitter and loss.
+
+import argparse
+import asyncio
+import ast
+import math
+import random
+import selectors
+import sys
+import threading
+import time
+
+from emulate import FIRMWARE, load_firmware, random_game
+from esp8266 import ESP8266, Timing, encode_binary
+from microbit import LINE_US, MicroBit, VirtualClock, run_lines
+
+
+# Stops a robot's firmware from wherever it is when the load test is over
+# Not an Exception so the firmware's own except clauses can't swallow it
+class FleetStopped(BaseException):
+    pass
+
+
+# Asyncio selector that skips ahead on the virtual clock instead of waiting
+class FastForwardSelector(selectors.SelectSelector):
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events and timeout:
+            self.loop.now_us += max(1, math.ceil(timeout * 1000000))
+        return events
+
+
+# Event loop whose time is the virtual clock shared by the server and the network
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.now_us = 0
+        super().__init__(FastForwardSelector(self))
+
+    def time(self):
+        return self.now_us / 1000000
+
+
+# The shared medium: frames go over the air one at a time, each lost frame is resent after a
+# TCP retransmission timeout that doubles every time
+class Network:
+    def __init__(self, latency_ms=3, jitter_ms=1, loss=0.0, rate_mbps=11, frame_us=300, rto_ms=200, rng=None):
+        self.latency_us = int(latency_ms * 1000)
+        self.jitter_us = int(jitter_ms * 1000)
+        self.loss = loss
+        self.rate_mbps = rate_mbps
+        self.frame_us = frame_us
+        self.rto_us = rto_ms * 1000
+        self.rng = rng or random.Random(1)
+        # When the air is next free, how long it has been busy, frames sent and lost
+        self.free_us = 0
+        self.air_us = 0
+        self.frames = 0
+        self.lost = 0
+
+    # Returns when nbytes sent at at_us arrive
+    def transit(self, at_us, nbytes):
+        rto = self.rto_us
+        while True:
+            start = max(at_us, self.free_us)
+            air = self.frame_us + int(nbytes * 8 / self.rate_mbps)
+            self.free_us = start + air
+            self.air_us += air
+            self.frames += 1
+            if self.rng.random() >= self.loss:
+                return start + air + self.latency_us + int(self.rng.random() * self.jitter_us)
+            self.lost += 1
+            at_us = start + rto
+            rto *= 2
+
+
+# A robot's virtual clock, which hands control back to the fleet when it gets too far ahead
+class FleetClock(VirtualClock):
+    def __init__(self, robot, limit_ms=None, line_us=LINE_US):
+        super().__init__(limit_ms, line_us)
+        self.robot = robot
+        self.horizon_us = 0
+
+    def advance(self, us):
+        super().advance(us)
+        if self.now_us > self.horizon_us:
+            self.robot.sync()
+
+
+# One emulated robot, running the firmware in its own thread
+# Stands in for the ScriptedServer on its ESP8266, passing everything on to the game server over the network
+class FleetRobot:
+    def __init__(self, fleet, index, firmware, overrides, timing):
+        self.fleet = fleet
+        self.index = index
+        self.device = MicroBit(FleetClock(self, fleet.limit_ms, fleet.line_us))
+        self.clock = self.device.clock
+        self.esp = ESP8266(self.clock, self, ip="192.168.3." + str(10 + index), timing=timing, state="configured")
+        self.device.uart.attach(self.esp)
+        self.namespace = load_firmware(self.device, firmware, overrides)
+        self.address = self.namespace["ServerAddress"]
+        self.port = int(self.namespace["ServerPort"])
+        self.bot = None
+        self.use_binary = False
+        self.payload = b""
+        self.error = None
+        self.finished = False
+        self.stopping = False
+        self.baton = threading.Semaphore(0)
+        self.thread = threading.Thread(target=self.main, name="robot " + str(index), daemon=True)
+        # Futures the server is waiting on: registered, acknowledged a message, reported a move done
+        self.registered = None
+        self.acked = None
+        self.done = None
+
+    def start(self):
+        self.thread.start()
+        self.resume()
+
+    def main(self):
+        # Tracing is per thread
+        run_lines()
+        self.baton.acquire()
+        try:
+            if self.stopping:
+                raise FleetStopped()
+            self.bot = self.namespace["MaqueenPlus"]()
+            self.bot.forever()
+        except FleetStopped:
+            pass
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.finished = True
+            self.fleet.baton.release()
+
+    # Runs the robot until it's next more than one latency ahead of the server, called on the loop
+    def resume(self):
+        if self.finished:
+            return
+        self.clock.horizon_us = self.fleet.loop.now_us + self.fleet.quantum_us
+        self.baton.release()
+        self.fleet.baton.acquire()
+
+    # Called on the robot's thread, waits for the server to catch up
+    def sync(self):
+        fleet = self.fleet
+        fleet.loop.call_at(self.clock.now_us / 1000000, self.resume)
+        fleet.baton.release()
+        self.baton.acquire()
+        if self.stopping:
+            raise FleetStopped()
+
+    # ESP8266 side, called on the robot's thread
+    def attach(self, esp):
+        pass
+
+    def accepts(self, address, port):
+        return address == self.address and port == self.port
+
+    def received(self, at_us, link_id, data):
+        arrive = self.fleet.network.transit(at_us, len(data))
+        self.fleet.loop.call_at(arrive / 1000000, self.fleet.server.received, self, link_id, data)
+
+    def closed(self, at_us, link_id):
+        if link_id == 0:
+            self.fleet.loop.call_at(at_us / 1000000, self.fleet.server.closed, self)
+
+    def push_failed(self, at_us):
+        # Robot isn't listening yet, try again shortly
+        self.fleet.loop.call_at((at_us + 1000000) / 1000000, self.fleet.server.push, self, None)
+
+
+# Stand-in for the game server's /Bot/Index and /Bot/Done endpoints and the orders it pushes to robots
+# Each round every robot gets one move at the same time, the round is over once they all report done
+class GameServer:
+    def __init__(self, fleet, moves, seed=1, binary=False, gap_ms=250, think_ms=3):
+        self.fleet = fleet
+        self.moves = moves
+        self.seed = seed
+        self.binary = binary
+        self.gap_ms = gap_ms
+        self.think_us = think_ms * 1000
+        # (phase, round, robot index, ms to complete) for everything that completed
+        self.results = []
+        self.rounds = []
+
+    def now_us(self):
+        return self.fleet.loop.now_us
+
+    # Sends a message to a robot's port 8080, payload None resends the last one
+    def push(self, robot, payload):
+        if payload is not None:
+            robot.payload = payload
+        at = self.fleet.network.transit(self.now_us(), len(robot.payload) + 40)
+        robot.esp.push(at, robot.payload)
+
+    def received(self, robot, link_id, data):
+        link = robot.esp.links.get(link_id)
+        if link is None:
+            return
+        if link.remote == "client":
+            # Robot answering a pushed message, server hangs up
+            robot.esp.remote_close(self.fleet.network.transit(self.now_us(), 40), link_id)
+            return
+        link.request += data
+        while b"\r\n\r\n" in link.request:
+            head, link.request = link.request.split(b"\r\n\r\n", 1)
+            link.request = link.request.lstrip(b"\r\n")
+            self.request(robot, link_id, head.decode())
+
+    def request(self, robot, link_id, head):
+        lines = head.split("\r\n")
+        path = lines[0].split(" ")[1]
+        close = "Connection: close" in lines
+        response = ("HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n" +
+                    ("Connection: close\r\n" if close else "") + "\r\nAK").encode()
+        reply = self.fleet.network.transit(self.now_us() + self.think_us, len(response))
+        robot.esp.deliver(reply, link_id, response)
+        if close:
+            robot.esp.remote_close(reply + 1000, link_id)
+        if path.startswith("/Bot/Index"):
+            robot.use_binary = self.binary and "&proto=1" in path
+            self.resolve(robot.registered)
+        elif path.startswith("/Bot/Done"):
+            self.resolve(robot.done)
+
+    def closed(self, robot):
+        self.resolve(robot.acked)
+
+    @staticmethod
+    def resolve(future):
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def encode(self, robot, kind, step, text):
+        return encode_binary(kind, step, text) if robot.use_binary else text.encode()
+
+    # Waits for one future per robot, records how long each took from start_us
+    async def collect(self, phase, number, futures, start_us, timeout_ms):
+        done_us = [None] * len(futures)
+
+        async def one(index, future):
+            await future
+            done_us[index] = self.now_us()
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*[one(i, f) for i, f in enumerate(futures)]), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+        for index, at in enumerate(done_us):
+            if at is not None:
+                self.results.append((phase, number, index, (at - start_us) / 1000))
+        if all(at is not None for at in done_us):
+            self.rounds.append((phase, number, (max(done_us) - start_us) / 1000))
+            return True
+        return False
+
+    async def play(self, timeout_ms=120000):
+        loop = self.fleet.loop
+        robots = self.fleet.robots
+        for robot in robots:
+            robot.registered = loop.create_future()
+            robot.start()
+        if not await self.collect("register", 0, [robot.registered for robot in robots], 0, timeout_ms):
+            return
+        # Player numbers are one digit in text messages, the bot number is only used in reports
+        start = self.now_us()
+        futures = []
+        for robot in robots:
+            robot.acked = loop.create_future()
+            futures.append(robot.acked)
+            step = ("assign", 1 + robot.index % 8, robot.index % 10)
+            self.push(robot, self.encode(robot, "assign", step, "0:" + str(step[1]) + str(step[2])))
+        if not await self.collect("assign", 0, futures, start, timeout_ms):
+            return
+        scripts = [random_game(self.moves, self.seed + robot.index)[1:] for robot in robots]
+        self.game_start_us = self.now_us()
+        for number in range(self.moves):
+            await asyncio.sleep(self.gap_ms / 1000)
+            start = self.now_us()
+            futures = []
+            for robot in robots:
+                robot.done = loop.create_future()
+                futures.append(robot.done)
+                step = scripts[robot.index][number]
+                self.push(robot, self.encode(robot, "move", step, str(step[1]) + str(step[2]) + str(step[3])))
+            if not await self.collect("move", number, futures, start, timeout_ms):
+                return
+        self.game_end_us = self.now_us()
+
+
+class Fleet:
+    def __init__(self, count, moves, latency_ms=3, jitter_ms=1, loss=0.0, seed=1, binary=False,
+                 firmware=FIRMWARE, overrides=None, limit_ms=3600000, frame_us=300, line_us=LINE_US):
+        self.limit_ms = limit_ms
+        self.line_us = line_us
+        self.loop = VirtualTimeLoop()
+        self.network = Network(latency_ms, jitter_ms, loss, frame_us=frame_us, rng=random.Random(seed))
+        # Robots never get further ahead of the server than a message takes to reach them
+        self.quantum_us = max(100, int(latency_ms * 1000))
+        self.baton = threading.Semaphore(0)
+        self.server = GameServer(self, moves, seed, binary)
+        timing = Timing()
+        timing.rtt = 2 * latency_ms
+        self.robots = [FleetRobot(self, index, firmware, overrides, timing) for index in range(count)]
+
+    def run(self):
+        wall_start = time.perf_counter()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.server.play())
+        finally:
+            self.stop()
+            asyncio.set_event_loop(None)
+            self.loop.close()
+        self.wall_ms = (time.perf_counter() - wall_start) * 1000
+        return self
+
+    # Lets every robot thread run once more to stop
+    def stop(self):
+        for robot in self.robots:
+            if robot.thread.is_alive() and not robot.finished:
+                robot.stopping = True
+                robot.baton.release()
+                self.baton.acquire()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def summary(fleet):
+    server = fleet.server
+    row = {"robots": len(fleet.robots)}
+    for phase in ("register", "assign", "move"):
+        times = [ms for name, _, _, ms in server.results if name == phase]
+        row[phase] = [percentile(times, p) for p in (0.5, 0.9, 0.99)] + [max(times) if times else 0]
+    rounds = [ms for name, _, ms in server.rounds if name == "move"]
+    row["round"] = [percentile(rounds, 0.5), percentile(rounds, 0.9), max(rounds) if rounds else 0]
+    moves = sum(1 for name, _, _, _ in server.results if name == "move")
+    row["complete"] = len(rounds) == server.moves
+    game_ms = (getattr(server, "game_end_us", fleet.loop.now_us) - getattr(server, "game_start_us", 0)) / 1000
+    row["throughput"] = moves / (game_ms / 1000) if game_ms > 0 else 0
+    row["air"] = fleet.network.air_us / fleet.loop.now_us if fleet.loop.now_us else 0
+    row["lost"] = fleet.network.lost
+    row["errors"] = [robot.index for robot in fleet.robots if robot.error is not None]
+    row["wall_ms"] = fleet.wall_ms
+    return row
+
+
+def report(rows, out=sys.stdout):
+    out.write("%6s  %-23s  %-23s  %-31s  %-23s  %8s  %5s  %5s\n" % (
+        "robots", "register p50/p90/max", "assign p50/p90/max", "move done p50/p90/p99/max", "round p50/p90/max",
+        "moves/s", "air", "lost"))
+    for row in rows:
+        register, assign, move, rounds = row["register"], row["assign"], row["move"], row["round"]
+        out.write("%6d  %-23s  %-23s  %-31s  %-23s  %8.2f  %4.1f%%  %5d%s\n" % (
+            row["robots"],
+            "%.0f/%.0f/%.0f" % (register[0], register[1], register[3]),
+            "%.0f/%.0f/%.0f" % (assign[0], assign[1], assign[3]),
+            "%.0f/%.0f/%.0f/%.0f" % tuple(move),
+            "%.0f/%.0f/%.0f" % tuple(rounds),
+            row["throughput"], row["air"] * 100, row["lost"],
+            "" if row["complete"] else "  (incomplete)"))
+        for index in row["errors"]:
+            out.write("        robot %d stopped with an error\n" % index)
+    out.write("times in ms of robot time, rounds are every robot moving once\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Ruckus firmware with a fleet of emulated robots")
+    parser.add_argument("--robots", default="4,8,12,16", help="comma separated fleet sizes to run")
+    parser.add_argument("--moves", type=int, default=10, help="rounds of moves in each game")
+    parser.add_argument("--latency", type=float, default=3, help="one way network latency in ms")
+    parser.add_argument("--jitter", type=float, default=1, help="random extra latency of up to this many ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="chance of losing each frame")
+    parser.add_argument("--frame", type=int, default=300, help="air time of each frame besides its data in us")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the moves and the network")
+    parser.add_argument("--binary", action="store_true",
+                        help="send messages in the binary format if the firmware offers it")
+    parser.add_argument("--firmware", default=FIRMWARE, help="firmware file to run")
+    parser.add_argument("--line-us", type=float, default=LINE_US,
+                        help="what running each line of firmware costs in us, 0 for nothing")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override one of the firmware's settings, e.g. --set PersistentLink=False")
+    args = parser.parse_args(argv)
+    overrides = {}
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        overrides[name] = ast.literal_eval(value)
+    rows = []
+    for count in [int(value) for value in args.robots.split(",")]:
+        fleet = Fleet(count, args.moves, args.latency, args.jitter, args.loss, args.seed, args.binary,
+                      args.firmware, overrides, frame_us=args.frame, line_us=args.line_us).run()
+        rows.append(summary(fleet))
+        sys.stderr.write("%d robots emulated in %.1f s\n" % (count, fleet.wall_ms / 1000))
+    report(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+# Host-side stand-in for the micro:bit MicroPython "microbit" module
+# Lets the Ruckus firmware run unmodified under CPython against a virtual clock,
+# an emulated ESP8266 on the UART (see esp8266.py) and a simulated Maqueen Plus on I2C.
+
+import io
+import math
+import sys
+import time
+import types
+
+# 115200 baud, 8N1
+UART_BYTE_US = 87
+# 100 kHz I2C, 9 clocks per byte
+I2C_BYTE_US = 90
+I2C_OVERHEAD_US = 60
+# Small costs charged for calls that don't sleep so busy loops still advance the clock
+UART_READ_US = 100
+RUNNING_TIME_US = 2
+DISPLAY_US = 50
+# Rough cost of running one line of firmware in MicroPython on the micro:bit V2's 64 MHz nRF52833, charged
+# by run_lines. 0 runs the firmware for free, so only the time spent waiting on the hardware counts.
+LINE_US = 10
+# What gc.mem_free() says. There's no heap model, so the heap numbers the firmware reports are placeholders.
+HEAP_FREE = 60000
+
+
+class EmulationTimeout(Exception):
+    pass
+
+
+# Virtual clock in microseconds, everything attached to it is advanced in lock step
+# With run_lines every line of firmware run costs line_us, which is added up in pending_us and
+# charged the next time the clock is advanced or read with ticks
+class VirtualClock:
+    def __init__(self, limit_ms=None, line_us=0):
+        self.now_us = 0
+        self.limit_us = None if limit_ms is None else limit_ms * 1000
+        self.listeners = []
+        self.line_us = line_us
+        self.pending_us = 0
+        self.lines = 0
+
+    def ms(self):
+        return self.now_us // 1000
+
+    def advance(self, us):
+        # Whole microseconds only, a fraction of line_us stays pending
+        charged = int(self.pending_us)
+        us = int(us) + charged
+        self.pending_us -= charged
+        if us <= 0:
+            return
+        target = self.now_us + us
+        if self.limit_us is not None and target > self.limit_us:
+            raise EmulationTimeout("virtual time limit of " + str(self.limit_us // 1000) + " ms reached")
+        for listener in self.listeners:
+            listener(self.now_us, target)
+        self.now_us = target
+
+    # Charges what has run since the clock last moved, returns the time
+    def now(self):
+        self.advance(0)
+        return self.now_us
+
+    # Local trace function of firmware frames
+    def line_tracer(self, frame, event, arg):
+        if event == "line":
+            self.pending_us += self.line_us
+            self.lines += 1
+        return self.line_tracer
+
+
+# Global trace function, firmware frames are the ones with the clock load_firmware leaves in their globals
+def _charge_lines(frame, event, arg):
+    clock = frame.f_globals.get("__clock__")
+    if clock is None or not clock.line_us:
+        return None
+    return clock.line_tracer
+
+
+# Starts charging the firmware run on this thread for every line, see LINE_US
+def run_lines():
+    sys.settrace(_charge_lines)
+
+
+def stop_lines():
+    sys.settrace(None)
+
+
+# Simple named constants (Image.HAPPY, Sound.SAD, ...)
+class _Named:
+    def __init__(self, kind):
+        self._kind = kind
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._kind + "." + name
+
+
+# Approximate length of the built-in V2 sounds in milliseconds
+SOUND_MS = {"Sound.GIGGLE": 1100, "Sound.HAPPY": 800, "Sound.HELLO": 700, "Sound.MYSTERIOUS": 1400,
+            "Sound.SAD": 1000, "Sound.SLIDE": 800, "Sound.SOARING": 1500, "Sound.SPRING": 600,
+            "Sound.TWINKLE": 1600, "Sound.YAWN": 1800}
+
+
+class Pin:
+    def __init__(self, number):
+        self.number = number
+
+
+class Display:
+    def __init__(self, clock):
+        self.clock = clock
+        self.shown = None
+        self.history = []
+
+    def show(self, image, delay=400, wait=True, loop=False, clear=False):
+        self.clock.advance(DISPLAY_US)
+        self.shown = image
+        self.history.append((self.clock.ms(), image))
+
+    def scroll(self, text, delay=150, wait=True, loop=False, monospace=False):
+        self.show(text)
+        if wait:
+            self.clock.advance(len(str(text)) * 5 * delay * 1000)
+
+    def clear(self):
+        self.shown = None
+
+
+class Audio:
+    def __init__(self, clock):
+        self.clock = clock
+        self.played = []
+        self.until_us = 0
+
+    def play(self, source, wait=True, pin=None, return_pin=None):
+        self.played.append((self.clock.ms(), source))
+        self.until_us = self.clock.now_us + SOUND_MS.get(source, 1000) * 1000
+        if wait:
+            self.clock.advance(self.until_us - self.clock.now_us)
+
+    def is_playing(self):
+        return self.clock.now_us < self.until_us
+
+    def stop(self):
+        self.until_us = 0
+
+
+class Button:
+    def __init__(self, clock):
+        self.clock = clock
+        self.presses = []
+        self.count = 0
+
+    # Schedule a press at a virtual time in milliseconds
+    def press_at(self, ms):
+        self.presses.append(ms)
+        self.presses.sort()
+
+    def _collect(self):
+        now = self.clock.ms()
+        while self.presses and self.presses[0] <= now:
+            self.presses.pop(0)
+            self.count += 1
+
+    def was_pressed(self):
+        self._collect()
+        pressed = self.count > 0
+        self.count = 0
+        return pressed
+
+    def get_presses(self):
+        self._collect()
+        count = self.count
+        self.count = 0
+        return count
+
+    def is_pressed(self):
+        return False
+
+
+# UART wired to an ESP8266 emulator (or nothing)
+class UART:
+    ODD = 1
+    EVEN = 0
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.device = None
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def init(self, baudrate=9600, bits=8, parity=None, stop=1, tx=None, rx=None):
+        self.baudrate = baudrate
+
+    def attach(self, device):
+        self.device = device
+
+    def any(self):
+        self.clock.advance(UART_READ_US)
+        if self.device is None:
+            return 0
+        return self.device.available(self.clock.now_us)
+
+    def read(self, nbytes=None):
+        self.clock.advance(UART_READ_US)
+        if self.device is None:
+            return None
+        data = self.device.read(self.clock.now_us, nbytes)
+        if not data:
+            return None
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        if nbytes is None:
+            nbytes = len(buf)
+        data = self.read(nbytes)
+        if data is None:
+            return None
+        buf[0:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        return self.read()
+
+    def write(self, buf):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        data = bytes(buf)
+        # Writes block until the bytes are on the wire
+        self.clock.advance(len(data) * UART_BYTE_US)
+        self.bytes_written += len(data)
+        if self.device is not None:
+            self.device.write(self.clock.now_us, data)
+        return len(data)
+
+
+# I2C bus, peripherals are objects with read(n) and write(data)
+class I2C:
+    def __init__(self, clock):
+        self.clock = clock
+        self.devices = {}
+        self.transactions = 0
+        self.bytes = 0
+
+    def init(self, freq=100000, sda=None, scl=None):
+        pass
+
+    def attach(self, addr, device):
+        self.devices[addr] = device
+
+    def scan(self):
+        self.clock.advance(I2C_OVERHEAD_US * 112)
+        return sorted(self.devices)
+
+    def _device(self, addr, nbytes):
+        self.transactions += 1
+        self.bytes += nbytes
+        self.clock.advance(I2C_OVERHEAD_US + (nbytes + 1) * I2C_BYTE_US)
+        device = self.devices.get(addr)
+        # Nothing answers until the device has booted
+        if device is None or self.clock.now_us < getattr(device, "ready_us", 0):
+            raise OSError(19)
+        return device
+
+    def read(self, addr, n, repeat=False):
+        return bytes(self._device(addr, n).read(n))
+
+    def write(self, addr, buf, repeat=False):
+        self._device(addr, len(buf)).write(bytes(buf))
+
+
+# Simulated Maqueen Plus motor board
+class MaqueenBoard:
+    TICKS_PER_ROTATION = 90
+    WHEEL_DIAMETER = 44
+    # Chosen so TurnDistance = 0.32 is a 90 degree turn
+    TRACK = 56.3
+    # Encoder ticks per second for each unit of reported speed
+    TICKS_PER_SPEED = 0.75
+    DEADBAND = 5
+    # Line sensors L3 to R3, mm to the left of the middle, and how far ahead of the wheels they are
+    LINE_SENSORS = (36, 22, 8, -8, -22, -36)
+    SENSOR_AHEAD = 55
+    # Game board lines are GRID mm apart and LINE_WIDTH mm wide, the robot starts in the middle of a
+    # square with its line sensors over the line in front
+    GRID = 110
+    LINE_WIDTH = 10
+
+    def __init__(self, clock, gains=None, tau_ms=60, version=1, boot_ms=300, pid_tau_ms=90):
+        self.clock = clock
+        self.version = version
+        # The board's microcontroller takes a moment to start after power up
+        self.ready_us = boot_ms * 1000
+        self.regs = bytearray(256)
+        self.pointer = 0
+        self.pid = False
+        self.tau_us = tau_ms * 1000
+        # With its PID controller on, the board holds each wheel at the speed it's set to, as fast
+        # as the motor allows, settling a little slower than the motor on its own
+        self.pid_tau_us = pid_tau_ms * 1000
+        # Reported speed per unit of PWM above the deadband, per wheel and direction
+        self.gains = gains or {("L", 1): 2.86, ("L", 2): 2.79, ("R", 1): 2.93, ("R", 2): 2.83}
+        self.command = {"L": (0, 0), "R": (0, 0)}
+        # Direction each wheel last drove in, for coasting after the motor is cut
+        self.rolling = {"L": 1, "R": 1}
+        self.speed = {"L": 0.0, "R": 0.0}
+        self.ticks = {"L": 0.0, "R": 0.0}
+        # Ground truth pose in millimeters and radians
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        clock.listeners.append(self._integrate)
+
+    def target_speed(self, wheel):
+        direction, pwm = self.command[wheel]
+        if direction == 0 or pwm == 0:
+            return 0.0
+        top = self.gains[(wheel, direction)] * (255 - self.DEADBAND)
+        if self.pid:
+            return min(float(pwm), top)
+        if pwm <= self.DEADBAND:
+            return 0.0
+        return self.gains[(wheel, direction)] * (pwm - self.DEADBAND)
+
+    def _integrate(self, start_us, end_us):
+        if not (self.speed["L"] or self.speed["R"] or self.command["L"][0] or self.command["R"][0]):
+            return
+        t = start_us
+        while t < end_us:
+            step = min(1000, end_us - t)
+            travel = {}
+            for wheel in ("L", "R"):
+                target = self.target_speed(wheel)
+                tau = self.pid_tau_us if self.pid and target else self.tau_us
+                self.speed[wheel] += (target - self.speed[wheel]) * min(1.0, step / tau)
+                if target == 0 and self.speed[wheel] < 0.5:
+                    self.speed[wheel] = 0.0
+                ticks = self.speed[wheel] * self.TICKS_PER_SPEED * step / 1000000
+                self.ticks[wheel] += ticks
+                if self.command[wheel][0]:
+                    self.rolling[wheel] = self.command[wheel][0]
+                sign = -1 if self.rolling[wheel] == 2 else 1
+                travel[wheel] = sign * ticks / self.TICKS_PER_ROTATION * math.pi * self.WHEEL_DIAMETER
+            forward = (travel["L"] + travel["R"]) / 2
+            self.heading += (travel["R"] - travel["L"]) / self.TRACK
+            self.x += forward * math.cos(self.heading)
+            self.y += forward * math.sin(self.heading)
+            t += step
+
+    def _live(self):
+        for wheel, offset in (("L", 0), ("R", 2)):
+            self.regs[offset] = self.command[wheel][0]
+            self.regs[offset + 1] = min(255, int(round(self.speed[wheel])))
+        left = int(self.ticks["L"]) & 0xFFFF
+        right = int(self.ticks["R"]) & 0xFFFF
+        self.regs[4:8] = bytes([left >> 8, left & 0xFF, right >> 8, right & 0xFF])
+        self.regs[0x0A] = 1 if self.pid else 0
+        self.regs[0x1D] = self.line_bits()
+        self.regs[0x32] = self.version
+
+    # Bits of the line sensors over a line, L3 is bit 0
+    def line_bits(self):
+        bits = 0
+        cos = math.cos(self.heading)
+        sin = math.sin(self.heading)
+        for index, side in enumerate(self.LINE_SENSORS):
+            for along in (self.x + self.SENSOR_AHEAD * cos - side * sin, self.y + self.SENSOR_AHEAD * sin + side * cos):
+                # Lines run between squares, half a square from the middle of each
+                offset = (along - self.GRID / 2) % self.GRID
+                if min(offset, self.GRID - offset) <= self.LINE_WIDTH / 2:
+                    bits |= 1 << index
+        return bits
+
+    # How far the middle of the robot is from the middle of the nearest square, in mm
+    def grid_error(self):
+        return math.hypot(self.x - round(self.x / self.GRID) * self.GRID,
+                          self.y - round(self.y / self.GRID) * self.GRID)
+
+    def read(self, n):
+        self._live()
+        data = self.regs[self.pointer:self.pointer + n]
+        self.pointer = (self.pointer + n) & 0xFF
+        return data
+
+    def write(self, data):
+        if not data:
+            return
+        self.pointer = data[0]
+        payload = data[1:]
+        if not payload:
+            return
+        reg = data[0]
+        for offset, value in enumerate(payload):
+            address = reg + offset
+            if address in (0x00, 0x02):
+                wheel = "L" if address == 0x00 else "R"
+                pwm = payload[offset + 1] if offset + 1 < len(payload) else self.command[wheel][1]
+                self.command[wheel] = (value, pwm)
+            elif 0x04 <= address <= 0x07:
+                # Any write to a wheel's encoder registers clears its count
+                self.ticks["L" if address < 0x06 else "R"] = 0.0
+            elif address == 0x0A:
+                self.pid = value == 1
+            self.regs[address & 0xFF] = value
+
+
+# micro:bit flash file system, only the calls the micro:bit "os" module has
+class FlashFS:
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+        self.writes = 0
+
+    def module(self):
+        mod = types.ModuleType("os")
+        mod.listdir = lambda: sorted(self.files)
+        mod.remove = self.remove
+        mod.size = self.size
+        mod.uname = lambda: ("microbit", "microbit", "2.1.1", "emulated", "micro:bit")
+        return mod
+
+    def remove(self, name):
+        if name not in self.files:
+            raise OSError(2)
+        del self.files[name]
+
+    def size(self, name):
+        if name not in self.files:
+            raise OSError(2)
+        return len(self.files[name])
+
+    def open(self, name, mode="r"):
+        binary = "b" in mode
+        if "w" in mode:
+            fs = self
+            self.writes += 1
+
+            class Writer(io.BytesIO if binary else io.StringIO):
+                def close(inner):
+                    value = inner.getvalue()
+                    fs.files[name] = value if binary else value.encode()
+                    super().close()
+
+            return Writer()
+        if name not in self.files:
+            raise OSError(2)
+        data = self.files[name]
+        return io.BytesIO(data) if binary else io.StringIO(data.decode())
+
+
+# One emulated robot: clock, UART, I2C and the peripherals the firmware imports
+class MicroBit:
+    def __init__(self, clock=None, files=None):
+        self.clock = clock or VirtualClock()
+        self.uart = UART(self.clock)
+        self.i2c = I2C(self.clock)
+        self.display = Display(self.clock)
+        self.audio = Audio(self.clock)
+        self.button_a = Button(self.clock)
+        self.button_b = Button(self.clock)
+        self.fs = FlashFS(files)
+        self.board = MaqueenBoard(self.clock)
+        self.i2c.attach(0x10, self.board)
+        self.wall_start = time.perf_counter()
+
+    def sleep(self, ms):
+        self.clock.advance(int(ms * 1000))
+
+    def running_time(self):
+        self.clock.advance(RUNNING_TIME_US)
+        return self.clock.ms()
+
+    def module(self):
+        mod = types.ModuleType("microbit")
+        mod.sleep = self.sleep
+        mod.running_time = self.running_time
+        mod.uart = self.uart
+        mod.i2c = self.i2c
+        mod.display = self.display
+        mod.audio = self.audio
+        mod.button_a = self.button_a
+        mod.button_b = self.button_b
+        mod.Image = _Named("Image")
+        mod.Sound = _Named("Sound")
+        for number in range(21):
+            setattr(mod, "pin" + str(number), Pin(number))
+        return mod
+
+    def gc_module(self):
+        mod = types.ModuleType("gc")
+        mod.collect = lambda: None
+        mod.enable = lambda: None
+        mod.disable = lambda: None
+        mod.mem_free = lambda: HEAP_FREE
+        mod.mem_alloc = lambda: 4000
+        return mod
+
+    def utime_module(self):
+        mod = types.ModuleType("utime")
+        mod.sleep_ms = self.sleep
+        mod.ticks_ms = lambda: self.clock.now() // 1000
+        mod.ticks_us = lambda: self.clock.now()
+        mod.ticks_diff = lambda end, start: end - start
+        mod.ticks_add = lambda ticks, delta: ticks + delta
+        return mod
+
+    def modules(self):
+        micropython = types.ModuleType("micropython")
+        micropython.const = lambda value: value
+        return {"microbit": self.module(), "os": self.fs.module(), "gc": self.gc_module(),
+                "micropython": micropython, "utime": self.utime_module()}
+
+
+# Importing this file directly gives a single default device, like the real module
+_default = MicroBit()
+globals().update({name: value for name, value in vars(_default.module()).items() if not name.startswith("__")})
@@ -0,0 +1,148 @@
+# Startup benchmark: how long a robot takes from reset to registering with /Bot/Index, and how much heap it
+# has left once started, for the single file and the builds made by build.py
+# Usage: python startup.py --listen [--port P] [--label NAME] [--log FILE]
+#        python startup.py [--set NAME=VALUE] FIRMWARE...
+#
+# With --listen this stands in for the game server: point a robot's ServerAddress at this computer, flash a
+# build, and press reset a few times. Each registration is printed as it comes in and, with --log, added to a
+# CSV file, and on Ctrl-C the runs in the log are summed up by label, so running once with --label source and
+# once with --label mpy compares the two builds.
+# Otherwise each firmware file or build folder is started in the emulator. The emulator doesn't take time to
+# compile anything and has no real heap, so this only checks that a build starts and registers, and prints no
+# times or heap: those only come from real robots.
+
+import argparse
+import ast
+import csv
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from emulate import FIRMWARE, make_robot
+from microbit import EmulationTimeout, run_lines, stop_lines
+
+FIELDS = ("label", "name", "ip", "check", "configure", "join", "board", "index", "free")
+
+
+# The fields of one registration from the path of its /Bot/Index request, or None if it isn't one
+def registration(path, label):
+    url = urlparse(path)
+    if url.path != "/Bot/Index":
+        return None
+    query = parse_qs(url.query)
+    boot = (query.get("boot", [""])[0].split(",") + [""] * 5)[:5]
+    return {"label": label, "name": query.get("name", [""])[0], "ip": query.get("ip", [""])[0],
+            "check": boot[0], "configure": boot[1], "join": boot[2], "board": boot[3], "index": boot[4],
+            "free": query.get("free", [""])[0]}
+
+
+def write_run(run, out=sys.stdout):
+    out.write(("%-10s %-16s reset to /Bot/Index %6s ms, free heap %6s bytes "
+               "(module checked %s ms, configured %s ms, joined %s ms, board up at %s ms)\n") % (
+        run["label"], run["name"], run["index"], run["free"], run["check"], run["configure"], run["join"],
+        run["board"]))
+
+
+# Mean, least and most time to register and free heap of the runs with each label
+def summary(runs, out=sys.stdout):
+    out.write("%-10s %5s %10s %10s %10s %10s %10s %10s\n" % (
+        "label", "runs", "index ms", "min", "max", "free", "min", "max"))
+    labels = []
+    for run in runs:
+        if run["label"] not in labels:
+            labels.append(run["label"])
+    for label in labels:
+        index = [int(run["index"]) for run in runs if run["label"] == label and run["index"]]
+        free = [int(run["free"]) for run in runs if run["label"] == label and run["free"]]
+        if not index:
+            continue
+        out.write("%-10s %5d %10.0f %10d %10d %10s %10s %10s\n" % (
+            label, len(index), sum(index) / len(index), min(index), max(index),
+            "%.0f" % (sum(free) / len(free)) if free else "-", min(free) if free else "-", max(free) if free else "-"))
+
+
+def listen(port, label, log):
+    runs = []
+    if log and os.path.exists(log):
+        with open(log, newline="") as log_file:
+            runs.extend(csv.DictReader(log_file))
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            run = registration(self.path, label)
+            if run is not None:
+                runs.append(run)
+                write_run(run)
+                if log:
+                    new = not os.path.exists(log)
+                    with open(log, "a", newline="") as log_file:
+                        writer = csv.DictWriter(log_file, FIELDS)
+                        if new:
+                            writer.writeheader()
+                        writer.writerow(run)
+            # The robot waits for AK
+            body = b"AK"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(("", port), Handler)
+    sys.stdout.write("waiting for robots on port %d, reset one to time its startup, Ctrl-C to stop\n" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    summary(runs)
+
+
+def emulate(firmwares, overrides):
+    for firmware in firmwares:
+        # Just the assignment, the game doesn't matter
+        device, esp, server, namespace = make_robot([("assign", 1, 0)], firmware, limit_ms=60000, overrides=overrides)
+        run_lines()
+        try:
+            namespace["MaqueenPlus"]()
+        except EmulationTimeout as error:
+            sys.stdout.write("Stopped: " + str(error) + "\n")
+        finally:
+            stop_lines()
+        # Build folders go by their name, source or mpy
+        label = os.path.basename(os.path.normpath(firmware)) if os.path.isdir(firmware) else "single"
+        runs = (registration(path, label) for at_us, path in server.requests)
+        name = next((run["name"] for run in runs if run), None)
+        if name is None:
+            sys.stdout.write("%-10s never registered\n" % label)
+        else:
+            sys.stdout.write("%-10s registered as %s\n" % (label, name))
+    sys.stdout.write("emulated: startup times and free heap only come from real robots, see --listen\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time how long robots take to start and register")
+    parser.add_argument("firmware", nargs="*", help="firmware files or build folders to start in the emulator")
+    parser.add_argument("--listen", action="store_true", help="wait for real robots to register instead")
+    parser.add_argument("--port", type=int, default=8082, help="port to listen on, the robot's ServerPort")
+    parser.add_argument("--label", default="single",
+                        help="what the robots registering are running: single, source or mpy")
+    parser.add_argument("--log", metavar="FILE", help="CSV file to keep the registrations in across runs")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override one of the firmware's settings in the emulator")
+    args = parser.parse_args(argv)
+    if args.listen:
+        listen(args.port, args.label, args.log)
+        return
+    overrides = {}
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        overrides[name] = ast.literal_eval(value)
+    emulate(args.firmware or [FIRMWARE], overrides)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,54 @@
 from microbit import pin1, pin2, i2c, display, Image, sleep, uart, running_time, audio, Sound, button_a
 import struct
 import os
-from math import pi as PI
+import gc
+from math import pi as PI, sqrt, sin, cos
+from utime import ticks_us, ticks_diff
+from array import array
 
 # Change server info here
 ServerAddress = "192.168.3.1"
 ServerPort = "8082"
+# Keep the connection to the server open between moves instead of reconnecting for every report
+PersistentLink = True
+# Most moves a program message can queue up
+MoveQueueSize = 8
+# Run reading orders, driving, reporting and the button as cooperative tasks so a report can go
+# out while the next move is driven, set False for the original loop that does one thing at a time
+CooperativeTasks = True
+# Version of the binary message format offered to the server when registering, text messages
+# are always understood as well
+ProtocolVersion = 1
+# Add how long each stage of a move took to its Done report, the stage times of the last
+# TimelineSize moves are kept either way
+ReportTimeline = False
+TimelineSize = 8
+# Add where the robot thinks it is to its Done report, worked out from the encoders over the
+# whole game: &pose=<x>,<y>,<heading> in mm and degrees from where it was when assigned, x ahead
+ReportPose = False
+# Keep the moves off the heap: orders are parsed straight out of the receive buffer, and the
+# garbage is collected after each move while the robot settles, so a collection doesn't land in
+# the middle of one. Needs CooperativeTasks. Done reports are always written to the UART in pieces
+# from constant bytes and preallocated buffers instead of being built up as strings.
+StaticBuffers = True
+# Add the least free heap seen during each move and how many times the garbage collector ran
+# on its own meanwhile to its Done report: &heap=<bytes>,<collections>. Needs CooperativeTasks.
+ReportHeap = False
 
 # Change Wi-Fi credentials here
 SSID = "RoboRuckus"
 WPA_Pass = "idontevenknowourwifi"
+# How long to wait at startup for a Wi-Fi module that's already set up to join the network on its own
+AutoJoinWait = 5000
+# When a Done report can't get through, wait LinkBackoff ms before trying again, doubling each time
+# up to LinkBackoffMax ms. Recovery starts with reopening the connection, rejoins the network after
+# LinkRejoinAfter failed tries and restarts the module after LinkRestartAfter.
+LinkBackoff = 250
+LinkBackoffMax = 8000
+LinkRejoinAfter = 2
+LinkRestartAfter = 5
+# How often to check on the network when there's nothing to send, in ms
+LinkProbeInterval = 10000
 
 # Robot color
 Color = 7
@@ -33,6 +72,53 @@ LinearTime = 1300
 LinearDistance = 0.72
 TurnDistance = 0.32
 
+# Profiled moves ramp up over ProfileRamp ms, cruise, then slow down so they could stop at
+# ProfileBrake ticks/ms^2, never dropping below ProfileMinSpeed, and cut each motor early
+# enough to coast onto the target instead of cutting both at full speed
+ProfiledMotion = False
+ProfileRamp = 150
+ProfileBrake = 0.001
+ProfileMinSpeed = 25
+# Add the planned and actual time and distance of each straight move to its Done report:
+# &stats=<planned ms>,<actual ms>,<planned ticks>,<left ticks>,<right ticks>, all 0 for other moves.
+# The planned time is 0 unless ProfiledMotion planned the move.
+ReportMoveStats = False
+
+# Calibrate the wheel speeds by measuring each motor at its current PWM and CalibrateStep above it,
+# going straight to the PWM those two points say gives LinearSpeedTarget and then checking it, instead
+# of the original calibration that drives four squares each way nudging the speeds by one. Each
+# point is measured CalibrateSettle ms after the PWM changes, averaged over CalibrateSamples reads.
+ModelCalibration = False
+CalibrateStep = 20
+CalibrateSettle = 200
+CalibrateSamples = 4
+
+# Let the Maqueen Plus board hold the wheel speeds with its own PID controller. Wheels are set to
+# LinearSpeedTarget rather than their calibrated PWM, and straight moves only read the encoders to
+# stop, at most every PIDPoll ms and less often while far from the target. Pivot turns run both
+# wheels at PIDTurnSpeed. Takes over straight moves from ProfiledMotion, and is best used with PivotTurns.
+OnboardPID = False
+PIDPoll = 40
+PIDTurnSpeed = 140
+
+# Finish straight moves on the grid lines. From SnapWindow ticks before the target the line sensors
+# are read every SnapPoll ms, and each wheel stops SnapOffset ticks after the sensors on its side
+# reach a line. Without a line the move goes on up to SnapWindow ticks past the target looking for one.
+SnapToGrid = False
+SnapWindow = 20
+SnapOffset = 3
+SnapPoll = 3
+
+# Turn by spinning both wheels in opposite directions at once, instead of the original turn
+# that moves one wheel and then the other
+PivotTurns = False
+
+# Record the encoders and wheel speeds every time they're read during a move, the last TraceSize
+# samples are kept and sent to the server by setup mode instruction 4. A move takes about 150 samples, and
+# each sample 10 bytes of memory, so the default keeps about the last 10 moves in 15 KB
+TraceMotion = False
+TraceSize = 1500
+
 # Robot name (must be URL escaped)
 RobotName = "Test%20Bot"
 
@@ -41,7 +127,17 @@ Left_Forward_Speed = 40
 Left_Backward_Speed = 40
 Right_Forward_Speed = 40
 Right_Backward_Speed = 40
+CRLF = b"\r\n"
 ConnectionString = "AT+CIPSTART=1,\"TCP\",\"" + ServerAddress + "\"," + ServerPort
+# Join WiFi network, saving it so the module joins on its own next time. Saving writes the module's
+# flash, so it's only done at startup when the module didn't join on its own with what it had saved.
+# JoinSaveString = "AT+CWJAP_DEF=\"" + SSID + "\","
+# Swap the below with the above line for an  unprotected network
+JoinSaveString = "AT+CWJAP_DEF=\"" + SSID + "\",\"" + WPA_Pass + "\""
+# Join WiFi network without saving it, to get back on it after losing it
+# JoinString = "AT+CWJAP_CUR=\"" + SSID + "\","
+# Swap the below with the above line for an  unprotected network
+JoinString = "AT+CWJAP_CUR=\"" + SSID + "\",\"" + WPA_Pass + "\""
 BotNumber = "0"
 Assigned = False
 PlayerNumber = 0
@@ -51,6 +147,49 @@ class Dir:
     CW = 1
     CCW = 2
 
+# What to tell the server after a queued move
+class ReportKind:
+    PLAIN = 0
+    MOVE = 1
+    NONE = 2
+    PROGRAM = 3
+    REJECTED = 4
+
+# Stages of a move in the timeline: its order read, acknowledged, driving started and finished,
+# the Done report started, connected to the server and acknowledged
+class Stage:
+    RECEIVED = 0
+    ACKED = 1
+    MOVING = 2
+    STOPPED = 3
+    REPORTING = 4
+    LINKED = 5
+    DONE = 6
+    COUNT = 7
+
+# Binary messages start with 0xB0 plus one of these message types, the version is the one offered when registering
+# Orders are two bytes, <movement * 4 + lateral><magnitude>, programs are <report> then orders back to back,
+# and instructions are <instruction> then either <player><bot> or, in setup mode, a settings record
+class Message:
+    ORDER = 1
+    PROGRAM = 2
+    INSTRUCTION = 3
+
+# Settings record: speed target, max travel time, travel distance, turn distance, LED color, then the name
+SettingsFormat = ">BHffB"
+SettingsSize = struct.calcsize(SettingsFormat)
+
+# Settings are stored in two files written in turn, so losing power mid-write leaves the other one intact
+# Record: store version, sequence number, the settings record fields, the four calibrated wheel speeds,
+# the name (up to 32 bytes) and a CRC-16 of everything before it. The newest valid one is used.
+StoreVersion = 1
+StoreFormat = ">BHBHffBBBBB32sH"
+StoreSize = struct.calcsize(StoreFormat)
+StoreFiles = ("settings0.bin", "settings1.bin")
+# CRC-16/CCITT of each four bit value shifted into the top of the CRC, big endian, for CRC16
+CRCTable = (b"\x00\x00\x10\x21\x20\x42\x30\x63\x40\x84\x50\xa5\x60\xc6\x70\xe7"
+            b"\x81\x08\x91\x29\xa1\x4a\xb1\x6b\xc1\x8c\xd1\xad\xe1\xce\xf1\xef")
+
 # Maqueen I2C address
 I2caddr = 0x10
 
@@ -63,86 +202,202 @@ class WiFi:
     def __init__(self, ssid, pw, bot = None):
         uart.init(baudrate=115200, bits=8, parity=None, stop=1, tx=pin1, rx=pin2)
         self.bot = bot
-        self.bot.LoadSettings(True)
+        # Receive buffer, bytes between rx_pos and rx_len haven't been looked at yet
+        self.rx_buf = bytearray(64)
+        self.rx_mv = memoryview(self.rx_buf)
+        self.rx_pos = 0
+        self.rx_len = 0
+        # +IPD frame parser state and the payload of the last complete frame
+        self.frame_matcher = ATMatcher(("+IPD,",))
+        self.frame_state = 0
+        self.frame_number = 0
+        self.frame_link = 0
+        self.frame_remaining = 0
+        self.payload = bytearray(256)
+        self.payload_mv = memoryview(self.payload)
+        self.payload_len = 0
+        # Last message from the server that hasn't been handled yet, -1 when empty
+        self.inbox = bytearray(256)
+        self.inbox_mv = memoryview(self.inbox)
+        self.inbox_len = -1
+        self.inbox_taken = False
+        # Start of the last response to a command, the matcher of the command still waiting
+        # for its response and the result once it's in
+        self.response = bytearray(256)
+        self.response_len = 0
+        self.matchers = {}
+        self.matcher = None
+        self.result = ""
+        # Writes Done reports piece by piece, and the end of their request, which never changes
+        self.writer = UARTWriter()
+        self.done_tail = bytes(" HTTP/1.1\r\nHost: " + ServerAddress + ":" + ServerPort + "\r\n" +
+                               ("Connection: keep-alive" if PersistentLink else "Connection: close") + "\r\n\r\n",
+                               "UTF-8")
+        # Whether link 1 to the server is being kept open, and how the last and all Done reports went
+        self.link_open = False
+        self.move_reused = 0
+        self.move_reconnects = 0
+        self.total_reuses = 0
+        self.total_reconnects = 0
+        # Moves waiting to run, six bytes each: the order's three digits, a ReportKind and its number,
+        # then the move's timeline entry
+        self.queue = bytearray(MoveQueueSize * 6)
+        self.queue_head = 0
+        self.queue_count = 0
+        # Work for the network task: acknowledgments owed for received messages and Done
+        # reports for finished moves or rejected programs, each its ReportKind, number and timeline entry
+        # or -1, and whether it's in the middle of one
+        self.acks = 0
+        self.reports = array("h", [0] * (MoveQueueSize * 3))
+        self.report_head = 0
+        self.report_count = 0
+        self.busy = False
+        # Stage times in ms of the last TimelineSize moves, Stage.COUNT per move, the number of
+        # moves so far, the first move not acknowledged yet, when the last message was read and
+        # acknowledged, and how long the last Done report took once connected
+        self.timeline = array("l", [0] * (TimelineSize * Stage.COUNT))
+        self.timeline_next = 0
+        self.timeline_acked = 0
+        self.message_time = 0
+        self.ack_time = 0
+        self.last_handshake = 0
+        # Pose the robot was at when each move in the timeline stopped, x and y in mm and heading in degrees
+        self.poses = array("h", [0] * (TimelineSize * 3))
+        # Least free heap during each move in the timeline and how many times the garbage collector ran on its own
+        self.heaps = array("l", [0] * (TimelineSize * 2))
+        # The bot's move_stats after each move in the timeline
+        self.stats = array("l", [0] * (TimelineSize * 5))
+        # Keeps an eye on the network and gets the link back when it drops
+        self.links = LinkManager(self)
+        # Bringing up the board, stepped while waiting on the module
+        self.starting = self.bot.StartSteps()
+        # Startup times in ms: checking the module, configuring it, joining, board up, registered
+        self.boot_times = [0, 0, 0, 0, 0]
         while (not self.WifiStartup()):
             display.show(Image.SAD)
             sleep(1000)
         display.show(Image.HAPPY)
 
+    # Checks what state the module is in first, it keeps its mode and joins the saved network
+    # on its own after powering up, so the reset and join are skipped when they aren't needed.
+    # The board is brought up during the long waits.
     def WifiStartup(self):
+        times = self.boot_times
+        start = running_time()
         # Empty Buffer
         self.EmptySerialBuffer()
 
-        # Enable multiplexing (necessary for server operations)
-        self.SendCommand("AT+CIPMUX=1", "OK")
+        # Wait for the module to finish booting
+        while "ERROR" in self.SendCommand("AT", "OK", self.starting, 500):
+            pass
+        configured = "+CWMODE:1" in self.SendCommand("AT+CWMODE?", "OK")
+        # Waits for the OK at the end, the address is at the start of the response
+        client = self.ParseIP(self.SendCommand("AT+CIPSTA?", "OK"))
+        times[0] = running_time() - start
+
+        if not configured:
+            # Enable multiplexing (necessary for server operations)
+            self.SendCommand("AT+CIPMUX=1", "OK")
 
-        # Stop server just in case
-        self.SendCommand("AT+CIPSERVER=0", "OK")
+            # Stop server just in case
+            self.SendCommand("AT+CIPSERVER=0", "OK")
 
-        # Initialize radio
-        self.SendCommand("AT+CWMODE=1", "OK")
+            # Initialize radio
+            self.SendCommand("AT+CWMODE=1", "OK")
 
-        # Disable DHCP server
-        self.SendCommand("AT+CWDHCP=1,1", "OK")
+            # Disable DHCP server
+            self.SendCommand("AT+CWDHCP=1,1", "OK")
 
-        # Restart the module to enable changes
-        self.SendCommand("AT+RST", "ready")
-        sleep(1000)
+            # Restart the module to enable changes
+            self.SendCommand("AT+RST", "ready", self.starting)
+            self.Wait(1000)
+            client = None
+        times[1] = running_time() - start - times[0]
 
         # Enable multiplexing (necessary for server operations)
         self.SendCommand("AT+CIPMUX=1", "OK")
 
-        # Join WiFi network
-        # SendCommand("AT+CWJAP=\"" + SSID + "\",", "OK")
-        # Swap the below with the above line for an  unprotected network
-        self.SendCommand("AT+CWJAP_CUR=\"" + SSID + "\",\"" + WPA_Pass + "\"", "OK")
-
-        # Get assigned IP address
-        ip_string = self.SendCommand("AT+CIPSTA?", "gateway")
-        if not(ip_string is None) and not ("ERROR" in ip_string):
-            # Parse IP address
-            ip_string = ip_string[ip_string.find("\"") + 1:]
-            client = ip_string[0:ip_string.find("\"")]
-
-            # Empty Buffer
-            self.EmptySerialBuffer()
-
-            # Start server
-            self.SendCommand("AT+CIPSERVER=1,8080", "OK")
+        if client is None and configured:
+            # Give the module a chance to finish joining on its own
+            if not ("ERROR" in self.SendCommand("", "WIFI GOT IP", self.starting, AutoJoinWait)):
+                client = self.ParseIP(self.SendCommand("AT+CIPSTA?", "OK"))
+        if client is None:
+            # Join WiFi network
+            self.SendCommand(JoinSaveString, "OK", self.starting, 15000)
+
+            # Get assigned IP address
+            client = self.ParseIP(self.SendCommand("AT+CIPSTA?", "OK"))
+        times[2] = running_time() - start - times[0] - times[1]
+        if client is None:
+            return False
 
-            # Connect to server
-            self.SendCommand(ConnectionString, "OK")
-            sleep(200)
+        # The settings are needed to register
+        self.bot.Drive(self.starting)
+        times[3] = self.bot.board_ready
 
-            # Inform server of bot
-            message = ""
-            message = "GET /Bot/Index?ip=" + client + "&name=" + RobotName + " HTTP/1.1" + "\r\n" + "Host: " + ServerAddress + ":" + ServerPort + "\r\n" + "Connection: close" + "\r\n\r\n"
-            self.SendCommand("AT+CIPSEND=1," + str(len(message) + 2), "OK")
-            response = self.SendCommand(message, "AK")
+        # Empty Buffer
+        self.EmptySerialBuffer()
 
-            # Check for server acknowledgment
-            if "ERROR" in response:
-                return False
-        else:
+        # Start server
+        self.SendCommand("AT+CIPSERVER=1,8080", "OK")
+
+        # Connect to server
+        self.SendCommand(ConnectionString, "OK")
+        sleep(200)
+
+        # Inform server of bot, with how much heap is left once everything is loaded and started
+        times[4] = running_time()
+        gc.collect()
+        message = ""
+        message = ("GET /Bot/Index?ip=" + client + "&name=" + RobotName + "&proto=" + str(ProtocolVersion) +
+                   "&boot=" + ",".join([str(time) for time in times]) + "&free=" + str(gc.mem_free()) +
+                   " HTTP/1.1" + "\r\n" + "Host: " + ServerAddress + ":" + ServerPort + "\r\n" +
+                   "Connection: close" + "\r\n\r\n")
+        self.SendCommand("AT+CIPSEND=1," + str(len(message) + 2), "OK")
+        response = self.SendCommand(message, "AK")
+
+        # Check for server acknowledgment
+        if "ERROR" in response:
             return False
         return True
 
-    def MessageReceived(self, message: str):
-        global Assigned, PlayerNumber, BotNumber, InSetupMode
-        message = message[(message.find(":") + 1):]
-        if Assigned:
+    # Sleeps for ms, running any steps of bringing up the board that come due meanwhile
+    def Wait(self, ms: int):
+        end = running_time() + ms
+        while running_time() < end:
+            delay = end - running_time()
+            try:
+                delay = min(delay, next(self.starting))
+            except StopIteration:
+                pass
+            sleep(max(0, delay))
+
+    # Returns the IP address in a response to AT+CIPSTA?, or None if there isn't one
+    def ParseIP(self, ip_string: str):
+        if ip_string is None or "ERROR" in ip_string:
+            return None
+        # Parse IP address
+        ip_string = ip_string[ip_string.find("\"") + 1:]
+        client = ip_string[0:ip_string.find("\"")]
+        if client == "" or client == "0.0.0.0":
+            return None
+        return client
+
+    # Handles the payload of a message from the server
+    # With CooperativeTasks, move orders are only queued here and the motion task runs them
+    def MessageReceived(self, message):
+        global InSetupMode
+        if message is self.inbox_mv:
+            self.InboxReceived(self.inbox_len)
+        elif not isinstance(message, str):
+            self.BinaryReceived(message)
+        elif Assigned and message[0] == "P":
+            # A whole program of moves
+            program = bytes(message, "UTF-8")
+            self.QueueProgram(program, len(program), 3)
+        elif Assigned:
             # Parse message
-            Movement = int(message[0])
-            Magnitude = int(message[1])
-            LateralMove = int(message[2])
-
-            # Check for reset command
-            if LateralMove == 2:
-                Assigned = False
-                display.show(Image.HAPPY)
-            else:
-                # Process a move order
-                self.ProcessMove(Movement, Magnitude, LateralMove)
+            self.Order(int(message[0]), int(message[1]), int(message[2]))
         elif InSetupMode:
             self.SetupMode(message)
         else:
@@ -151,182 +406,1098 @@ class WiFi:
             if instruction == 0:
                 # Get player assignment
                 message = message[message.find(":") + 1:]
-                PlayerNumber = int(message[0])
-                # Get bot number
-                BotNumber = message[1]
-                display.show(PlayerNumber)
-                Assigned = True
+                self.Assign(int(message[0]), message[1])
             elif instruction == 1:
                 display.show(Image.DUCK)
                 InSetupMode = True
 
-    def ProcessMove(self, Movement: int, Magnitude: int, LateralMove: int):
-        if Movement <= 3:
-            # Standard movement
-            if Magnitude > 0:
-                if Movement == 0:
-                    # Left
-                    self.bot.Turn(Magnitude, 1)
-                elif Movement == 1:
-                    # Right
-                    self.bot.Turn(Magnitude, 0)
-                elif Movement == 2:
-                    # Forward
-                    self.bot.LinearMove(Magnitude, 0, False)
-                elif Movement == 3:
-                    # Backup
-                    self.bot.LinearMove(Magnitude, 1, False)
-            else:
-                # Robot trying to move, but is blocked
-                display.show(Image.CONFUSED)
-                audio.play(Sound.SAD, True)
-        # Non-movment command
+    # Handles an order or program with StaticBuffers, text or binary, without copying it out of the inbox
+    def InboxReceived(self, length: int):
+        inbox = self.inbox
+        if length > 0 and inbox[0] & 0xF0 == 0xB0:
+            self.BinaryReceived(self.inbox_mv, length)
+        elif length > 0 and inbox[0] == 80:
+            # "P", a whole program of moves
+            self.QueueProgram(inbox, length, 3)
+        elif length >= 3:
+            self.Order(inbox[0] - 48, inbox[1] - 48, inbox[2] - 48)
+
+    # Handles a binary message, read straight out of the inbox, length bytes of it if given
+    def BinaryReceived(self, data, length = -1):
+        global InSetupMode
+        if length < 0:
+            length = len(data)
+        if length < 2:
+            return
+        kind = data[0] & 0x0F
+        if Assigned and kind == Message.PROGRAM:
+            self.QueueProgram(data, length, 2)
+        elif Assigned and kind == Message.ORDER and length >= 3:
+            self.Order(data[1] >> 2, data[2], data[1] & 0x03)
+        elif kind == Message.INSTRUCTION:
+            instruction = data[1]
+            if InSetupMode:
+                if instruction == 4:
+                    self.SetupInstruction(4)
+                elif instruction != 0:
+                    # Settings record
+                    values = struct.unpack_from(SettingsFormat, data, 2)
+                    self.bot.UseSettings(str(data[2 + SettingsSize:length], "UTF-8"), values[0], values[1], values[2],
+                                         values[3], values[4])
+                    self.SetupInstruction(instruction)
+                else:
+                    # Optionally followed by the ETag of the settings the server already has
+                    self.SetupInstruction(0, (data[2] << 8) | data[3] if length >= 4 else -1)
+            elif not Assigned:
+                if instruction == 0 and length >= 4:
+                    self.Assign(data[2], str(data[3]))
+                elif instruction == 1:
+                    display.show(Image.DUCK)
+                    InSetupMode = True
+
+    # Takes a player assignment
+    def Assign(self, player: int, bot: str):
+        global Assigned, PlayerNumber, BotNumber
+        PlayerNumber = player
+        # Get bot number
+        BotNumber = bot
+        display.show(PlayerNumber)
+        Assigned = True
+        # Poses are from where the robot starts the game
+        self.bot.ResetPose()
+
+    # Handles one move order
+    def Order(self, Movement: int, Magnitude: int, LateralMove: int):
+        # Check for reset command
+        if LateralMove == 2:
+            self.ResetOrder(ReportKind.NONE, 0)
+        elif CooperativeTasks:
+            self.QueueMove(Movement, Magnitude, LateralMove, ReportKind.PLAIN, 0)
         else:
-            if Movement == 4:
-                # Damage taken
-                display.show(Image.SURPRISED)
-                audio.play(Sound.SAD, True)
-        # Forces a response to the server, resets the WiFi on fail
-        sleep(500)
-        success = False
-        while not success:
-            # Ensure connection isn't already open
-            self.SendCommand("AT+CIPCLOSE=1", "")
-            success = True
-            # Open TCP connection to server
-            response = self.SendCommand(ConnectionString, "OK")
-            if "FAIL" in response or "ERROR" in response:
-                success = False
+            # Process a move order
+            self.ProcessMove(Movement, Magnitude, LateralMove, ReportKind.PLAIN, 0, self.NewTimeline())
+
+    # Ends the game on a reset order, dropping the moves still queued. If the reset, or one of the
+    # moves dropped, was to report for a whole program, that report is still sent so the server
+    # isn't left waiting for it.
+    def ResetOrder(self, kind: int, number: int):
+        global Assigned
+        queue = self.queue
+        while kind != ReportKind.PROGRAM and self.queue_count > 0:
+            slot = self.NextMove()
+            kind = queue[slot + 3]
+            number = queue[slot + 4]
+        self.queue_count = 0
+        Assigned = False
+        display.show(Image.HAPPY)
+        if kind != ReportKind.PROGRAM:
+            return
+        if CooperativeTasks:
+            self.PushReport(kind, number, -1)
+        else:
+            self.ReportDone(-1, kind, number)
+
+    # Runs a program that was just queued, unless the motion task will
+    def ProgramQueued(self):
+        if not CooperativeTasks:
+            self.RunQueue()
+
+    # Queues the moves of a program message, the first length bytes of data, then runs them unless the
+    # motion task will. Text programs are P<report><moves> with three digit orders, size 3, and binary
+    # ones the same with two byte orders, size 2. Report is 0 to report after each move or 1 to report
+    # once after the last one. A program without moves, or with more than the queue has room for,
+    # is rejected whole so the server always hears back.
+    def QueueProgram(self, data, length: int, size: int):
+        if length < 2:
+            return
+        report = data[1] - 48 if size == 3 else data[1]
+        moves = (length - 2) // size
+        if moves == 0 or moves > MoveQueueSize - self.queue_count:
+            self.RejectProgram(moves)
+            return
+        kind = ReportKind.MOVE if report == 0 else ReportKind.NONE
+        for number in range(moves):
+            index = 2 + number * size
+            if size == 3:
+                self.QueueMove(data[index] - 48, data[index + 1] - 48, data[index + 2] - 48, kind, number)
             else:
-                # This should really be a POST request, but GET is more reliable
-                message = "GET /Bot/Done?bot="
-                message = message + BotNumber + " HTTP/1.1"+ "\r\n" + "Host: " + ServerAddress + ":" + ServerPort + "\r\n" + "Connection: close" + "\r\n\r\n"
-                response = self.SendCommand("AT+CIPSEND=1," + str(len(message) + 2), "OK")
+                self.QueueMove(data[index] >> 2, data[index + 1], data[index] & 0x03, kind, number)
+        self.ProgramReport(report, moves)
+        self.ProgramQueued()
+
+    # Tells the server a program of this many moves was rejected and none of it will run
+    def RejectProgram(self, moves: int):
+        if CooperativeTasks:
+            self.PushReport(ReportKind.REJECTED, moves, -1)
+        else:
+            self.ReportDone(-1, ReportKind.REJECTED, moves)
+
+    # Makes the last of count moves just queued report for the whole program if it should
+    def ProgramReport(self, report: int, count: int):
+        if report != 0 and count > 0:
+            # The last move reports for the whole program
+            slot = ((self.queue_head + self.queue_count - 1) % MoveQueueSize) * 6
+            self.queue[slot + 3] = ReportKind.PROGRAM
+            self.queue[slot + 4] = count
+
+    # Adds one move to the end of the queue, returns False if it's full
+    def QueueMove(self, Movement: int, Magnitude: int, LateralMove: int, kind: int, number: int):
+        if self.queue_count >= MoveQueueSize:
+            return False
+        slot = ((self.queue_head + self.queue_count) % MoveQueueSize) * 6
+        queue = self.queue
+        queue[slot] = Movement
+        queue[slot + 1] = Magnitude
+        queue[slot + 2] = LateralMove
+        queue[slot + 3] = kind
+        queue[slot + 4] = number
+        queue[slot + 5] = self.NewTimeline()
+        self.queue_count += 1
+        return True
 
-                if "ERROR" in response:
-                    success = False
-                else:
-                    # Notify server that bot has finished moving, check for acknowledgment
-                    response = self.SendCommand(message, "AK")
-                if "ERROR" in response:
-                    success = False
-            if not success:
-                # Something went wrong, try resetting the WiFi module
-                sleep(350)
-                self.SendCommand("AT+CIPMUX=1", "OK")
-                self.SendCommand("AT+CIPSERVER=1,8080", "OK")
+    # Takes the move at the front of the queue, returns the slot it's in
+    def NextMove(self):
+        slot = self.queue_head * 6
+        self.queue_head = (self.queue_head + 1) % MoveQueueSize
+        self.queue_count -= 1
+        return slot
+
+    # Runs queued moves back to back
+    def RunQueue(self):
+        while self.queue_count > 0:
+            slot = self.NextMove()
+            queue = self.queue
+            # Check for reset command
+            if queue[slot + 2] == 2:
+                self.ResetOrder(queue[slot + 3], queue[slot + 4])
+                return
+            kind = queue[slot + 3]
+            self.ProcessMove(queue[slot], queue[slot + 1], queue[slot + 2], kind, queue[slot + 4], queue[slot + 5])
+            if kind == ReportKind.NONE:
+                # Let the robot settle before the next move
+                sleep(100)
+
+    # Runs one move, then reports it done as a ReportKind with its number unless that's NONE
+    def ProcessMove(self, Movement: int, Magnitude: int, LateralMove: int, kind = ReportKind.PLAIN, number = 0,
+                    entry = -1):
+        self.Stamp(entry, Stage.MOVING)
+        self.bot.Drive(self.bot.MoveSteps(Movement, Magnitude))
+        self.Stamp(entry, Stage.STOPPED)
+        self.KeepStats(entry)
+        if kind == ReportKind.NONE:
+            return
+        if ReportPose:
+            self.bot.Drive(self.bot.SettleSteps())
+            self.KeepPose(entry)
+        self.ReportDone(entry, kind, number)
         display.show(PlayerNumber)
 
+    # Hands a finished move to the network task to report
+    def PushReport(self, kind: int, number: int, entry: int):
+        if self.report_count >= MoveQueueSize:
+            return
+        slot = ((self.report_head + self.report_count) % MoveQueueSize) * 3
+        self.reports[slot] = kind
+        self.reports[slot + 1] = number
+        self.reports[slot + 2] = entry
+        self.report_count += 1
+
+    # Starts the timeline of a move from the message it came in, returns its entry
+    def NewTimeline(self):
+        entry = self.timeline_next % TimelineSize
+        self.timeline_next += 1
+        row = entry * Stage.COUNT
+        timeline = self.timeline
+        for stage in range(Stage.COUNT):
+            timeline[row + stage] = 0
+        timeline[row + Stage.RECEIVED] = self.message_time
+        if self.ack_time >= self.message_time:
+            # Acknowledged before the move was handled
+            timeline[row + Stage.ACKED] = self.ack_time
+            self.timeline_acked = self.timeline_next
+        return entry
+
+    # Records when a move reached a stage, entry -1 is no move
+    def Stamp(self, entry: int, stage: int):
+        if entry >= 0:
+            self.timeline[entry * Stage.COUNT + stage] = running_time()
+
+    # An acknowledgment went out, it was for the moves since the last one
+    def AckSent(self):
+        self.ack_time = running_time()
+        while self.timeline_acked < self.timeline_next:
+            self.timeline[(self.timeline_acked % TimelineSize) * Stage.COUNT + Stage.ACKED] = self.ack_time
+            self.timeline_acked += 1
+
+    # Reads messages from the server, move orders are queued for the motion task and
+    # anything else is handled on the spot once the network task has nothing in flight
+    def IntakeTask(self):
+        while True:
+            message = self.ReadMessage()
+            if message is None:
+                yield 5
+                continue
+            if not InSetupMode:
+                self.acks += 1
+            if not Assigned:
+                # Instructions talk to the ESP8266 themselves
+                while self.acks > 0 or self.busy:
+                    yield 5
+            self.MessageReceived(message)
+            yield 0
+
+    # Sends acknowledgments for received messages and Done reports for finished moves,
+    # one AT exchange at a time so they never interleave
+    def NetworkTask(self):
+        while True:
+            if self.acks > 0:
+                self.busy = True
+                self.acks -= 1
+                yield from self.CommandSteps("AT+CIPSEND=0,2", "OK")
+                yield from self.CommandSteps("OK", "CLOSED")
+                self.AckSent()
+                self.busy = False
+            elif self.report_count > 0:
+                self.busy = True
+                slot = self.report_head * 3
+                self.report_head = (self.report_head + 1) % MoveQueueSize
+                self.report_count -= 1
+                yield from self.ReportSteps(self.reports[slot + 2], self.reports[slot], self.reports[slot + 1])
+                display.show(PlayerNumber)
+                self.busy = False
+            elif running_time() - self.links.last_probe > LinkProbeInterval:
+                # Nothing to send, make sure the network is still there
+                self.busy = True
+                yield from self.links.CheckSteps()
+                self.busy = False
+            else:
+                yield 5
+
+    # Forces a response to the server, recovers the WiFi on fail
+    def ReportDone(self, entry = -1, kind = ReportKind.PLAIN, number = 0):
+        for delay in self.ReportSteps(entry, kind, number):
+            sleep(delay)
+
+    # Steps of a Done report, yielding how long to wait before the next step
+    # With PersistentLink the previous connection is reused and only replaced if a send fails.
+    # Failed tries are handed to the link manager, which backs off and escalates the recovery.
+    # The stages of the move's timeline entry are stamped on the way, and the report of its
+    # ReportKind and number is written by DoneSteps.
+    def ReportSteps(self, entry = -1, kind = ReportKind.PLAIN, number = 0):
+        yield 500
+        self.Stamp(entry, Stage.REPORTING)
+        self.move_reused = 0
+        self.move_reconnects = 0
+        links = self.links
+        if PersistentLink and self.link_open:
+            self.Stamp(entry, Stage.LINKED)
+            yield from self.DoneSteps(entry, kind, number)
+            if self.result != "ERROR":
+                self.move_reused = 1
+                self.total_reuses += 1
+                self.ReportSent(entry)
+                return
+            self.link_open = False
+        while True:
+            # Ensure connection isn't already open, wait for the reply so it isn't mistaken for the next one
+            yield from self.CommandSteps("AT+CIPCLOSE=1", "OK")
+            self.move_reconnects += 1
+            self.total_reconnects += 1
+            # Open TCP connection to server
+            yield from self.CommandSteps(ConnectionString, "OK")
+            if not ("FAIL" in self.result or "ERROR" in self.result):
+                # DoneSteps tells the server how long the link was down if it was
+                self.Stamp(entry, Stage.LINKED)
+                yield from self.DoneSteps(entry, kind, number)
+                if self.result != "ERROR":
+                    break
+            # Something went wrong, wait and try to get the link back
+            yield from links.RecoverSteps()
+        links.Recovered()
+        self.link_open = PersistentLink
+        self.ReportSent(entry)
+
+    # Keeps the pose the robot is at for a move's Done report
+    def KeepPose(self, entry: int):
+        if entry < 0 or not ReportPose:
+            return
+        pose = self.bot.Odometry()
+        index = entry * 3
+        poses = self.poses
+        poses[index] = int(pose[0])
+        poses[index + 1] = int(pose[1])
+        # Degrees from -180 to 179
+        poses[index + 2] = (int(round(pose[2] * 180 / PI)) + 180) % 360 - 180
+
+    # Keeps how a move went against its plan for its Done report
+    def KeepStats(self, entry: int):
+        if entry < 0 or not ReportMoveStats:
+            return
+        index = entry * 5
+        move_stats = self.bot.move_stats
+        for field in range(5):
+            self.stats[index + field] = move_stats[field]
+
+    # Keeps the heap use of a move for its Done report, then collects the garbage while nothing's moving
+    def KeepHeap(self, entry: int):
+        bot = self.bot
+        if entry >= 0:
+            self.heaps[entry * 2] = bot.heap_low
+            self.heaps[entry * 2 + 1] = bot.heap_gcs
+        if StaticBuffers:
+            gc.collect()
+            bot.heap_last = gc.mem_free()
+
+    # Steps of sending the Done report of a move and waiting for the server's acknowledgment,
+    # leaves "ERROR" in result if it failed. The request is written to the UART piece by piece,
+    # twice over, first only to add up its length for AT+CIPSEND.
+    def DoneSteps(self, entry: int, kind: int, number: int):
+        writer = self.writer
+        links = self.links
+        recovery = running_time() - links.incident_start if links.incident_start >= 0 else -1
+        writer.Start(False)
+        self.WriteDone(entry, kind, number, recovery)
+        length = writer.length
+        writer.Start(True)
+        writer.Put(b"AT+CIPSEND=1,")
+        writer.PutInt(length + 2)
+        writer.Put(CRLF)
+        yield from self.CommandSteps("", "OK")
+        if self.result == "ERROR":
+            return
+        self.WriteDone(entry, kind, number, recovery)
+        writer.Put(CRLF)
+        yield from self.CommandSteps("", "AK")
+
+    # Writes the HTTP request of a Done report: the move or program number of its ReportKind, how long
+    # the link was down unless recovery is -1, and the timeline, pose and heap use of the move
+    # This should really be a POST request, but GET is more reliable
+    def WriteDone(self, entry: int, kind: int, number: int, recovery: int):
+        writer = self.writer
+        writer.Put(b"GET /Bot/Done?bot=")
+        writer.Put(BotNumber)
+        if kind == ReportKind.MOVE:
+            writer.Put(b"&move=")
+            writer.PutInt(number)
+        elif kind == ReportKind.PROGRAM:
+            writer.Put(b"&moves=")
+            writer.PutInt(number)
+        elif kind == ReportKind.REJECTED:
+            writer.Put(b"&rejected=")
+            writer.PutInt(number)
+        if recovery >= 0:
+            writer.Put(b"&recovery=")
+            writer.PutInt(recovery)
+        if ReportTimeline and entry >= 0:
+            row = entry * Stage.COUNT
+            timeline = self.timeline
+            received = timeline[row]
+            writer.Put(b"&timeline=")
+            for stage in range(Stage.ACKED, Stage.DONE):
+                writer.PutInt(timeline[row + stage] - received if timeline[row + stage] else -1)
+                writer.Put(b",")
+            writer.PutInt(self.last_handshake)
+        if ReportPose and entry >= 0:
+            index = entry * 3
+            poses = self.poses
+            writer.Put(b"&pose=")
+            writer.PutInt(poses[index])
+            writer.Put(b",")
+            writer.PutInt(poses[index + 1])
+            writer.Put(b",")
+            writer.PutInt(poses[index + 2])
+        if ReportHeap and CooperativeTasks and entry >= 0:
+            writer.Put(b"&heap=")
+            writer.PutInt(self.heaps[entry * 2])
+            writer.Put(b",")
+            writer.PutInt(self.heaps[entry * 2 + 1])
+        if ReportMoveStats and entry >= 0:
+            writer.Put(b"&stats=")
+            for field in range(5):
+                if field:
+                    writer.Put(b",")
+                writer.PutInt(self.stats[entry * 5 + field])
+        writer.Put(self.done_tail)
+
+    # A Done report got through, finishes the move's timeline
+    def ReportSent(self, entry: int):
+        if entry < 0:
+            return
+        self.Stamp(entry, Stage.DONE)
+        row = entry * Stage.COUNT
+        self.last_handshake = self.timeline[row + Stage.DONE] - self.timeline[row + Stage.LINKED]
+
     # Setup and tuning mode
     def SetupMode(self, message: str):
-        global InSetupMode
         instruction = int(message[0:message.find(":")])
         message = message[message.find(":") + 1:]
+        if instruction == 4:
+            # Nothing follows
+            self.SetupInstruction(4)
+        elif instruction != 0:
+            # New settings, only written to storage when quitting
+            self.bot.SaveSettings(message, False)
+            self.SetupInstruction(instruction)
+        else:
+            # Optionally followed by the ETag of the settings the server already has
+            etag = -1
+            try:
+                etag = int(message.rstrip(":"), 16)
+            except ValueError:
+                pass
+            self.SetupInstruction(0, etag)
+
+    # Carries out a setup instruction once any new settings are in use
+    # For instruction 0, etag is the ETag of the settings JSON the server already has, if any
+    def SetupInstruction(self, instruction: int, etag = -1):
+        global InSetupMode
         # Respond and close the connection if no further response needed
-        if instruction != 0:
+        if instruction != 0 and instruction != 4:
             self.SendCommand("AT+CIPSEND=0,2", "OK")
             self.SendCommand("OK", "CLOSED")
             self.EmptySerialBuffer()
 
-        # Send current settings to server
+        # Send current settings to server, or just the ETag if the server's copy is current
         if instruction == 0:
             settings = self.bot.LoadSettings()
+            if etag == self.bot.settings_etag:
+                settings = self.bot.settings_current
             self.SendCommand("AT+CIPSEND=0," + str(len(settings)), "OK")
             self.SendCommand(settings, "CLOSED")
             self.EmptySerialBuffer()
-        # Save new settings and run a calibration/speed test
+        # Run a calibration/speed test
         elif instruction == 1:
-            self.bot.SaveSettings(message, False)
             self.bot.CalibrateSpeed()
-        # Save new settings and run a navigation test
+        # Run a navigation test
         elif instruction == 2:
-            self.bot.SaveSettings(message, False)
             self.bot.NavigationTest()
         # Quit setup mode
         elif instruction == 3:
             # Save settings to storage
-            self.bot.SaveSettings(message, True)
+            self.bot.WriteSettings()
             InSetupMode = False
             display.show(Image.HAPPY)
+        # Send the encoder trace
+        elif instruction == 4:
+            self.SendTrace()
+
+    # Sends the encoder trace in reply to a setup instruction: a four byte header of "T", format
+    # version 2 and the number of samples, then the samples oldest first, five 16 bit values each,
+    # all little endian. Sent in pieces the module can take, it's empty if tracing is off.
+    def SendTrace(self):
+        bot = self.bot
+        trace = bot.trace
+        if trace is not None and bot.trace_count:
+            # Where the last move ended up
+            bot.getSensors()
+        count = 0 if trace is None else min(bot.trace_count, TraceSize)
+        first = (bot.trace_count - count) % TraceSize
+        self.SendCommand("AT+CIPSEND=0,4", "OK")
+        self.SendCommand(struct.pack("<BBH", 84, 2, count), "SEND OK" if count else "CLOSED")
+        if count:
+            view = memoryview(trace)
+            left = count
+            for start, end in ((first, min(first + count, TraceSize)), (0, max(0, first + count - TraceSize))):
+                while start < end:
+                    # 200 samples is 2000 bytes, just under the most one send can take
+                    stop = min(end, start + 200)
+                    left -= stop - start
+                    self.SendCommand("AT+CIPSEND=0," + str((stop - start) * 10), "OK")
+                    self.SendCommand(view[start * 5:stop * 5], "SEND OK" if left else "CLOSED")
+                    start = stop
+        self.EmptySerialBuffer()
 
     # Sends an AT command to the ESP8266
     # Will return immdiately with "OK" unless an EndString is supplied
     # then it will wait until that string is found in the response or
     # ERROR if it's not found.
     # If no command is supplied, will just read a response.
-    def SendCommand(self, Command: str, EndString: str):
-        serial_str = ""
+    # While waiting, a Background task's steps are run whenever they're due.
+    def SendCommand(self, Command: str, EndString: str, Background = None, Timeout = 8000):
+        wake = 0
+        for delay in self.CommandSteps(Command, EndString, Timeout):
+            if Background is not None and running_time() >= wake:
+                try:
+                    wake = running_time() + next(Background)
+                except StopIteration:
+                    Background = None
+        return self.Response()
+
+    # The start of the response to the last command, or "ERROR" if it failed
+    def Response(self):
+        if self.result == "ERROR":
+            return self.result
+        return str(self.response[0:self.response_len], "UTF-8")
+
+    # Steps of SendCommand, the token that ended the response or "ERROR" ends up in result
+    # Responses are matched byte by byte as they arrive, so there is no fixed
+    # wait after sending and a token split across two reads is still found.
+    def CommandSteps(self, Command: str, EndString: str, Timeout = 8000):
         if Command != "":
+            self.DropStale()
             # Send command
-            uart.write(bytes((Command + "\r\n"), "UTF-8"))
-            sleep(100)
-        if EndString != "":
-            timeout = running_time()
-            # Look for EndString or other common response
-            while True:
-                serial_buffer = uart.read()
-                # Check if data was received
-                if not(serial_buffer is None):
-                    serial_str += str(serial_buffer, "UTF-8")
-                # Prevent the string from getting too long
-                if len(serial_str) > 300:
-                    serial_str = serial_str[0:(len(serial_str) - 200)]
-                # Check for EndString or other positive response
-                if (EndString in serial_str) or ("ALREADY CONNECTED" in serial_str):
-                    return serial_str
-                # Check for error reponse
-                elif ("ERROR" in serial_str) or ("SEND FAIL" in serial_str):
-                    break
-                if running_time() - timeout > 8000:
-                    break
-            return "ERROR"
-        return "OK"
+            uart.write(Command)
+            uart.write(CRLF)
+        if EndString == "":
+            self.result = "OK"
+            return
+        matcher = self.matchers.get(EndString)
+        if matcher is None:
+            # EndString first so it wins over the generic tokens, same as before
+            # FAIL covers SEND FAIL and a failed join
+            matcher = ATMatcher((EndString, "ALREADY CONNECTED", "ERROR", "FAIL"))
+            self.matchers[EndString] = matcher
+        matcher.Reset()
+        self.matcher = matcher
+        self.response_len = 0
+        timeout = running_time()
+        while True:
+            self.Pump()
+            if self.matcher is None:
+                return
+            if running_time() - timeout > Timeout:
+                self.matcher = None
+                self.result = "ERROR"
+                return
+            yield 0
+
+    # Drops what's left of earlier responses before a new command is sent, like an OK or ERROR after
+    # the token a command waited for, so the new command doesn't take it for its own response.
+    # +IPD frames are still parsed, it stops once one completes a message for the inbox like Pump.
+    def DropStale(self):
+        self.matcher = None
+        while self.inbox_len < 0 and (self.rx_pos < self.rx_len or self.FillSerial()):
+            self.Pump()
+
+    # Reads whatever the UART has into the receive buffer, returns the number of bytes read
+    def FillSerial(self):
+        count = uart.readinto(self.rx_buf)
+        if count is None:
+            count = 0
+        self.rx_pos = 0
+        self.rx_len = count
+        return count
+
+    # Reads from the serial port without waiting, running every byte through the +IPD,<link>,<length>:
+    # frame parser and the matcher of the command waiting for a response, if there is one.
+    # Stops once a command's response or a message for the inbox is complete, leaving the rest for
+    # the next call. Frames can be split across reads or share one, the parser picks up where it left off.
+    def Pump(self):
+        while True:
+            if self.rx_pos >= self.rx_len and not self.FillSerial():
+                return
+            buf = self.rx_buf
+            while self.rx_pos < self.rx_len:
+                if self.frame_state == 3 and self.matcher is None:
+                    # Copy as much of the payload as is here in one go
+                    count = min(self.frame_remaining, self.rx_len - self.rx_pos)
+                    room = min(count, len(self.payload) - self.payload_len)
+                    if room > 0:
+                        end = self.payload_len + room
+                        self.payload_mv[self.payload_len:end] = self.rx_mv[self.rx_pos:self.rx_pos + room]
+                        self.payload_len += room
+                    self.rx_pos += count
+                    self.frame_remaining -= count
+                    if self.frame_remaining == 0 and self.FrameDone():
+                        return
+                    continue
+                byte = buf[self.rx_pos]
+                self.rx_pos += 1
+                matched = False
+                if self.matcher is not None:
+                    # Keep the start of the response, that's where the interesting part is
+                    response = self.response
+                    if self.response_len < len(response):
+                        response[self.response_len] = byte
+                        self.response_len += 1
+                    token = self.matcher.Feed(byte)
+                    if token >= 0:
+                        # The response only becomes a string if it's asked for, see Response
+                        self.result = self.matcher.names[token] if token <= 1 else "ERROR"
+                        self.matcher = None
+                        matched = True
+                if self.ParseFrame(byte) or matched:
+                    return
+
+    # Runs one byte through the frame parser, returns True if it completed a message for the inbox
+    def ParseFrame(self, byte: int):
+        state = self.frame_state
+        if state == 3:
+            if self.payload_len < len(self.payload):
+                self.payload[self.payload_len] = byte
+                self.payload_len += 1
+            self.frame_remaining -= 1
+            return self.frame_remaining == 0 and self.FrameDone()
+        if state == 0:
+            if self.frame_matcher.Feed(byte) == 0:
+                self.frame_state = 1
+                self.frame_number = 0
+        elif 48 <= byte <= 57:
+            self.frame_number = self.frame_number * 10 + byte - 48
+        elif byte == 44 and state == 1:
+            # ",", link number done, length next
+            self.frame_link = self.frame_number
+            self.frame_number = 0
+            self.frame_state = 2
+        elif byte == 58:
+            # ":", payload follows (no link number when not multiplexing)
+            if state == 1:
+                self.frame_link = 0
+            self.frame_remaining = self.frame_number
+            self.payload_len = 0
+            self.frame_state = 3
+            if self.frame_remaining == 0:
+                return self.FrameDone()
+        else:
+            # Not a frame header after all
+            self.frame_state = 0
+            self.frame_matcher.Reset()
+        return False
+
+    # Ends a frame, messages from the server on link 0 go to the inbox if it's free
+    # Returns True if the frame went to the inbox
+    def FrameDone(self):
+        self.frame_state = 0
+        if self.frame_link != 0 or self.inbox_len >= 0:
+            return False
+        self.inbox_mv[0:self.payload_len] = self.payload_mv[0:self.payload_len]
+        self.inbox_len = self.payload_len
+        return True
+
+    # Returns the next message from the server, or None if there isn't one yet
+    # Binary messages come back as a memoryview of the inbox rather than a string, the inbox
+    # is kept for them until the next call. With StaticBuffers orders and programs come back as
+    # the whole inbox, inbox_len long, for InboxReceived.
+    def ReadMessage(self):
+        if self.inbox_taken:
+            self.inbox_len = -1
+            self.inbox_taken = False
+        if self.inbox_len < 0:
+            self.Pump()
+            if self.inbox_len < 0:
+                return None
+        length = self.inbox_len
+        self.message_time = running_time()
+        if StaticBuffers and CooperativeTasks and Assigned and not InSetupMode:
+            self.inbox_taken = True
+            return self.inbox_mv
+        if length > 0 and self.inbox[0] & 0xF0 == 0xB0:
+            self.inbox_taken = True
+            return self.inbox_mv[0:length]
+        self.inbox_len = -1
+        return str(self.inbox_mv[0:length], "UTF-8")
 
     # Attempts to empty any data left in the serial buffer
     def EmptySerialBuffer(self):
+        self.rx_pos = self.rx_len = 0
         ser_buffer = uart.read()
         while not(ser_buffer is None) and len(ser_buffer) > 0:
             ser_buffer = uart.read()
 
+# Incrementally matches several tokens against a byte stream in one pass
+# Each token keeps a KMP failure table so partial matches survive any chunking of the input
+class ATMatcher:
+    def __init__(self, tokens):
+        self.names = tokens
+        self.tokens = [bytes(token, "UTF-8") for token in tokens]
+        self.fail = [self.FailTable(token) for token in self.tokens]
+        self.state = [0] * len(self.tokens)
+
+    @staticmethod
+    def FailTable(token):
+        table = [0] * len(token)
+        k = 0
+        for i in range(1, len(token)):
+            while k > 0 and token[i] != token[k]:
+                k = table[k - 1]
+            if token[i] == token[k]:
+                k += 1
+            table[i] = k
+        return table
+
+    def Reset(self):
+        for i in range(len(self.state)):
+            self.state[i] = 0
+
+    # Feeds one byte, returns the index of the first token it completes or -1
+    def Feed(self, byte):
+        state = self.state
+        for i in range(len(self.tokens)):
+            token = self.tokens[i]
+            k = state[i]
+            while k > 0 and byte != token[k]:
+                k = self.fail[i][k - 1]
+            if byte == token[k]:
+                k += 1
+            if k == len(token):
+                state[i] = 0
+                return i
+            state[i] = k
+        return -1
+
+# Writes a request to the UART in pieces, bytes as they are and numbers formatted into a preallocated
+# buffer, so nothing has to be built on the heap. Started without sending, it only adds up the length.
+class UARTWriter:
+    def __init__(self):
+        # Enough digits for any 32 bit number and its sign, and a view of the last n of them for every n
+        self.digits = bytearray(11)
+        self.tails = [memoryview(self.digits)[11 - count:] for count in range(12)]
+        self.sending = False
+        self.length = 0
+
+    def Start(self, sending: bool):
+        self.sending = sending
+        self.length = 0
+
+    def Put(self, part):
+        if self.sending:
+            uart.write(part)
+        self.length += len(part)
+
+    def PutInt(self, value: int):
+        digits = self.digits
+        index = 11
+        negative = value < 0
+        if negative:
+            value = -value
+        while True:
+            index -= 1
+            digits[index] = 48 + value % 10
+            value //= 10
+            if value == 0:
+                break
+        if negative:
+            index -= 1
+            digits[index] = 45
+        self.Put(self.tails[11 - index])
+
+# Checks on the link to the server and gets it back after a failure
+# Each failed try waits a bit longer than the last, up to LinkBackoffMax, so robots that lost the
+# network don't all hammer the access point. Recovery escalates from reopening the connection to
+# rejoining the network and then restarting the module. Every incident's recovery time is kept.
+class LinkManager:
+    def __init__(self, wifi):
+        self.wifi = wifi
+        # Module status from the last check: 2 has an IP, 3 connected, 4 disconnected, 5 not joined
+        self.status = 0
+        self.last_probe = 0
+        # When the current incident started, -1 if there isn't one, the tries that failed in it
+        # and how far the recovery has escalated
+        self.incident_start = -1
+        self.failures = 0
+        self.escalation = 0
+        self.tier = 0
+        # The last few incidents: recovery time in ms and the highest tier used, 1 reopen, 2 rejoin, 3 restart
+        self.recovery_ms = [0] * 8
+        self.recovery_tier = bytearray(8)
+        self.incidents = 0
+
+    # Steps of asking the module how its link is
+    def ProbeSteps(self):
+        wifi = self.wifi
+        yield from wifi.CommandSteps("AT+CIPSTATUS", "OK")
+        self.last_probe = running_time()
+        response = wifi.Response()
+        index = response.find("STATUS:")
+        if index < 0 or index + 7 >= len(response):
+            self.status = 0
+            return
+        self.status = ord(response[index + 7]) - 48
+        if response.find("+CIPSTATUS:1,") < 0:
+            # The server closed link 1 or it was lost with the network
+            wifi.link_open = False
+
+    # Steps of the idle check, starts recovering right away if the network is gone
+    def CheckSteps(self):
+        yield from self.ProbeSteps()
+        if self.status == 5 or self.status == 0:
+            yield from self.RecoverSteps()
+        elif self.incident_start >= 0:
+            self.Recovered()
+
+    # Steps of recovering after a failed try, escalating with each one that fails
+    def RecoverSteps(self):
+        wifi = self.wifi
+        if self.incident_start < 0:
+            self.incident_start = running_time()
+            self.failures = 0
+            self.escalation = 0
+            self.tier = 0
+        self.failures += 1
+        self.escalation += 1
+        yield min(LinkBackoffMax, LinkBackoff << min(self.failures - 1, 6))
+        yield from self.ProbeSteps()
+        if self.escalation >= LinkRestartAfter:
+            # Nothing else worked, start the module over and join again in steps. The server still
+            # knows the robot, so it isn't registered again.
+            self.tier = 3
+            self.escalation = 0
+            display.show(Image.SAD)
+            wifi.link_open = False
+            yield from wifi.CommandSteps("AT+RST", "ready", 5000)
+            yield 1000
+            yield from wifi.CommandSteps("AT+CWMODE=1", "OK")
+            yield from wifi.CommandSteps(JoinString, "OK", 15000)
+            yield from wifi.CommandSteps("AT+CIPMUX=1", "OK")
+            yield from wifi.CommandSteps("AT+CIPSERVER=1,8080", "OK")
+        elif self.escalation >= LinkRejoinAfter or self.status == 5:
+            # Not on the network, or reopening didn't help
+            self.tier = max(self.tier, 2)
+            if self.escalation < LinkRejoinAfter:
+                self.escalation = LinkRejoinAfter
+            yield from wifi.CommandSteps(JoinString, "OK", 15000)
+            yield from wifi.CommandSteps("AT+CIPMUX=1", "OK")
+            yield from wifi.CommandSteps("AT+CIPSERVER=1,8080", "OK")
+        else:
+            # Still on the network, the next try reopens the connection
+            self.tier = max(self.tier, 1)
+            yield from wifi.CommandSteps("AT+CIPMUX=1", "OK")
+            yield from wifi.CommandSteps("AT+CIPSERVER=1,8080", "OK")
+
+    # Ends the current incident, if there is one, and keeps how long it took
+    def Recovered(self):
+        if self.incident_start < 0:
+            return
+        slot = self.incidents % len(self.recovery_ms)
+        self.recovery_ms[slot] = running_time() - self.incident_start
+        self.recovery_tier[slot] = self.tier
+        self.incidents += 1
+        self.incident_start = -1
+
+# Runs generator tasks in turn, each one yields how many ms it wants to wait before its next step
+# Keeps how many steps each task took and the total and longest step time in µs
+class Scheduler:
+    def __init__(self):
+        # [name, task, wake time, steps, total µs, longest µs]
+        self.tasks = []
+
+    def Add(self, name: str, task):
+        self.tasks.append([name, task, 0, 0, 0, 0])
+
+    # Runs the tasks until the robot stops running, sleeping when none of them are due
+    def Run(self, bot):
+        tasks = self.tasks
+        while bot.running:
+            now = running_time()
+            wake = now + 50
+            for task in tasks:
+                if task[2] <= now:
+                    start = ticks_us()
+                    delay = next(task[1])
+                    spent = ticks_diff(ticks_us(), start)
+                    task[3] += 1
+                    task[4] += spent
+                    if spent > task[5]:
+                        task[5] = spent
+                    now = running_time()
+                    task[2] = now + delay
+                if task[2] < wake:
+                    wake = task[2]
+            if ReportHeap:
+                bot.HeapSample()
+            if wake > now:
+                sleep(wake - now)
+
 class MaqueenPlus:
     version = None
     running = False
     wheelDiameter = 44
+    # Encoder counts per wheel rotation
+    ticksPerRotation = 90
 
     PID = False
 
     wifi = None
 
     def __init__(self):
-        self.I2CInit()
-        self.RGB(Color, Color)
-        self.PID = self.getPID()
+        # Preallocated for getSensors
+        self.sensor_reg = bytearray([0x00])
+        self.sensors = [0, 0, 0, 0]
+        # Preallocated for setMotors, setLMotor, setRMotor and clearDistance, by register
+        self.motors_buf = bytearray([0x00, 0, 0, 0, 0])
+        self.left_buf = bytearray([0x00, 0, 0])
+        self.right_buf = bytearray([0x02, 0, 0])
+        self.clear_bufs = {ALL: bytearray([0x04, 0, 0, 0]), LEFT: bytearray([0x04, 0]), RIGHT: bytearray([0x06, 0])}
+        # Free heap: least seen since the move started, collections the garbage collector ran on its
+        # own meanwhile, and the last reading, which a collection makes jump up
+        self.heap_low = 0
+        self.heap_gcs = 0
+        self.heap_last = 0
+        # Preallocated for getLineBits
+        self.line_reg = bytearray([0x1D])
+        # Where each wheel of a straight move stops, and which wheels (bit 0 left, bit 1 right) have
+        # had their stop moved onto a grid line
+        self.stops = [0, 0]
+        self.snapped = 0
+        # Learned by profiled moves: cruise speed in ticks/ms and ticks coasted per unit of wheel speed
+        self.cruise_rate = 0.07
+        self.coast = 0.04
+        # Last move: [planned ms, actual ms, planned ticks, left ticks, right ticks]
+        self.move_stats = [0, 0, 0, 0, 0]
+        # Set by the button for the motion task
+        self.calibrate = False
+        # Speeds measured by calibration for the left and right wheel
+        self.measured = [0, 0]
+        # Stored settings record, the slot and sequence number it has, and a scratch record for writing
+        self.store = bytearray(StoreSize)
+        self.store_slot = -1
+        self.store_seq = 0
+        self.record = bytearray(StoreSize)
+        # Settings JSON for setup mode, its ETag and the reply used when the server already has it
+        self.settings_json = None
+        self.settings_etag = -1
+        self.settings_current = None
+        # PWM last set for the left and right motors
+        self.motor_pwm = [0, 0]
+        # Direction each wheel last drove in, the encoders count up either way
+        self.wheel_dir = [Dir.CW, Dir.CW]
+        # Dead reckoned pose, x and y in mm and heading in radians counterclockwise, and the encoder
+        # counts since they were last cleared that are already in it
+        self.pose = [0.0, 0.0, 0.0]
+        self.odo_ticks = [0, 0]
+        # Encoder trace, five values per sample: ms since the move started, left and right ticks, then
+        # for each wheel the PWM set times 256 plus the speed it reports. A move starts with a marker
+        # sample of 0xFFFF, the kind of move (0 straight, 1 turn), its magnitude and direction, and
+        # ends with a sample taken once it has stopped. Samples taken so far and when the current
+        # move started.
+        self.trace = array("H", [0] * (TraceSize * 5)) if TraceMotion else None
+        self.trace_count = 0
+        self.trace_start = 0
+        # When the board was up and the settings loaded, in ms since reset
+        self.board_ready = 0
+        # The board is brought up while the Wi-Fi module is busy starting
         self.wifi = WiFi(SSID, WPA_Pass, self)
 
     def forever(self):
         global InSetupMode
         self.running = True
+        if CooperativeTasks:
+            self.scheduler = Scheduler()
+            self.scheduler.Add("intake", self.wifi.IntakeTask())
+            self.scheduler.Add("motion", self.MotionTask())
+            self.scheduler.Add("network", self.wifi.NetworkTask())
+            self.scheduler.Add("ui", self.UITask())
+            self.scheduler.Run(self)
+            return
         while self.running:
             if button_a.was_pressed():
                 self.CalibrateSpeed()
-            received = ""
-            receive_buf = uart.read()
-            # Check for data on the serial port
-            if not(receive_buf is None):
-                while not(receive_buf is None) and len(receive_buf) > 0:
-                    received += str(receive_buf, "UTF-8")
-                    receive_buf = uart.read()
-                    sleep(2)
-                # Check if it's from the server
-                if "+IPD,0," in received:
-                    if not InSetupMode:
-                        # Send acknowledgment
-                        self.wifi.SendCommand("AT+CIPSEND=0,2", "OK")
-                        self.wifi.SendCommand("OK", "CLOSED")
-                        self.wifi.EmptySerialBuffer()
-                    # Process received message
-                    self.wifi.MessageReceived(received)
-            sleep(20)
+            # Check for a message from the server
+            message = self.wifi.ReadMessage()
+            if message is not None:
+                if not InSetupMode:
+                    # Send acknowledgment
+                    self.wifi.SendCommand("AT+CIPSEND=0,2", "OK")
+                    self.wifi.SendCommand("OK", "CLOSED")
+                    self.wifi.AckSent()
+                # Process received message
+                self.wifi.MessageReceived(message)
+            else:
+                sleep(5)
+
+    # Runs queued moves one after another, each finished one goes to the network task to report
+    # while the next one is already driving
+    def MotionTask(self):
+        wifi = self.wifi
+        queue = wifi.queue
+        while True:
+            if self.calibrate:
+                self.calibrate = False
+                yield from self.CalibrateSteps()
+            elif wifi.queue_count > 0:
+                slot = wifi.NextMove()
+                # Check for reset command
+                if queue[slot + 2] == 2:
+                    wifi.ResetOrder(queue[slot + 3], queue[slot + 4])
+                    continue
+                # The slot can be reused once the move starts
+                kind = queue[slot + 3]
+                number = queue[slot + 4]
+                entry = queue[slot + 5]
+                wifi.Stamp(entry, Stage.MOVING)
+                self.HeapStart()
+                yield from self.MoveSteps(queue[slot], queue[slot + 1])
+                wifi.Stamp(entry, Stage.STOPPED)
+                wifi.KeepStats(entry)
+                if kind != ReportKind.NONE:
+                    wifi.PushReport(kind, number, entry)
+                # Let the robot settle before the next move, the report waits longer than this
+                # before it's sent so it gets the pose from where the robot came to rest
+                yield from self.SettleSteps()
+                wifi.KeepPose(entry)
+                wifi.KeepHeap(entry)
+            else:
+                yield 10
+
+    # Watches the button, a press asks the motion task for a calibration run
+    def UITask(self):
+        while True:
+            if button_a.was_pressed():
+                self.calibrate = True
+            yield 50
+
+    # Starts watching the free heap for a move
+    def HeapStart(self):
+        self.heap_last = self.heap_low = gc.mem_free()
+        self.heap_gcs = 0
+
+    # Notes the free heap, the garbage collector ran if it went up
+    def HeapSample(self):
+        free = gc.mem_free()
+        if free > self.heap_last:
+            self.heap_gcs += 1
+        if free < self.heap_low:
+            self.heap_low = free
+        self.heap_last = free
+
+    # Waits for the wheels to stop after a move, at least 100 ms and at most 300 ms
+    def SettleSteps(self):
+        start = running_time()
+        yield 100
+        sensors = self.ReadSensors()
+        while (sensors[2] or sensors[3]) and running_time() - start < 300:
+            yield 10
+            sensors = self.ReadSensors()
+
+    # Runs the steps of a motion, sleeping for as long as each one asks
+    def Drive(self, steps):
+        for delay in steps:
+            sleep(delay)
+
+    # Steps of one move order
+    def MoveSteps(self, Movement: int, Magnitude: int):
+        # Only straight moves record how they went
+        self.RecordMove(0, 0, 0, 0, 0)
+        if Movement <= 3:
+            # Standard movement
+            if Magnitude > 0:
+                if Movement == 0:
+                    # Left
+                    yield from self.TurnSteps(Magnitude, 1)
+                elif Movement == 1:
+                    # Right
+                    yield from self.TurnSteps(Magnitude, 0)
+                elif Movement == 2:
+                    # Forward
+                    yield from self.LinearSteps(Magnitude, 0, False)
+                elif Movement == 3:
+                    # Backup
+                    yield from self.LinearSteps(Magnitude, 1, False)
+            else:
+                # Robot trying to move, but is blocked
+                display.show(Image.CONFUSED)
+                yield from self.SoundSteps(Sound.SAD)
+        # Non-movment command
+        elif Movement == 4:
+            # Damage taken
+            display.show(Image.SURPRISED)
+            yield from self.SoundSteps(Sound.SAD)
+
+    # Plays a sound without blocking, waiting in steps until it's done
+    def SoundSteps(self, sound):
+        audio.play(sound, False)
+        while audio.is_playing():
+            yield 20
 
     def getVersion(self):
         i2c.write(0x10, bytearray([0x32]))
@@ -334,28 +1505,67 @@ class MaqueenPlus:
         return i2c.read(0x10, 1)
 
     def I2CInit(self):
+        self.Drive(self.I2CSteps())
+
+    # Steps of I2CInit, waits for the board to answer with its version
+    def I2CSteps(self):
         display.show(Image.NO)
         i2c.scan()
         while not self.version:
-            sleep(1000)
-            self.version = self.getVersion()
+            try:
+                i2c.write(I2caddr, bytearray([0x32]))
+                yield 100
+                self.version = i2c.read(I2caddr, 1)
+            except OSError:
+                # Board hasn't started yet
+                yield 100
         display.show(Image.YES)
 
+    # Steps of bringing up the board and loading the settings
+    def StartSteps(self):
+        yield from self.I2CSteps()
+        self.LoadSettings(True)
+        self.RGB(Color, Color)
+        self.PID = self.getPID()
+        if self.PID != OnboardPID:
+            self.togglePID()
+        self.board_ready = running_time()
+
     def RGB(self, colorL, colorR):
         buf = bytearray([0x0b, colorL, colorR])
         i2c.write(I2caddr, buf)
 
     def setMotors(self, speedL, speedR, dirL, dirR):
-        buf = bytearray([0x00, dirL, int(speedL), dirR, int(speedR)])
+        buf = self.motors_buf
+        buf[1] = dirL
+        buf[2] = int(speedL)
+        buf[3] = dirR
+        buf[4] = int(speedR)
         i2c.write(I2caddr, buf)
+        self.motor_pwm[0] = int(speedL)
+        self.motor_pwm[1] = int(speedR)
+        if speedL:
+            self.wheel_dir[0] = dirL
+        if speedR:
+            self.wheel_dir[1] = dirR
 
     def setLMotor(self, speedL, dirL):
-        buf = bytearray([0x00, dirL, int(speedL)])
+        buf = self.left_buf
+        buf[1] = dirL
+        buf[2] = int(speedL)
         i2c.write(I2caddr, buf)
+        self.motor_pwm[0] = int(speedL)
+        if speedL:
+            self.wheel_dir[0] = dirL
 
     def setRMotor(self, speedR, dirR):
-        buf = bytearray([0x02, dirR, int(speedR)])
+        buf = self.right_buf
+        buf[1] = dirR
+        buf[2] = int(speedR)
         i2c.write(I2caddr, buf)
+        self.motor_pwm[1] = int(speedR)
+        if speedR:
+            self.wheel_dir[1] = dirR
 
     def stopAll(self):
         self.setMotors(0, 0, 0, 0)
@@ -381,10 +1591,14 @@ class MaqueenPlus:
         elif motor == 1:
             return round(motorSpeed_d[3])
 
+    # Counts kept by the encoders go into the pose before they're cleared
     def clearDistance(self, motor = ALL):
-        addr = 0x04 if motor in (ALL, LEFT) else 0x06
-        buf = bytearray([addr, 0, 0, 0]) if motor is ALL else bytearray([addr, 0])
-        i2c.write(0x10, buf)
+        self.Odometry()
+        if motor in (ALL, LEFT):
+            self.odo_ticks[0] = 0
+        if motor in (ALL, RIGHT):
+            self.odo_ticks[1] = 0
+        i2c.write(0x10, self.clear_bufs[motor])
 
     def getRotations(self, motor_side):
         i2c.write(0x10, bytearray([0x04]))
@@ -396,24 +1610,134 @@ class MaqueenPlus:
             distance = (((buf[2] <<8 ) | buf[3]) * 10)/900
         return round(distance, 3)
 
+    # Reads both encoders and both wheel speeds in one burst from register 0x00
+    # Returns [left ticks, right ticks, left speed, right speed], the same list is reused every call
+    def getSensors(self):
+        sensors = self.ReadSensors()
+        if self.trace is not None:
+            pwm = self.motor_pwm
+            self.TraceSample(min(running_time() - self.trace_start, 0xFFFE), sensors[0], sensors[1],
+                             (pwm[0] << 8) | sensors[2], (pwm[1] << 8) | sensors[3])
+        return sensors
+
+    # getSensors without adding to the encoder trace
+    def ReadSensors(self):
+        i2c.write(I2caddr, self.sensor_reg)
+        buf = i2c.read(I2caddr, 8)
+        sensors = self.sensors
+        sensors[0] = (buf[4] << 8) | buf[5]
+        sensors[1] = (buf[6] << 8) | buf[7]
+        sensors[2] = buf[1]
+        sensors[3] = buf[3]
+        return sensors
+
+    # Adds one sample to the encoder trace, overwriting the oldest once it's full
+    def TraceSample(self, time: int, left: int, right: int, left_speed: int, right_speed: int):
+        trace = self.trace
+        index = (self.trace_count % TraceSize) * 5
+        trace[index] = time
+        trace[index + 1] = left
+        trace[index + 2] = right
+        trace[index + 3] = left_speed
+        trace[index + 4] = right_speed
+        self.trace_count += 1
+
+    # Marks the start of a move in the encoder trace, after where the last one ended up
+    def TraceStart(self, kind: int, magnitude: int, direction: int):
+        if self.trace is not None:
+            if self.trace_count:
+                self.getSensors()
+            self.trace_start = running_time()
+            self.TraceSample(0xFFFF, kind, magnitude, direction, 0)
+
+    # Adds the wheel travel since the last call to the pose and returns it. Each stretch is taken
+    # as an arc. How far apart the wheels are comes from TurnDistance being a quarter turn, so
+    # a turn counts as whatever the robot is tuned to turn.
+    def Odometry(self):
+        sensors = self.ReadSensors()
+        ticks = self.odo_ticks
+        scale = PI * self.wheelDiameter / self.ticksPerRotation
+        left = (sensors[0] - ticks[0]) * scale
+        right = (sensors[1] - ticks[1]) * scale
+        ticks[0] = sensors[0]
+        ticks[1] = sensors[1]
+        if self.wheel_dir[0] == Dir.CCW:
+            left = -left
+        if self.wheel_dir[1] == Dir.CCW:
+            right = -right
+        pose = self.pose
+        turned = (right - left) / (4 * TurnDistance * self.wheelDiameter)
+        heading = pose[2] + turned / 2
+        pose[0] += (left + right) / 2 * cos(heading)
+        pose[1] += (left + right) / 2 * sin(heading)
+        pose[2] += turned
+        return pose
+
+    # Starts the pose over where the robot is now
+    def ResetPose(self):
+        self.Odometry()
+        pose = self.pose
+        pose[0] = 0.0
+        pose[1] = 0.0
+        pose[2] = 0.0
+
     # Whatever units wheelDiameter is in
     def getDistance(self, motor_side):
         return self.getRotations(motor_side) * self.wheelDiameter * PI
 
+    # Returns the line sensors as bits, L3 is 0x01 through R3 0x20, without building a list
+    def getLineBits(self):
+        i2c.write(I2caddr, self.line_reg)
+        return i2c.read(I2caddr, 1)[0]
+
     # Returns [L3, L2, L1, R1, R2, R3]
     def getLine(self):
-        i2c.write(0x10, bytearray([0x1D]))
-        line_d = struct.unpack('b', i2c.read(I2caddr, 1))
-        return [(line_d[0] & 0x01) == 1, (line_d[0] & 0x02) == 2, (line_d[0] & 0x04) == 4,
-                (line_d[0] & 0x08) == 8, (line_d[0] & 0x10) == 16, (line_d[0] & 0x20) == 32]
+        line_d = self.getLineBits()
+        return [(line_d & 0x01) == 1, (line_d & 0x02) == 2, (line_d & 0x04) == 4,
+                (line_d & 0x08) == 8, (line_d & 0x10) == 16, (line_d & 0x20) == 32]
+
+    # Sets where both wheels of a straight move stop, past the target while looking for a grid line
+    def StopAt(self, total, snap: bool):
+        stops = self.stops
+        stops[0] = total + SnapWindow if snap else total
+        stops[1] = stops[0]
+        self.snapped = 0 if snap else 3
+
+    # Moves each wheel's stop onto the grid line once the sensors on its side see one near the
+    # target. A line across the path is under at least two of a side's three sensors at once, a line
+    # running alongside is only ever under one. Returns how many ms to wait before reading again, or
+    # 0 outside the snap window.
+    def Snap(self, sensors, total):
+        if self.snapped == 3 or max(sensors[0], sensors[1]) < total - SnapWindow:
+            return 0
+        bits = self.getLineBits()
+        for wheel in (0, 1):
+            flag = 1 << wheel
+            side = (bits >> (3 * wheel)) & 0x07
+            # Clearing the lowest bit leaves another one if two or more are set
+            if not self.snapped & flag and sensors[wheel] >= total - SnapWindow and side & (side - 1):
+                self.stops[wheel] = sensors[wheel] + SnapOffset
+                self.snapped |= flag
+        return SnapPoll
 
     # Move forward or backward
     def LinearMove(self, Magnitude: int, MoveDirection: int, Calibrate: bool):
+        self.Drive(self.LinearSteps(Magnitude, MoveDirection, Calibrate))
+
+    # Steps of LinearMove
+    def LinearSteps(self, Magnitude: int, MoveDirection: int, Calibrate: bool):
         global Right_Forward_Speed, Right_Backward_Speed, Left_Forward_Speed, Left_Backward_Speed
+        self.TraceStart(0, Magnitude, MoveDirection)
+        if OnboardPID and not Calibrate:
+            yield from self.PIDSteps(Magnitude, MoveDirection)
+            return
+        if ProfiledMotion and not Calibrate:
+            yield from self.ProfiledSteps(Magnitude, MoveDirection)
+            return
         # Clear motor distance
         self.clearDistance(ALL)
-        # Calculate total move disatnce
-        total = LinearDistance + ((LinearDistance + 0.18) * (Magnitude - 1))
+        # Calculate total move disatnce, in encoder ticks
+        total = (LinearDistance + ((LinearDistance + 0.18) * (Magnitude - 1))) * self.ticksPerRotation
         # Calculate upper-bound of move time
         total_time = LinearTime * Magnitude
         # Set initial motor speeds
@@ -425,7 +1749,7 @@ class MaqueenPlus:
         # Set direction of move
         direction = Dir.CW
         # Wait for clear disatance to finish
-        sleep(50)
+        yield 50
 
         left_done = False
         right_done = False
@@ -462,21 +1786,24 @@ class MaqueenPlus:
                 else:
                     left_motor += Left_Forward_Speed - left_motor
             self.setMotors(left_motor, right_motor, direction, direction)
-            sleep(20)
+            yield 20
         # Pause if calibrating to let motor speed stabilize
         if (Calibrate):
-            sleep(350)
+            yield 350
 
         # This loop will move the requested distance or exit on an upper-bound timeout
+        self.StopAt(total, SnapToGrid and not Calibrate)
+        stops = self.stops
+        sensors = self.sensors
         while ((running_time() - time) <= total_time):
-            # Get distance traveled
-            left_distance = float(self.getRotations(LEFT))
-            right_distance = float(self.getRotations(RIGHT))
+            # Get distance traveled, and wheel speeds, in one read
+            sensors = self.getSensors()
+            poll = self.Snap(sensors, total)
             # Check if move is done for each wheel
-            if (not left_done and left_distance >= total):
+            if (not left_done and sensors[0] >= stops[0]):
                 self.setLMotor(0, 0)
                 left_done = True
-            if (not right_done and right_distance >= total):
+            if (not right_done and sensors[1] >= stops[1]):
                 self.setRMotor(0, 0)
                 right_done = True
             # Check if all motors are done moving
@@ -485,8 +1812,8 @@ class MaqueenPlus:
 
             # If calibrating, check wheel speeds as well
             if (Calibrate):
-                left = self.motorSpeed(LEFT)
-                right = self.motorSpeed(RIGHT)
+                left = sensors[2]
+                right = sensors[3]
                 if (not right_done and not left_done):
                     # Check if right motor is going to fast or too slow and adjust
                     if (right - LinearSpeedTarget > 5):
@@ -523,123 +1850,502 @@ class MaqueenPlus:
                         elif MoveDirection == 1:
                             Left_Backward_Speed = left_motor
                 # Pause to let new speed, if any, stabilize
-                sleep(20)
+                yield 20
+            else:
+                yield poll or 10
         self.stopAll()
+        self.RecordMove(0, running_time() - time, total, sensors[0], sensors[1])
+
+    # Profiled version of LinearMove for normal game moves, plans ramp, cruise and braking
+    # phases from the distance and predicts each wheel's stopping point from its measured speed
+    def ProfiledSteps(self, Magnitude: int, MoveDirection: int):
+        self.clearDistance(ALL)
+        total = (LinearDistance + ((LinearDistance + 0.18) * (Magnitude - 1))) * self.ticksPerRotation
+        total_time = LinearTime * Magnitude
+        direction = Dir.CW
+        cruise = (Left_Forward_Speed, Right_Forward_Speed)
+        if MoveDirection == 1:
+            direction = Dir.CCW
+            cruise = (Left_Backward_Speed, Right_Backward_Speed)
+        # Plan the move from the cruise speed seen on previous moves
+        rate = self.cruise_rate
+        ramp_ticks = rate * ProfileRamp / 2
+        brake_ticks = rate * rate / (2 * ProfileBrake)
+        if ramp_ticks + brake_ticks > total:
+            # Too short to reach cruise speed
+            planned = (ProfileRamp + rate / ProfileBrake) * sqrt(total / (ramp_ticks + brake_ticks))
+        else:
+            planned = ProfileRamp + (total - ramp_ticks - brake_ticks) / rate + rate / ProfileBrake
+        # Wait for clear disatance to finish
+        yield 50
+
+        motors = [0, 0]
+        cut_ticks = [-1, -1]
+        cut_speed = [0, 0]
+        self.StopAt(total, SnapToGrid)
+        stops = self.stops
+        # Start and end of the cruise phase, to measure cruise speed
+        cruise_start = -1
+        cruise_from = 0
+        cruise_end = 0
+        cruise_to = 0
+        time = running_time()
+        while True:
+            elapsed = running_time() - time
+            if elapsed > total_time:
+                break
+            sensors = self.getSensors()
+            poll = self.Snap(sensors, total)
+            changed = False
+            for wheel in (0, 1):
+                if cut_ticks[wheel] >= 0:
+                    continue
+                ticks = sensors[wheel]
+                remaining = stops[wheel] - ticks
+                # Cut the motor once it would coast the rest of the way
+                if remaining <= sensors[wheel + 2] * self.coast:
+                    motors[wheel] = 0
+                    cut_ticks[wheel] = ticks
+                    cut_speed[wheel] = sensors[wheel + 2]
+                    changed = True
+                    continue
+                level = min(1, elapsed / ProfileRamp, sqrt(2 * ProfileBrake * remaining) / rate)
+                if wheel == 0 and level == 1:
+                    if cruise_start < 0:
+                        cruise_start = elapsed
+                        cruise_from = ticks
+                    cruise_end = elapsed
+                    cruise_to = ticks
+                speed = min(cruise[wheel], max(ProfileMinSpeed, int(cruise[wheel] * level)))
+                if speed != motors[wheel]:
+                    motors[wheel] = speed
+                    changed = True
+            if changed:
+                self.setMotors(motors[0], motors[1], direction if motors[0] else 0, direction if motors[1] else 0)
+            if cut_ticks[0] >= 0 and cut_ticks[1] >= 0:
+                break
+            yield poll or 10
+        self.stopAll()
+
+        # Let the wheels coast to a stop to see where they ended up
+        settle = running_time()
+        sensors = self.getSensors()
+        while (sensors[2] > 5 or sensors[3] > 5) and running_time() - settle < 150:
+            yield 10
+            sensors = self.getSensors()
+        # Learn how far each wheel coasts for its speed, and the cruise speed
+        for wheel in (0, 1):
+            if cut_speed[wheel] > 0:
+                self.coast += ((sensors[wheel] - cut_ticks[wheel]) / cut_speed[wheel] - self.coast) * 0.5
+        if cruise_end - cruise_start >= 50:
+            self.cruise_rate += ((cruise_to - cruise_from) / (cruise_end - cruise_start) - self.cruise_rate) * 0.5
+        self.RecordMove(planned, running_time() - time, total, sensors[0], sensors[1])
+
+    # Version of LinearMove for when the board runs its PID controller, sets both wheels to the target
+    # speed once and cuts each motor when it would coast onto the target. Between reads it sleeps
+    # for half the time the wheels should take to get there, so the bus is left alone while cruising.
+    def PIDSteps(self, Magnitude: int, MoveDirection: int):
+        self.clearDistance(ALL)
+        total = (LinearDistance + ((LinearDistance + 0.18) * (Magnitude - 1))) * self.ticksPerRotation
+        total_time = LinearTime * Magnitude
+        direction = Dir.CCW if MoveDirection == 1 else Dir.CW
+        rate = self.cruise_rate
+        # Wait for clear disatance to finish
+        yield 50
+        motors = [LinearSpeedTarget, LinearSpeedTarget]
+        cut_ticks = [-1, -1]
+        cut_speed = [0, 0]
+        self.StopAt(total, SnapToGrid)
+        stops = self.stops
+        self.setMotors(motors[0], motors[1], direction, direction)
+        time = running_time()
+        sensors = self.sensors
+        while running_time() - time <= total_time:
+            sensors = self.getSensors()
+            poll = self.Snap(sensors, total)
+            changed = False
+            nearest = total
+            for wheel in (0, 1):
+                if cut_ticks[wheel] >= 0:
+                    continue
+                remaining = stops[wheel] - sensors[wheel] - sensors[wheel + 2] * self.coast
+                if remaining <= 0:
+                    motors[wheel] = 0
+                    cut_ticks[wheel] = sensors[wheel]
+                    cut_speed[wheel] = sensors[wheel + 2]
+                    changed = True
+                elif remaining < nearest:
+                    nearest = remaining
+            if changed:
+                self.setMotors(motors[0], motors[1], direction if motors[0] else 0, direction if motors[1] else 0)
+            if cut_ticks[0] >= 0 and cut_ticks[1] >= 0:
+                break
+            if SnapToGrid and not poll:
+                # Wake up in time for the snap window
+                nearest = min(nearest, total - SnapWindow - max(sensors[0], sensors[1]))
+            yield poll or max(5, min(PIDPoll, int(nearest / rate / 2)))
+        self.stopAll()
+
+        # Let the wheels coast to a stop to see where they ended up
+        settle = running_time()
+        sensors = self.getSensors()
+        while (sensors[2] > 5 or sensors[3] > 5) and running_time() - settle < 150:
+            yield 10
+            sensors = self.getSensors()
+        for wheel in (0, 1):
+            if cut_speed[wheel] > 0:
+                self.coast += ((sensors[wheel] - cut_ticks[wheel]) / cut_speed[wheel] - self.coast) * 0.5
+        self.RecordMove(0, running_time() - time, total, sensors[0], sensors[1])
+
+    # Keeps the planned and actual time and distance of the last move
+    def RecordMove(self, planned, actual, total, left, right):
+        stats = self.move_stats
+        stats[0] = int(planned)
+        stats[1] = actual
+        stats[2] = int(total)
+        stats[3] = left
+        stats[4] = right
 
     # Turn (rotate) left or right
     def Turn(self, magnitude: int, direction: int):
-        for index in range(magnitude):
-            # Clear wheels distances and wait for it to complete
-            self.clearDistance(ALL)
-            sleep(50)
-            if direction == 0:
-                # Turn right, motor must move a bit faster since other wheel is stationary
-                self.setLMotor(Left_Forward_Speed + 15, Dir.CW)
-                # Trun wheel required distance
-                while float(self.getRotations(LEFT)) < TurnDistance:
-                    sleep(1)
-                self.stopAll()
-                # This clear is probably unnecessary since it was claered above, may remove
-                self.clearDistance(RIGHT)
-                sleep(50)
-                # Run other wheel backwards to complete turn
-                self.setRMotor(Right_Backward_Speed + 15, Dir.CCW)
-                while float(self.getRotations(RIGHT)) < TurnDistance:
-                    sleep(1)
-            elif direction == 1:
-                # Turn left, motor must move a bit faster since other wheel is stationary
-                self.setRMotor(Right_Forward_Speed + 15, Dir.CW)
-                while float(self.getRotations(RIGHT)) < TurnDistance:
-                    sleep(1)
-                self.stopAll()
-                # This clear is probably unnecessary since it was claered above, may remove
-                self.clearDistance(LEFT)
-                sleep(50)
-                # Run other wheel backwards to complete turn
-                self.setLMotor(Left_Backward_Speed + 15, Dir.CCW)
-                while float(self.getRotations(LEFT)) < TurnDistance:
-                    sleep(1)
+        self.Drive(self.TurnSteps(magnitude, direction))
+
+    # Steps of Turn
+    def TurnSteps(self, magnitude: int, direction: int):
+        self.TraceStart(1, magnitude, direction)
+        if PivotTurns:
+            # One continuous rotation for all the quarter turns
+            yield from self.PivotSteps(direction, magnitude)
+            return
+        # Each wheel turns once for all the quarter turns, without stopping and settling between quarters
+        turn = TurnDistance * self.ticksPerRotation * magnitude
+        if OnboardPID:
+            # The board holds the speed, the calibrated PWMs would be taken as speeds
+            speeds = (PIDTurnSpeed, PIDTurnSpeed, PIDTurnSpeed, PIDTurnSpeed)
+        else:
+            speeds = (Left_Forward_Speed + 15, Left_Backward_Speed + 15, Right_Forward_Speed + 15,
+                      Right_Backward_Speed + 15)
+        # Clear wheels distances and wait for it to complete
+        self.clearDistance(ALL)
+        yield 50
+        if direction == 0:
+            # Turn right, motor must move a bit faster since other wheel is stationary
+            self.setLMotor(speeds[0], Dir.CW)
+            # Trun wheel required distance
+            while self.getSensors()[0] < turn:
+                yield 5
+            self.stopAll()
+            # This clear is probably unnecessary since it was claered above, may remove
+            self.clearDistance(RIGHT)
+            yield 50
+            # Run other wheel backwards to complete turn
+            self.setRMotor(speeds[3], Dir.CCW)
+            while self.getSensors()[1] < turn:
+                yield 5
+        elif direction == 1:
+            # Turn left, motor must move a bit faster since other wheel is stationary
+            self.setRMotor(speeds[2], Dir.CW)
+            while self.getSensors()[1] < turn:
+                yield 5
             self.stopAll()
-            sleep(250)
+            # This clear is probably unnecessary since it was claered above, may remove
+            self.clearDistance(LEFT)
+            yield 50
+            # Run other wheel backwards to complete turn
+            self.setLMotor(speeds[1], Dir.CCW)
+            while self.getSensors()[0] < turn:
+                yield 5
+        self.stopAll()
+        yield 250
+
+    # Turns on the spot by a number of 90 degree quarters, both wheels run at once in opposite
+    # directions without stopping between quarters. Each wheel is stopped on its own when it's
+    # predicted to coast onto its target, and a wheel that gets ahead of the other is slowed so
+    # the robot turns about its center.
+    def PivotSteps(self, direction: int, quarters = 1):
+        self.clearDistance(ALL)
+        total = TurnDistance * self.ticksPerRotation * quarters
+        if direction == 0:
+            # Turn right, left wheel forward and right wheel backward
+            dirL = Dir.CW
+            dirR = Dir.CCW
+            base = (Left_Forward_Speed + 15, Right_Backward_Speed + 15)
+        else:
+            dirL = Dir.CCW
+            dirR = Dir.CW
+            base = (Left_Backward_Speed + 15, Right_Forward_Speed + 15)
+        if OnboardPID:
+            # The board evens out the wheels itself
+            base = (PIDTurnSpeed, PIDTurnSpeed)
+        # Wait for clear disatance to finish
+        yield 50
+        motors = [base[0], base[1]]
+        done = [False, False]
+        self.setMotors(motors[0], motors[1], dirL, dirR)
+        time = running_time()
+        while running_time() - time <= LinearTime * quarters:
+            sensors = self.getSensors()
+            lead = sensors[0] - sensors[1]
+            changed = False
+            for wheel in (0, 1):
+                if done[wheel]:
+                    continue
+                if total - sensors[wheel] <= sensors[wheel + 2] * self.coast:
+                    done[wheel] = True
+                    speed = 0
+                else:
+                    # Hold back the wheel that's ahead
+                    ahead = lead if wheel == 0 else -lead
+                    speed = max(base[wheel] // 2, base[wheel] - 3 * ahead) if ahead > 0 else base[wheel]
+                if speed != motors[wheel]:
+                    motors[wheel] = speed
+                    changed = True
+            if changed:
+                self.setMotors(motors[0], motors[1], dirL if motors[0] else 0, dirR if motors[1] else 0)
+            if done[0] and done[1]:
+                break
+            yield 5
+        self.stopAll()
 
     # Saves new move settings, optionally writing them to storage.
-    # If initialize is also true, will save a new file with the current settings
-    def SaveSettings(self, NewSettings: str, commit: bool, initialize = False):
-        global RobotName, LinearSpeedTarget, LinearTime, LinearDistance, TurnDistance, Color, Left_Forward_Speed, Left_Backward_Speed, Right_Forward_Speed, Right_Backward_Speed
+    # The calibrated wheel speeds are put in use too if they follow the color, as in settings.txt
+    # and the settings host/calibrate.py fits: left forward, left backward, right forward, right backward
+    def SaveSettings(self, NewSettings: str, commit: bool):
+        global Left_Forward_Speed, Left_Backward_Speed, Right_Forward_Speed, Right_Backward_Speed
         NewSettings = NewSettings[0:NewSettings.find(":")]
         # Assign new settings values
         settings = NewSettings.split(",")
-        RobotName = settings[0]
-        LinearSpeedTarget = int(settings[1])
-        LinearTime = int(settings[2])
-        LinearDistance = float(settings[3])
-        TurnDistance = float(settings[4])
-        Color = int(settings[5])
-        self.RGB(Color, Color)
+        self.UseSettings(settings[0], int(settings[1]), int(settings[2]), float(settings[3]), float(settings[4]),
+                         int(settings[5]))
 
-        # Load previous calibration settings on startup
-        if initialize:
+        if len(settings) >= 10:
             Left_Forward_Speed = int(settings[6])
             Left_Backward_Speed = int(settings[7])
             Right_Forward_Speed = int(settings[8])
             Right_Backward_Speed = int(settings[9])
-        else:
-            NewSettings = NewSettings + "," + str(Left_Forward_Speed) + "," + str(Left_Backward_Speed) + "," + str(Right_Forward_Speed) + "," + str(Right_Backward_Speed) + ":"
 
         # Save new settings to file system
         if commit:
-            # Try to remove the file first if it exists
+            self.WriteSettings()
+
+    # Puts new move settings in use
+    def UseSettings(self, name: str, speed: int, time: int, distance: float, turn: float, color: int):
+        global RobotName, LinearSpeedTarget, LinearTime, LinearDistance, TurnDistance, Color
+        RobotName = name
+        LinearSpeedTarget = speed
+        LinearTime = time
+        LinearDistance = distance
+        TurnDistance = turn
+        Color = color
+        self.RGB(Color, Color)
+        # Settings JSON needs rebuilding
+        self.settings_json = None
+
+    # Writes the settings in use, and the calibrated wheel speeds, to the settings file not holding
+    # the current record. Nothing is written if they haven't changed, returns whether anything was.
+    def WriteSettings(self):
+        record = self.record
+        struct.pack_into(StoreFormat, record, 0, StoreVersion, (self.store_seq + 1) & 0xFFFF, LinearSpeedTarget,
+                         LinearTime, LinearDistance, TurnDistance, Color, Left_Forward_Speed, Left_Backward_Speed,
+                         Right_Forward_Speed, Right_Backward_Speed, bytes(RobotName, "UTF-8"), 0)
+        # Only the settings count, not the sequence number or checksum
+        if self.store_slot >= 0 and record[3:StoreSize - 2] == self.store[3:StoreSize - 2]:
+            return False
+        struct.pack_into(">H", record, StoreSize - 2, self.CRC16(record, StoreSize - 2))
+        slot = 0 if self.store_slot == 1 else 1
+        with open(StoreFiles[slot], "wb") as settings_file:
+            settings_file.write(record)
+        self.store[:] = record
+        self.store_slot = slot
+        self.store_seq = (self.store_seq + 1) & 0xFFFF
+        return True
+
+    # Finds the newest valid settings record and puts it in use, returns False if there isn't one
+    def ReadSettings(self):
+        global Left_Forward_Speed, Left_Backward_Speed, Right_Forward_Speed, Right_Backward_Speed
+        for slot in (0, 1):
             try:
-                os.remove("settings.txt")
+                with open(StoreFiles[slot], "rb") as settings_file:
+                    data = settings_file.read()
             except:
-                pass
-            # Write text file
-            with open('settings.txt', 'w') as settings_file:
-                settings_file.write(NewSettings)
+                continue
+            if len(data) != StoreSize or data[0] != StoreVersion:
+                continue
+            if self.CRC16(data, StoreSize - 2) != struct.unpack_from(">H", data, StoreSize - 2)[0]:
+                continue
+            seq = struct.unpack_from(">H", data, 1)[0]
+            # Sequence numbers wrap, newer is less than half way round ahead
+            if self.store_slot < 0 or (seq - self.store_seq) & 0xFFFF < 0x8000:
+                self.store[:] = data
+                self.store_slot = slot
+                self.store_seq = seq
+        if self.store_slot < 0:
+            return False
+        values = struct.unpack(StoreFormat, self.store)
+        name = values[11]
+        end = name.find(b"\x00")
+        if end >= 0:
+            name = name[0:end]
+        self.UseSettings(str(name, "UTF-8"), values[2], values[3], values[4], values[5], values[6])
+        Left_Forward_Speed = values[7]
+        Left_Backward_Speed = values[8]
+        Right_Forward_Speed = values[9]
+        Right_Backward_Speed = values[10]
+        return True
+
+    # CRC-16/CCITT of the first length bytes of data, four bits at a time from CRCTable
+    @staticmethod
+    def CRC16(data, length: int):
+        crc = 0xFFFF
+        table = CRCTable
+        for index in range(length):
+            byte = data[index]
+            nibble = ((crc >> 12) ^ (byte >> 4)) * 2
+            crc = ((crc << 4) & 0xFFFF) ^ (table[nibble] << 8) ^ table[nibble + 1]
+            nibble = ((crc >> 12) ^ (byte & 0x0F)) * 2
+            crc = ((crc << 4) & 0xFFFF) ^ (table[nibble] << 8) ^ table[nibble + 1]
+        return crc
 
     # Loads saved settings from storage
+    # Without initialize, returns the settings JSON for setup mode instead, only rebuilt after the settings change
     def LoadSettings(self, initialize = False):
         global RobotName, LinearSpeedTarget, LinearTime, LinearDistance, TurnDistance, Color
         if not initialize:
-            # Create JSON string from current settings
-            content = '''{"name": "''' + RobotName + '''", "controls": [
+            if self.settings_json is None:
+                # Create JSON string from current settings
+                content = '''"name": "''' + RobotName + '''", "controls": [
             { "name": "LinearSpeedTarget", "displayname": "Speed of wheels", "min": 50, "max": 150, "increment": 1, "current": ''' + str(LinearSpeedTarget) + '''},
             { "name": "LinearTime", "displayname": "Max travel time (ms)", "min": 800, "max": 1500, "increment": 10, "current": ''' + str(LinearTime) + '''},
             { "name": "LinearDistance", "displayname": "Travel distance", "min": 0.2, "max": 1.2, "increment": 0.01, "current": ''' + str(LinearDistance) + '''},
             { "name": "TurnDistance", "displayname": "Turn distance", "min": 0.1, "max": 1.2, "increment": 0.01, "current": ''' + str(TurnDistance) + '''},
             { "name": "color", "displayname": "LED Color", "min": 1, "max": 7, "increment": 1, "current": ''' + str(Color) + '''}]}'''
-            return content
-        else:
-            # Check if settings files exist, create it if not
+                content = bytes(content, "UTF-8")
+                # The ETag is a checksum of the settings part, so it's the same after a restart
+                self.settings_etag = self.CRC16(content, len(content))
+                etag = '{"etag": "%04x"' % self.settings_etag
+                self.settings_json = bytes(etag + ", ", "UTF-8") + content
+                self.settings_current = bytes(etag + "}", "UTF-8")
+            return self.settings_json
+        elif not self.ReadSettings():
+            # Nothing stored yet, carry over the settings file older versions used if there is one
             try:
-                size = os.size("settings.txt")
-            except:
-                # Save default settings to files
-                settings = RobotName + "," + str(LinearSpeedTarget) + "," + str(LinearTime) + "," + str(LinearDistance) + "," + str(TurnDistance) + "," + str(Color) + "," + str(Left_Forward_Speed) + "," + str(Left_Backward_Speed) + "," + str(Right_Forward_Speed) + "," + str(Right_Backward_Speed) + ":"
-                self.SaveSettings(settings, True, True)
-            else:
-                # Load saved settings
                 with open('settings.txt') as settings_file:
                     content = settings_file.readline()
-                self.SaveSettings(content + ":", False, True)
+                self.SaveSettings(content + ":", False)
+            except:
+                pass
+            # Save the settings to storage
+            self.WriteSettings()
+            try:
+                os.remove("settings.txt")
+            except:
+                pass
 
     # Run the motors and calibrate their speeds
     def CalibrateSpeed(self):
-        self.LinearMove(4, 0, True)
-        sleep(1000)
-        self.LinearMove(4, 1, True)
+        self.Drive(self.CalibrateSteps())
+
+    # Steps of CalibrateSpeed, forward then backward, shows a tick if both came out on target
+    def CalibrateSteps(self):
+        if not ModelCalibration:
+            yield from self.LinearSteps(4, 0, True)
+            yield 1000
+            yield from self.LinearSteps(4, 1, True)
+            return
+        forward = yield from self.FitSpeedSteps(0)
+        yield 500
+        backward = yield from self.FitSpeedSteps(1)
+        display.show(Image.YES if forward and backward else Image.CONFUSED)
+
+    # Steps of calibrating both wheels in one direction, fitting speed = gain * (PWM - deadband) for
+    # each wheel through two measured points. If the check is more than 5 off target the PWM is
+    # corrected once more through the last two points. Returns whether both wheels ended up on target.
+    def FitSpeedSteps(self, MoveDirection: int):
+        global Right_Forward_Speed, Right_Backward_Speed, Left_Forward_Speed, Left_Backward_Speed
+        self.TraceStart(2, 0, MoveDirection)
+        # Keeps the pose right when the wheels change direction
+        self.clearDistance(ALL)
+        if MoveDirection == 0:
+            direction = Dir.CW
+            pwm = [Left_Forward_Speed, Right_Forward_Speed]
+        else:
+            direction = Dir.CCW
+            pwm = [Left_Backward_Speed, Right_Backward_Speed]
+        measured = self.measured
+        # Slowly accelerate motors (prevents lurching on start)
+        level = 0
+        while level < max(pwm):
+            level += 10
+            self.setMotors(min(level, pwm[0]), min(level, pwm[1]), direction, direction)
+            yield 20
+        yield from self.MeasureSteps()
+        last_pwm = list(pwm)
+        last_speed = list(measured)
+        ok = False
+        for attempt in range(4):
+            if attempt == 0:
+                # Second point to fit through
+                for wheel in (0, 1):
+                    pwm[wheel] = min(255, pwm[wheel] + CalibrateStep)
+            else:
+                ok = True
+                for wheel in (0, 1):
+                    if abs(measured[wheel] - LinearSpeedTarget) > 5:
+                        ok = False
+                    rise = measured[wheel] - last_speed[wheel]
+                    step = pwm[wheel] - last_pwm[wheel]
+                    last_pwm[wheel] = pwm[wheel]
+                    last_speed[wheel] = measured[wheel]
+                    # A wheel that didn't speed up can't be fitted, leave it
+                    if step != 0 and rise * step > 0:
+                        target = pwm[wheel] + (LinearSpeedTarget - measured[wheel]) * step / rise
+                        pwm[wheel] = max(1, min(255, round(target)))
+                if ok or attempt == 3:
+                    break
+            self.setMotors(pwm[0], pwm[1], direction, direction)
+            yield from self.MeasureSteps()
+        self.stopAll()
+        # Keep the PWM that was measured last
+        if MoveDirection == 0:
+            Left_Forward_Speed = last_pwm[0]
+            Right_Forward_Speed = last_pwm[1]
+        else:
+            Left_Backward_Speed = last_pwm[0]
+            Right_Backward_Speed = last_pwm[1]
+        return ok
+
+    # Steps of measuring both wheel speeds once they've settled, into measured
+    def MeasureSteps(self):
+        yield CalibrateSettle
+        measured = self.measured
+        measured[0] = 0
+        measured[1] = 0
+        for sample in range(CalibrateSamples):
+            sensors = self.getSensors()
+            measured[0] += sensors[2]
+            measured[1] += sensors[3]
+            yield 20
+        measured[0] = measured[0] / CalibrateSamples
+        measured[1] = measured[1] / CalibrateSamples
 
     # Performs a test of the robot's movements
     def NavigationTest(self):
-        self.LinearMove(2, 0, False)
-        sleep(1000)
-        self.LinearMove(1, 1, False)
-        sleep(1000)
-        self.Turn(1, 0)
-        sleep(1000)
-        self.Turn(1, 1)
-        sleep(500)
-        self.Turn(2, 0)
-
-M = MaqueenPlus()
-M.forever()
\ No newline at end of file
+        self.Drive(self.NavigationSteps())
+
+    # Steps of NavigationTest: two squares forward, one back, a quarter turn right and back left,
+    # then a half turn right
+    def NavigationSteps(self):
+        yield from self.LinearSteps(2, 0, False)
+        yield 1000
+        yield from self.LinearSteps(1, 1, False)
+        yield 1000
+        yield from self.TurnSteps(1, 0)
+        yield 1000
+        yield from self.TurnSteps(1, 1)
+        yield 500
+        yield from self.TurnSteps(2, 0)
+
+# Only start when run on the micro:bit, lets the host emulator import everything above
+if __name__ == "__main__":
+    M = MaqueenPlus()
+    M.forever()
\ No newline at end of file